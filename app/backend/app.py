@@ -1,10 +1,12 @@
 import os
-import io
+import hmac
+import json
 import mimetypes
 import time
 import logging
 import openai
-from flask import Flask, request, jsonify, send_file, abort
+import logs
+from flask import Flask, Response, request, jsonify, abort, g, stream_with_context
 from azure.identity import DefaultAzureCredential
 from azure.search.documents import SearchClient
 from approaches.retrievethenread import RetrieveThenReadApproach
@@ -13,6 +15,17 @@ from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.chatretrievethenread import ChatRetrieveThenReadApproach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from azure.storage.blob import BlobServiceClient
+from cache import AnswerCache, IndexVersion, SearchCache
+from content import ContentProxy
+from deadline import DeadlineExceeded, request_deadline
+from metrics import Metrics
+from pool import BoundedExecutor, PoolSaturated
+from profiling import SAMPLE, RequestProfiler
+from ratelimit import RateLimiter
+from recording import TrafficRecorder
+from resilience import ResilientCaller
+from semanticcache import SemanticCache, OpenAIEmbedder
+from usage import SessionIds, UsageTracker
 import mimetypes
 
 mimetypes.add_type('application/javascript', '.js')
@@ -31,6 +44,96 @@ AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMEN
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
+KB_FIELDS_TOKENS = os.environ.get("KB_FIELDS_TOKENS") or "tokens"
+
+# Cache of complete chat answers, set ANSWER_CACHE_SIZE to 0 to disable it. The on-disk tier is only used if ANSWER_CACHE_DIR is set
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE") or 512)
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL") or 3600)
+ANSWER_CACHE_DIR = os.environ.get("ANSWER_CACHE_DIR")
+INDEX_VERSION_REFRESH_INTERVAL = int(os.environ.get("INDEX_VERSION_REFRESH_INTERVAL") or 60)
+
+# Search the raw question and start answering while the keyword query is generated, can also be set per request with the
+# "speculative_retrieval" override
+SPECULATIVE_RETRIEVAL = (os.environ.get("SPECULATIVE_RETRIEVAL") or "false").lower() == "true"
+
+# Cache of search results shared by all approaches, set SEARCH_CACHE_SIZE to 0 to disable it
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE") or 1024)
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL") or 300)
+
+# Cache of answers for paraphrased questions, only enabled if an embeddings deployment is set
+AZURE_OPENAI_EMB_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMB_DEPLOYMENT")
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE") or 1000)
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD") or 0.95)
+
+# All OpenAI calls go through one pool, requests get a 429 response when LLM_POOL_WORKERS calls are running and
+# LLM_POOL_QUEUE more are waiting
+LLM_POOL_WORKERS = int(os.environ.get("LLM_POOL_WORKERS") or 16)
+LLM_POOL_QUEUE = int(os.environ.get("LLM_POOL_QUEUE") or 64)
+
+# Requests-per-minute and tokens-per-minute quotas of the OpenAI deployments, shared by all approaches. Calls wait for
+# quota for at most OPENAI_QUOTA_MAX_WAIT seconds before the request gets a 429 response. Leave unset for no limit
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM") or 0)
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM") or 0)
+OPENAI_QUOTA_MAX_WAIT = int(os.environ.get("OPENAI_QUOTA_MAX_WAIT") or 30)
+
+# Failed OpenAI and search calls are retried with jittered exponential backoff. With HEDGE_REQUESTS, a second request is
+# sent when a call takes longer than the p95 latency of its kind, and the first response is used
+RETRY_MAX_RETRIES = int(os.environ.get("RETRY_MAX_RETRIES") or 3)
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY") or 0.5)
+HEDGE_REQUESTS = (os.environ.get("HEDGE_REQUESTS") or "false").lower() == "true"
+
+# Deadline of /ask and /chat requests in seconds. Search and OpenAI calls get the time that is left as their HTTP timeout,
+# and the request gets a 504 response when it runs out. Set to 0 for no deadline
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT") or 60)
+
+# Logs are written as JSON lines by a background thread. LOG_SAMPLE_RATE is the share of requests that are also logged
+# at debug level, with their prompts, history and documents. Set LOG_FORMAT to "text" for readable logs when developing
+LOG_LEVEL = os.environ.get("LOG_LEVEL") or "INFO"
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE") or 0.01)
+LOG_FORMAT = os.environ.get("LOG_FORMAT") or "json"
+
+logs.configure_logging(LOG_LEVEL, LOG_SAMPLE_RATE, LOG_FORMAT == "json")
+
+# A share of the /ask and /chat requests is recorded to RECORD_DIR, with the search results and OpenAI responses they
+# saw, for replaying with benchmarks/replay.py. Every word of the questions, history, search queries and answers is
+# replaced by a placeholder of the same length, the search results are stored as they are. RECORD_RAW_TEXT keeps the
+# text with only e-mail addresses and long numbers masked, only set it where storing what customers type is allowed.
+# Leave RECORD_DIR unset to disable
+RECORD_DIR = os.environ.get("RECORD_DIR")
+RECORD_SAMPLE_RATE = float(os.environ.get("RECORD_SAMPLE_RATE") or 0.1)
+RECORD_RAW_TEXT = (os.environ.get("RECORD_RAW_TEXT") or "false").lower() == "true"
+
+# /ask and /chat requests with the "profile" override, and PROFILE_SAMPLE_RATE of all others, are profiled. Profiles
+# show the prompts and data of the request, so they are only for admins: the override is only honored, and the
+# X-Profile header with the path to download the profile from only sent, for requests with an X-Admin-Token header
+# that matches PROFILE_ADMIN_TOKEN, which /profiles requires too. Without PROFILE_ADMIN_TOKEN profiles can't be
+# requested or downloaded. PROFILE_MODE "sample" records the call stacks every few milliseconds, "cprofile" records
+# every call but slows the request down. Not available in asyncapp.py, where the event loop is shared by all requests
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_MODE = os.environ.get("PROFILE_MODE") or "sample"
+PROFILE_MAX_STORED = int(os.environ.get("PROFILE_MAX_STORED") or 100)
+
+# Token usage and cost of the OpenAI calls are summed per approach, stage and session and served on /usage. Prices are
+# "prompt,completion" per 1000 tokens. Sessions are identified by a signed cookie the server issues to clients that
+# don't send a valid one, requests without it only have the request budget. Set SESSION_SECRET to the same value on all
+# instances so they accept each other's cookies, without it every process signs with its own random secret.
+# SESSION_TOKEN_BUDGET and REQUEST_TOKEN_BUDGET stop requests with a 429 response when they are used up, sessions are
+# forgotten SESSION_TTL seconds after their last call. Leave the budgets unset for no limit
+AZURE_OPENAI_GPT_PRICES = os.environ.get("AZURE_OPENAI_GPT_PRICES") or "0.02,0.02"
+AZURE_OPENAI_CHATGPT_PRICES = os.environ.get("AZURE_OPENAI_CHATGPT_PRICES") or "0.0015,0.002"
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET") or 0)
+REQUEST_TOKEN_BUDGET = int(os.environ.get("REQUEST_TOKEN_BUDGET") or 0)
+SESSION_TTL = int(os.environ.get("SESSION_TTL") or 3600)
+SESSION_SECRET = os.environ.get("SESSION_SECRET")
+
+# Content files are streamed from blob storage, recently viewed files are cached on disk if CONTENT_CACHE_DIR is set.
+# With CONTENT_SAS_REDIRECT, clients are redirected to short-lived SAS URLs instead, which requires the app identity to
+# have the Storage Blob Delegator role
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR")
+CONTENT_CACHE_SIZE_MB = int(os.environ.get("CONTENT_CACHE_SIZE_MB") or 500)
+CONTENT_SAS_REDIRECT = (os.environ.get("CONTENT_SAS_REDIRECT") or "false").lower() == "true"
+CONTENT_SAS_TTL = int(os.environ.get("CONTENT_SAS_TTL") or 300)
 
 # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed, 
 # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the 
@@ -56,21 +159,63 @@ blob_client = BlobServiceClient(
     credential=azure_credential)
 blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
+# prepdocs.py stamps a new index version on the content container after indexing, which invalidates the caches
+index_version = IndexVersion(blob_container, INDEX_VERSION_REFRESH_INTERVAL)
+answer_cache = AnswerCache(index_version, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_DIR) if ANSWER_CACHE_SIZE > 0 else None
+search_cache = SearchCache(index_version, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL) if SEARCH_CACHE_SIZE > 0 else None
+llm_pool = BoundedExecutor(LLM_POOL_WORKERS, LLM_POOL_QUEUE)
+metrics = Metrics()
+traffic_recorder = TrafficRecorder(RECORD_DIR, RECORD_SAMPLE_RATE, RECORD_RAW_TEXT)
+request_profiler = RequestProfiler(PROFILE_SAMPLE_RATE, PROFILE_MODE, PROFILE_MAX_STORED)
+usage_tracker = UsageTracker({
+    AZURE_OPENAI_GPT_DEPLOYMENT: tuple(float(price) for price in AZURE_OPENAI_GPT_PRICES.split(",")),
+    AZURE_OPENAI_CHATGPT_DEPLOYMENT: tuple(float(price) for price in AZURE_OPENAI_CHATGPT_PRICES.split(","))
+}, SESSION_TOKEN_BUDGET, REQUEST_TOKEN_BUDGET, SESSION_TTL)
+session_ids = SessionIds(SESSION_SECRET)
+rate_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM, OPENAI_QUOTA_MAX_WAIT)
+resilience = ResilientCaller(RETRY_MAX_RETRIES, RETRY_BASE_DELAY, hedge=HEDGE_REQUESTS, rate_limiter=rate_limiter)
+content_proxy = ContentProxy(blob_container, CONTENT_CACHE_DIR, CONTENT_CACHE_SIZE_MB * 1024 * 1024, CONTENT_SAS_REDIRECT, blob_client, CONTENT_SAS_TTL)
+semantic_cache = SemanticCache(OpenAIEmbedder(AZURE_OPENAI_EMB_DEPLOYMENT, rate_limiter, resilience), index_version, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE) if AZURE_OPENAI_EMB_DEPLOYMENT and SEMANTIC_CACHE_SIZE > 0 else None
+
 # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
-# or some derivative, here we include several for exploration purposes
-ask_approaches = {
-    "rtr": RetrieveThenReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rrr": ReadRetrieveReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rda": ReadDecomposeAsk(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
-}
-
-chat_approaches = {
-    "rtr": ChatRetrieveThenReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
-}
+# or some derivative, here we include several for exploration purposes.
+# The async search client is optional, and is only used by the approaches when served from asyncapp.py
+def create_approaches(search_client, async_search_client=None):
+    ask_approaches = {
+        "rtr": RetrieveThenReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, async_search_client, search_cache, KB_FIELDS_TOKENS, llm_pool, rate_limiter, resilience, metrics),
+        "rrr": ReadRetrieveReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, search_cache, llm_pool, rate_limiter, resilience, metrics),
+        "rda": ReadDecomposeAsk(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, search_cache, llm_pool, rate_limiter, resilience, metrics)
+    }
+
+    chat_approaches = {
+        "rtr": ChatRetrieveThenReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, async_search_client, answer_cache, semantic_cache, search_cache, SPECULATIVE_RETRIEVAL, KB_FIELDS_TOKENS, llm_pool, rate_limiter, resilience, metrics),
+        "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, search_cache, llm_pool, rate_limiter, resilience, metrics)
+    }
+
+    return ask_approaches, chat_approaches
+
+ask_approaches, chat_approaches = create_approaches(search_client)
 
 app = Flask(__name__)
 
+# Every request gets an id, taken from the X-Request-ID header when the client or a proxy sets one, which is added to
+# all its log records and returned in the response
+@app.before_request
+def start_request():
+    logs.start_request(request.headers.get("X-Request-ID"))
+
+@app.after_request
+def add_request_id(response):
+    response.headers["X-Request-ID"] = logs.request_id()
+    if g.get("profile_id") and is_profile_admin():
+        response.headers["X-Profile"] = f"/profiles/{g.profile_id}"
+    set_session_cookie(response, request.cookies, request.is_secure)
+    return response
+
+def is_profile_admin():
+    token = request.headers.get("X-Admin-Token")
+    return bool(PROFILE_ADMIN_TOKEN and token and hmac.compare_digest(token.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8")))
+
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
 def static_file(path):
@@ -78,19 +223,13 @@ def static_file(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained. 
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files.
 @app.route("/content/<path>")
 def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+    r = content_proxy.get(path, request.headers.get("Range"), request.headers.get("If-None-Match"))
+    if r.status == 404:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    blob.readinto(blob_file)
-    blob_file.seek(0)
-    return send_file(blob_file, mimetype=mime_type, as_attachment=False, download_name=path)
+    return Response(r.body, status=r.status, headers=r.headers, direct_passthrough=True)
 
 @app.route("/ask", methods=["POST"])
 def ask():
@@ -102,8 +241,14 @@ def ask():
         impl = ask_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
+        overrides = request.json.get("overrides") or {}
+        with metrics.request("/ask", approach), request_deadline(REQUEST_TIMEOUT), traffic_recorder.record("/ask", request.json), request_profiler.profile(overrides, is_profile_admin()) as g.profile_id, usage_tracker.request("/ask", approach, request_session_id(request.cookies)):
+            r = impl.run(request.json["question"], overrides)
         return jsonify(r)
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    except DeadlineExceeded as e:
+        return gateway_timeout(e)
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
@@ -118,12 +263,127 @@ def chat():
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
+        overrides = request.json.get("overrides") or {}
+        with metrics.request("/chat", approach), request_deadline(REQUEST_TIMEOUT), traffic_recorder.record("/chat", request.json), request_profiler.profile(overrides, is_profile_admin()) as g.profile_id, usage_tracker.request("/chat", approach, request_session_id(request.cookies)):
+            r = impl.run(request.json["history"], overrides)
         return jsonify(r)
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    except DeadlineExceeded as e:
+        return gateway_timeout(e)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(get_stats(chat_approaches))
+
+# Token usage and cost per approach and stage, and the sessions that used the most tokens
+@app.route("/usage", methods=["GET"])
+def usage_endpoint():
+    return jsonify(usage_tracker.summary())
+
+# Latency histograms of the requests and of every stage, in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=METRICS_MIMETYPE)
+
+# Profile of a request, as collapsed stacks for flamegraph.pl or speedscope, or as pstats data for pstats or snakeviz.
+# Answers 404 to everyone but admins, so it doesn't tell whether a profile exists
+@app.route("/profiles/<profile_id>", methods=["GET"])
+def profile_file(profile_id):
+    profile = request_profiler.get(profile_id) if is_profile_admin() else None
+    if profile is None:
+        abort(404)
+    mode, data = profile
+    filename = f"{profile_id}.txt" if mode == SAMPLE else f"{profile_id}.prof"
+    return Response(data, mimetype="text/plain" if mode == SAMPLE else "application/octet-stream",
+                    headers={"Content-Disposition": f"attachment; filename=\"{filename}\""})
+
+def get_stats(chat_approaches):
+    return {
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "search_cache": search_cache.stats() if search_cache else None,
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "content": content_proxy.stats(),
+        "llm_pool": llm_pool.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "resilience": resilience.stats(),
+        "recorder": traffic_recorder.stats(),
+        "profiler": request_profiler.stats(),
+        "stages": metrics.stats(),
+        "speculation": chat_approaches["rtr"].speculation_stats.stats()
+    }
+
+# Streaming variants of /ask and /chat, sent as server-sent events. See Approach.run_stream for the events that are sent
+@app.route("/ask_stream", methods=["POST"])
+def ask_stream():
+    ensure_openai_token()
+    if not request.json:
+        return jsonify({"error": "request must be json"}), 400
+    impl = ask_approaches.get(request.json["approach"])
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    try:
+        llm_pool.check()
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    events = impl.run_stream(request.json["question"], request.json.get("overrides") or {})
+    return Response(stream_with_context(sse_stream(events, "/ask_stream", request.json["approach"], request_session_id(request.cookies))), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+@app.route("/chat_stream", methods=["POST"])
+def chat_stream():
+    ensure_openai_token()
+    if not request.json:
+        return jsonify({"error": "request must be json"}), 400
+    impl = chat_approaches.get(request.json["approach"])
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    try:
+        llm_pool.check()
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    events = impl.run_stream(request.json["history"], request.json.get("overrides") or {})
+    return Response(stream_with_context(sse_stream(events, "/chat_stream", request.json["approach"], request_session_id(request.cookies))), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+def too_many_requests(e):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+def gateway_timeout(e):
+    return jsonify({"error": str(e)}), 504
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4"
+
+# Stop proxies from buffering the stream, which would defeat the purpose of streaming
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def format_sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+def sse_stream(events, route, approach, session_id=None):
+    try:
+        # The approach only starts working when the stream is read, so the deadline and metric labels are set here
+        with metrics.request(route, approach), request_deadline(REQUEST_TIMEOUT), usage_tracker.request(route, approach, session_id):
+            for event in events:
+                yield format_sse(event)
+    except Exception as e:
+        # The response status has already been sent, so errors are reported as a final event
+        logging.exception(f"Exception in {route}")
+        yield format_sse({"error": str(e)})
+
+SESSION_COOKIE = "session_id"
+
+# Session of the request, None without a cookie issued by the server
+def request_session_id(cookies):
+    return session_ids.verify(cookies.get(SESSION_COOKIE))
+
+# Clients without a valid session cookie are issued one with the response, their next requests count against its budget
+def set_session_cookie(response, cookies, secure):
+    if request_session_id(cookies) is None:
+        response.set_cookie(SESSION_COOKIE, session_ids.issue(), httponly=True, samesite="Lax", secure=secure)
+
+# Blocks while the credential fetches a new token, so asyncapp.py calls it in a worker thread
 def ensure_openai_token():
     global openai_token
     if openai_token.expires_on < int(time.time()) - 60:
@@ -1,6 +1,145 @@
-from typing import Any
+import time
+import asyncio
+from typing import Any, AsyncIterator, Iterator, Optional
+from azure.search.documents.models import QueryType
+import deadline
+import usage
+from cache import SearchCache
+from metrics import SEARCH, Metrics
+from pool import BoundedExecutor
+from ratelimit import RateLimiter, estimate_request_tokens
+from recording import record_search
+from resilience import ResilientCaller
+from tokens import estimate_tokens
 
+# Sent as the "error" of the last event of a stream when no answer could be generated, or its completion stream was cut off
+ANSWER_FAILED = "The answer could not be generated, please try again."
+
+# Finish reasons of a completion whose answer is complete, "length" answers are cut at max_tokens but still usable
+COMPLETE_FINISH_REASONS = ("stop", "length")
 
 class Approach:
+    search_client = None
+    async_search_client = None
+    search_cache: Optional[SearchCache] = None
+    tokens_field: Optional[str] = None
+    executor: Optional[BoundedExecutor] = None
+    rate_limiter: Optional[RateLimiter] = None
+    resilience: Optional[ResilientCaller] = None
+    metrics: Optional[Metrics] = None
+
     def run(self, q: str, overrides: dict[str, Any]) -> Any:
         raise NotImplementedError
+
+    async def run_async(self, q: str, overrides: dict[str, Any]) -> Any:
+        # Approaches without native async support are run in a worker thread so they don't block the event loop
+        return await asyncio.to_thread(self.run, q, overrides)
+
+    # Streaming sends the data points first, then the answer in one or more "delta" events, and ends with an event
+    # holding the final answer and thoughts. Approaches that can't stream their answer send it as a single delta. When
+    # no answer could be generated, or its stream broke off, the last event holds an "error" instead of the answer.
+    def run_stream(self, q: str, overrides: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        yield from self.response_events(self.run(q, overrides))
+
+    async def run_stream_async(self, q: str, overrides: dict[str, Any]) -> AsyncIterator[dict[str, Any]]:
+        for event in self.response_events(await self.run_async(q, overrides)):
+            yield event
+
+    def response_events(self, r: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        yield {"data_points": r.get("data_points") or []}
+        if not r.get("answer"):
+            yield self.answer_failed_event()
+            return
+        yield {"delta": r.get("answer")}
+        yield {"answer": r.get("answer"), "thoughts": r.get("thoughts"), "followup_questions": []}
+
+    def answer_failed_event(self) -> dict[str, Any]:
+        return {"error": ANSWER_FAILED}
+
+    # A completion stream is only complete when its last chunk has a finish reason. A stream that just ends, e.g. when
+    # the connection drops, or whose content was filtered, didn't deliver the whole answer
+    def stream_finished(self, chunk: Any) -> bool:
+        return bool(chunk.choices) and chunk.choices[0].get("finish_reason") in COMPLETE_FINISH_REASONS
+
+    # Searches the index with the options used by all approaches. The results are read into a list, so they can be cached
+    # and iterated more than once, and repeated searches are served from the shared search cache if there is one.
+    def search_documents(self, q: str, filter: Optional[str], top: Optional[int], overrides: dict[str, Any]) -> list[dict[str, Any]]:
+        with self.metrics.stage(SEARCH):
+            started = time.perf_counter()
+            key = self.search_cache_key(q, filter, top, overrides)
+            documents = self.search_cache.get(key) if key else None
+            cached = documents is not None
+            if documents is None:
+                documents = self.resilience.call("search", self.run_search, q, filter, top, overrides)
+                if key:
+                    self.search_cache.set(key, documents)
+            record_search(q, filter, top, documents, time.perf_counter() - started, cached)
+            return list(documents)
+
+    async def search_documents_async(self, q: str, filter: Optional[str], top: Optional[int], overrides: dict[str, Any]) -> list[dict[str, Any]]:
+        if self.async_search_client is None:
+            return await asyncio.to_thread(self.search_documents, q, filter, top, overrides)
+
+        with self.metrics.stage(SEARCH):
+            started = time.perf_counter()
+            # The key includes the index version, which is read from blob storage when it is due
+            key = await asyncio.to_thread(self.search_cache_key, q, filter, top, overrides) if self.search_cache else None
+            documents = self.search_cache.get(key) if key else None
+            cached = documents is not None
+            if documents is None:
+                documents = await self.resilience.call_async("search", self.run_search_async, q, filter, top, overrides)
+                if key:
+                    self.search_cache.set(key, documents)
+            record_search(q, filter, top, documents, time.perf_counter() - started, cached)
+            return list(documents)
+
+    # Records the token usage of a completion in the usage of the request, streamed completions when the stream ends
+    def completion_usage(self, deployment: str, completion: Any, stream: bool, prompts: list[str]) -> Any:
+        if stream:
+            return usage.record_stream(deployment, completion, estimate_request_tokens(prompts, None))
+        usage.record_completion(deployment, completion)
+        return completion
+
+    def completion_usage_async(self, deployment: str, completion: Any, stream: bool, prompts: list[str]) -> Any:
+        if stream:
+            return usage.record_stream_async(deployment, completion, estimate_request_tokens(prompts, None))
+        usage.record_completion(deployment, completion)
+        return completion
+
+    # Token count of a source made of the name and the document content, using the count of the content that prepdocs.py
+    # stores in the index, so nothing is encoded on the request path. None for documents indexed before the counts were
+    # stored, which the approaches encode instead.
+    def document_tokens(self, doc: dict[str, Any], name: str) -> Optional[int]:
+        content_tokens = doc.get(self.tokens_field) if self.tokens_field else None
+        if content_tokens is None:
+            return None
+        return content_tokens + estimate_tokens(name)
+
+    def run_search(self, q: str, filter: Optional[str], top: Optional[int], overrides: dict[str, Any]) -> list[dict[str, Any]]:
+        return list(self.search_client.search(q, **self.search_arguments(filter, top, overrides)))
+
+    async def run_search_async(self, q: str, filter: Optional[str], top: Optional[int], overrides: dict[str, Any]) -> list[dict[str, Any]]:
+        r = await self.async_search_client.search(q, **self.search_arguments(filter, top, overrides))
+        return [doc async for doc in r]
+
+    def search_cache_key(self, q: str, filter: Optional[str], top: Optional[int], overrides: dict[str, Any]) -> Optional[str]:
+        if self.search_cache is None:
+            return None
+        return self.search_cache.key(q, filter, top, bool(overrides.get("semantic_ranker")), bool(overrides.get("semantic_captions")))
+
+    # The remaining time of the request is passed on as the connection, read and total timeouts of the search call, so
+    # a search that can't finish before the deadline is abandoned on the wire instead of holding a thread
+    def search_arguments(self, filter: Optional[str], top: Optional[int], overrides: dict[str, Any]) -> dict[str, Any]:
+        args = dict(filter=filter)
+        timeout = deadline.remaining()
+        if timeout is not None:
+            args.update(connection_timeout=timeout, read_timeout=timeout, timeout=timeout)
+        if top is not None:
+            args["top"] = top
+        if overrides.get("semantic_ranker"):
+            args.update(query_type=QueryType.SEMANTIC, 
+                        query_language="en-us", 
+                        query_speller="lexicon", 
+                        semantic_configuration_name="default", 
+                        query_caption="extractive|highlight-false" if overrides.get("semantic_captions") else None)
+        return args
@@ -1,14 +1,20 @@
+import logging
 import openai
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.chat_models import AzureChatOpenAI
+from cache import SearchCache
+from pool import BoundedExecutor
+from ratelimit import RateLimiter
+from metrics import ANSWER_GENERATION, Metrics
+from resilience import ResilientCaller
 from langchain.callbacks.manager import CallbackManager
 from langchain.agents import Tool, AgentType, initialize_agent, ConversationalChatAgent
 from langchain.memory import ConversationBufferMemory
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import DeadlineAzureChatOpenAI, HtmlCallbackHandler, LoggingCallbackHandler, RateLimitCallbackHandler
 from text import nonewlines
-from typing import Any, Sequence
+from typing import Any, Optional, Sequence
+
+logger = logging.getLogger(__name__)
 
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -73,8 +79,13 @@ Here is the user's input (remember to respond with a markdown code snippet of a
 
     CognitiveSearchToolDescription = "Useful for searching for public information about DNB house insurance."
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str, search_cache: Optional[SearchCache] = None, executor: Optional[BoundedExecutor] = None, rate_limiter: Optional[RateLimiter] = None, resilience: Optional[ResilientCaller] = None, metrics: Optional[Metrics] = None):
         self.search_client = search_client
+        self.search_cache = search_cache
+        self.executor = executor or BoundedExecutor()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.resilience = resilience or ResilientCaller(rate_limiter=self.rate_limiter)
+        self.metrics = metrics or Metrics()
         self.chatgpt_deployment = chatgpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
@@ -85,17 +96,7 @@ Here is the user's input (remember to respond with a markdown code snippet of a
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+        r = self.search_documents(q, filter, top, overrides)
         if use_semantic_captions:
             self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
@@ -112,7 +113,9 @@ Here is the user's input (remember to respond with a markdown code snippet of a
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        # Logs the prompts, actions and observations of the agent for sampled requests
+        log_handler = LoggingCallbackHandler()
+        cb_manager = CallbackManager(handlers=[cb_handler, log_handler])
         
         acs_tool = Tool(name="CognitiveSearch", 
                         func=lambda q: self.retrieve(q, overrides), 
@@ -121,7 +124,12 @@ Here is the user's input (remember to respond with a markdown code snippet of a
        
         tools: Sequence = [acs_tool]
 
-        temp_human_message=self.human_message.format(tools=tools, format_instructions=self.format_instructions.format(tool_names=", ".join([t.name for t in tools])), sources=self.sourcepage_field, input=history[-1].get("user"))
+        # The question is passed to the agent as its input, the only variable left in the prompt. create_prompt formats the
+        # human message twice before it parses it as a template, so its input placeholder is escaped twice, while the
+        # system message is parsed as it is
+        format_instructions = self.format_instructions.format(tool_names=", ".join([t.name for t in tools]))
+        temp_human_message = self.human_message.format(format_instructions=format_instructions, sources=self.sourcepage_field, input="{{{{input}}}}")
+        temp_system_message = self.system_message.format(format_instructions=format_instructions, sources=self.sourcepage_field, input="{input}")
 
         # memory = ConversationBufferMemory(memory_key = "chat_history", 
         #                               input_key = "input",
@@ -130,37 +138,39 @@ Here is the user's input (remember to respond with a markdown code snippet of a
         #                               human_prefix=human_message)
 
         prompt = ConversationalChatAgent.create_prompt(
-            system_message=self.system_message,
+            system_message=temp_system_message,
             human_message=temp_human_message,
             tools=tools,
             input_variables=["input", "agent_scratchpad", "chat_history"])
 
-        print(prompt)
+        logger.debug("Created agent prompt", extra={"prompt": prompt})
 
-        llm = AzureChatOpenAI(deployment_name=self.chatgpt_deployment, 
+        llm = DeadlineAzureChatOpenAI(deployment_name=self.chatgpt_deployment, 
                               temperature=0, 
                               openai_api_key=openai.api_key, 
                               openai_api_base=openai.api_base, 
-                              openai_api_version=openai.api_version
+                              openai_api_version=openai.api_version,
+                              callbacks=[RateLimitCallbackHandler(self.rate_limiter, deployment=self.chatgpt_deployment), log_handler]
                               )
 
         conversational_agent = initialize_agent(
             agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
             tools=tools, 
             llm=llm,
-            verbose=True,
+            callbacks=[log_handler],
             max_iterations=5,
             memory=ConversationBufferMemory(memory_key = "chat_history", 
                                       input_key = "input",
                                       output_key = "output", 
                                       return_messages = True),
             agent_kwargs= {
-                "system_message": self.system_message,
+                "system_message": temp_system_message,
                 "human_message": temp_human_message
                 }
             )
-        print(history)
-        result = conversational_agent.run(history[-1].get("user"))
+        logger.debug("Running agent", extra={"history": history})
+        # The searches made by the agent are also recorded as their own stage
+        result = self.executor.submit(self.metrics.timed, ANSWER_GENERATION, conversational_agent.run, history[-1].get("user")).result()
         
         
         # Remove references to tool names that might be confused with a citation
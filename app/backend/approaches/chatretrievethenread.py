@@ -1,14 +1,78 @@
+import asyncio
+import logging
+import threading
 import time
 import re
 import concurrent.futures
-from typing import Any, Sequence
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
 import openai
-import openai.error
+import deadline
+import usage
+import logs
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from approaches.approach import Approach
+from cache import AnswerCache, SearchCache, answer_overrides
+from pool import BoundedExecutor
+from ratelimit import ANSWER, QUERY, RateLimiter, estimate_request_tokens
+from metrics import ANSWER_GENERATION, QUERY_GENERATION, SOURCE_PACKING, SOURCE_VALIDATION, Metrics
+from resilience import ResilientCaller, is_retryable
+from semanticcache import SemanticCache, question_language
 from text import nonewlines
-import tiktoken
+from tokens import TokenCounter
+
+logger = logging.getLogger(__name__)
+
+class SpeculationStats:
+    """
+    Counts how often a speculative answer was used or discarded, how much time using it saved, and how many tokens the
+    discarded ones used before their stream was closed.
+    """
+
+    def __init__(self):
+        self.used = 0
+        self.discarded = 0
+        self.saved_seconds = 0.0
+        self.wasted_tokens = 0
+        self.lock = threading.Lock()
+
+    def record(self, used, saved_seconds):
+        with self.lock:
+            if used:
+                self.used += 1
+                self.saved_seconds += max(saved_seconds, 0)
+            else:
+                self.discarded += 1
+
+    def record_waste(self, tokens):
+        with self.lock:
+            self.wasted_tokens += tokens
+
+    def stats(self):
+        attempts = self.used + self.discarded
+        return {
+            "attempts": attempts,
+            "used": self.used,
+            "discarded": self.discarded,
+            "use_rate": self.used / attempts if attempts else 0.0,
+            "saved_ms_total": round(self.saved_seconds * 1000),
+            "saved_ms_per_use": round(self.saved_seconds * 1000 / self.used) if self.used else 0,
+            "wasted_tokens": self.wasted_tokens,
+            "wasted_tokens_per_discard": round(self.wasted_tokens / self.discarded) if self.discarded else 0
+        }
+
+class SpeculativeAnswer:
+    """
+    State of a speculative answer that is being generated. The answer is streamed, so a discarded one stops at the next
+    chunk and its stream is closed, which drops the connection and stops the generation, instead of the whole answer
+    being generated and billed. Counts the prompt tokens and the chunks received, which are wasted if it is discarded.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.tokens = 0
+        self.started = time.time()
+        self.finished = None
 
 class ChatRetrieveThenReadApproach(Approach):
     """
@@ -29,6 +93,16 @@ class ChatRetrieveThenReadApproach(Approach):
     CHATGPT_MAX_RETRIES = 3
     CHATGPT_MAX_TOKENS = 8192
     CHATGPT_MAXIMUM_ANSWER_LENGTH = 1024
+    # The prompt and the answer must fit in the context window together
+    PROMPT_MAX_TOKENS = CHATGPT_MAX_TOKENS - CHATGPT_MAXIMUM_ANSWER_LENGTH
+    # Sources are encoded in batches, so documents that won't fit in the prompt are mostly never encoded
+    SOURCE_BATCH_SIZE = 8
+
+    # Sources are cited by name in square brackets
+    SOURCE_REFERENCE = r"\[([^]]+)\]"
+
+    # Minimum overlap (Jaccard index) between the sources of the raw question and the keyword query to use a speculative answer
+    SPECULATION_OVERLAP_THRESHOLD = 0.6
 
     assistant_prompt = """
 Your name is Floyd and you are a helpful insurance customer assistant representing DNB bank ASA. Respond in the same language as the question. Be brief in your answers. If the user asks something unrelated to DNB insurance, say that you can't answer that.
@@ -92,145 +166,610 @@ History:
     Format:
     <<What is the cheapest alternative?>> <<What does it cover?>> <<How much does it cost?>>"""
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str, async_search_client: Optional[AsyncSearchClient] = None, answer_cache: Optional[AnswerCache] = None, semantic_cache: Optional[SemanticCache] = None, search_cache: Optional[SearchCache] = None, speculative_retrieval: bool = False, tokens_field: Optional[str] = None, executor: Optional[BoundedExecutor] = None, rate_limiter: Optional[RateLimiter] = None, resilience: Optional[ResilientCaller] = None, metrics: Optional[Metrics] = None):
         self.search_client = search_client
+        self.async_search_client = async_search_client
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
         self.chatgpt_deployment = chatgpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
-        self.executor = concurrent.futures.ThreadPoolExecutor()
+        self.tokens_field = tokens_field
+        self.executor = executor or BoundedExecutor()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.resilience = resilience or ResilientCaller(self.CHATGPT_MAX_RETRIES, self.CHATGPT_RETRY_WAIT, rate_limiter=self.rate_limiter)
+        self.metrics = metrics or Metrics()
+        self.speculative_retrieval = speculative_retrieval
+        self.speculation_stats = SpeculationStats()
+
+        # The static parts of the prompts are measured once, only the parts that vary are counted per request
+        self.tokens = TokenCounter()
+        self.assistant_prompt_tokens = self.tokens.count(self.assistant_prompt.format(follow_up_questions_prompt="", injected_prompt="", sources=""))
+        self.follow_up_questions_prompt_tokens = self.tokens.count(self.follow_up_questions_prompt_content)
+        self.query_prompt_tokens = self.tokens.messages_count(self.format_chat_messages(self.query_prompt.format(history=""), [], "", self.query_prompt_few_shots))
     
     def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
         start_time = time.time()
 
-        print("Starting answering process")
-        print(f"Max time limit for chatGPT has been set to {self.CHATGPT_TIMEOUT} seconds")
+        logger.debug("Starting answering process", extra={"timeout_seconds": self.CHATGPT_TIMEOUT})
 
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 6
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-    
-        print("Beginning step 1: Generate keyword search query")
+        cached = self.get_cached_answer(history, overrides)
+        if cached:
+            logger.info("Answered from cache", extra={"duration_ms": logs.elapsed_ms(start_time)})
+            return cached
 
-        filtered_history = self.clear_history(history)
-        
-        step_time = time.time()
-        search_query = self.generate_keyword_query(filtered_history, overrides, self.CHATGPT_TIMEOUT)
-        print(f"Finished step 1 in {time.time() - step_time} seconds")
+        if self.should_speculate(history, overrides):
+            r = self.run_speculative(history, overrides)
+            logger.info("Answering process completed", extra={"duration_ms": logs.elapsed_ms(start_time)})
+            return r
 
+        filtered_history, search_query = self.prepare_query(history, overrides)
         if search_query == None:
             return {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
 
-        print(f"Search query: {search_query}")
-      
-        print("Beginning step 2: Retrieve documents from search index")
+        cached, query_vector = self.get_similar_answer(search_query, filtered_history, overrides)
+        if cached:
+            logger.info("Answered from semantic cache", extra={"duration_ms": logs.elapsed_ms(start_time)})
+            return cached
 
-        step_time = time.time()
-        documents = self.retrieve_documents(search_query, top, filter, use_semantic_captions, overrides)
-        source_list = self.documents_to_sources(documents, use_semantic_captions)
-        sources = len(source_list) and "\n".join(source_list) or ""
+        documents, source_list, prompt = self.prepare_sources(search_query, filtered_history, overrides)
 
-        print(f"Finished step 2 in {time.time() - step_time} seconds")
-        print("Beginning step 3: Generate question answer")
+        logger.debug("Beginning step 3: Generate question answer")
 
         step_time = time.time()
-        prompt = self.format_assistant_prompt(sources, overrides)
         answer = self.generate_question_answer(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT)
-        if answer == None:
-            print("WARNING: Timeout before generating question answer")
+        timed_out = answer == None
+        if timed_out:
+            logger.warning("Timeout before generating question answer")
             answer = "Sorry, I can't answer the question."
             # answer = self.generate_question_answer(self.no_source, filtered_history[len(filtered_history)], overrides, self.CHATGPT_TIMEOUT)
          
             
 
-        print("Generated answer: ", answer)
+        logger.debug("Generated answer", extra={"answer": answer})
 
-        if not self.check_answer_sources(answer, documents, filtered_history):
-            print("WARNING: Generated question answer used sources incorrectly")
-            answer = "Sorry, I do not have information related to your question."
-            # prompt = self.no_source.format(question=filtered_history[-1])
-            # answer = self.generate_question_answer(prompt,[], overrides, self.CHATGPT_TIMEOUT)
+        r = self.build_response(answer, documents, source_list, search_query, prompt, filtered_history, overrides)
+        if not timed_out:
+            self.cache_answer(history, overrides, search_query, r, query_vector)
+
+        logger.debug("Finished step 3", extra={"duration_ms": logs.elapsed_ms(step_time), "history": filtered_history})
+        logger.info("Answering process completed", extra={"duration_ms": logs.elapsed_ms(start_time)})
+
+        return r
+
+    async def run_async(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        start_time = time.time()
+
+        logger.debug("Starting answering process")
+
+        cached = await self.get_cached_answer_async(history, overrides)
+        if cached:
+            return cached
+
+        if self.should_speculate(history, overrides):
+            return await self.run_speculative_async(history, overrides)
+
+        filtered_history, search_query = await self.prepare_query_async(history, overrides)
+        if search_query == None:
+            return {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
+
+        cached, query_vector = await self.get_similar_answer_async(search_query, filtered_history, overrides)
+        if cached:
+            return cached
+
+        documents, source_list, prompt = await self.prepare_sources_async(search_query, filtered_history, overrides)
+        answer = await self.generate_question_answer_async(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT)
+        timed_out = answer == None
+        if timed_out:
+            logger.warning("Timeout before generating question answer")
+            answer = "Sorry, I can't answer the question."
+
+        r = self.build_response(answer, documents, source_list, search_query, prompt, filtered_history, overrides)
+        if not timed_out:
+            await asyncio.to_thread(self.cache_answer, history, overrides, search_query, r, query_vector)
+
+        logger.info("Answering process completed", extra={"duration_ms": logs.elapsed_ms(start_time)})
+
+        return r
+
+    def run_stream(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        cached = self.get_cached_answer(history, overrides)
+        if cached:
+            yield from self.response_events(cached)
+            return
+
+        filtered_history, search_query = self.prepare_query(history, overrides)
+        if search_query == None:
+            yield from self.response_events({"data_points": [], "answer": "Could not generate query, please try again.", "thoughts": ""})
+            return
+
+        cached, query_vector = self.get_similar_answer(search_query, filtered_history, overrides)
+        if cached:
+            yield from self.response_events(cached)
+            return
+
+        documents, source_list, prompt = self.prepare_sources(search_query, filtered_history, overrides)
+        yield {"data_points": source_list}
+
+        messages = self.answer_messages(prompt, filtered_history)
+        answer = ""
+        finished = False
+        with self.metrics.stage(ANSWER_GENERATION):
+            for completion in self.executor.submit_stream(self.get_completion, messages, overrides, True).result() or []:
+                delta = self.completion_delta(completion)
+                if delta:
+                    answer += delta
+                    yield {"delta": delta}
+                finished = finished or self.stream_finished(completion)
+
+        # A failed or cut off answer is neither validated nor cached, the client gets an error instead
+        if not finished or not answer:
+            logger.warning("Answer stream failed", extra={"finished": finished, "answer_length": len(answer)})
+            yield self.answer_failed_event()
+            return
+
+        # The sources can only be validated on the completed answer, so the final event carries the answer the client should keep
+        r = self.build_response(answer, documents, source_list, search_query, prompt, filtered_history, overrides)
+        self.cache_answer(history, overrides, search_query, r, query_vector)
+        yield {"answer": r["answer"], "thoughts": r["thoughts"], "followup_questions": self.followup_questions(r["answer"])}
+
+    async def run_stream_async(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> AsyncIterator[dict[str, Any]]:
+        cached = await self.get_cached_answer_async(history, overrides)
+        if cached:
+            for event in self.response_events(cached):
+                yield event
+            return
+
+        filtered_history, search_query = await self.prepare_query_async(history, overrides)
+        if search_query == None:
+            for event in self.response_events({"data_points": [], "answer": "Could not generate query, please try again.", "thoughts": ""}):
+                yield event
+            return
+
+        cached, query_vector = await self.get_similar_answer_async(search_query, filtered_history, overrides)
+        if cached:
+            for event in self.response_events(cached):
+                yield event
+            return
+
+        documents, source_list, prompt = await self.prepare_sources_async(search_query, filtered_history, overrides)
+        yield {"data_points": source_list}
+
+        messages = self.answer_messages(prompt, filtered_history)
+        answer = ""
+        finished = False
+        with self.metrics.stage(ANSWER_GENERATION):
+            completions = await self.get_completion_async(messages, overrides, stream=True)
+            if completions is not None:
+                async for completion in completions:
+                    delta = self.completion_delta(completion)
+                    if delta:
+                        answer += delta
+                        yield {"delta": delta}
+                    finished = finished or self.stream_finished(completion)
+
+        if not finished or not answer:
+            logger.warning("Answer stream failed", extra={"finished": finished, "answer_length": len(answer)})
+            yield self.answer_failed_event()
+            return
+
+        r = self.build_response(answer, documents, source_list, search_query, prompt, filtered_history, overrides)
+        await asyncio.to_thread(self.cache_answer, history, overrides, search_query, r, query_vector)
+        yield {"answer": r["answer"], "thoughts": r["thoughts"], "followup_questions": self.followup_questions(r["answer"])}
+
+    # Speculative retrieval for first questions: the raw question is searched and an answer generated from those sources
+    # while the keyword query is still being generated. If the sources found for the keyword query overlap enough with
+    # the speculative ones, the speculative answer is used, otherwise it is discarded and the answer generated as usual.
+    def should_speculate(self, history, overrides):
+        enabled = overrides.get("speculative_retrieval")
+        if enabled is None:
+            enabled = self.speculative_retrieval
+        return bool(enabled) and len(self.clear_history(history)) == 1
+
+    def run_speculative(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        use_semantic_captions, top, filter = self.search_options(overrides)
+        filtered_history = self.clear_history(history)
+
+        with deadline.limited(self.CHATGPT_TIMEOUT):
+            query_future = self.executor.submit(self.metrics.timed, QUERY_GENERATION, self.get_completion, self.keyword_query_messages(filtered_history), overrides, False, QUERY)
+
+        question = filtered_history[-1][self.USER]
+        documents = self.retrieve_documents(question, top, filter, use_semantic_captions, overrides)
+        source_list = self.documents_to_sources(documents, use_semantic_captions, self.source_token_budget(filtered_history, overrides))
+        prompt = self.format_assistant_prompt("\n".join(source_list), overrides)
+
+        speculation = SpeculativeAnswer()
+        answer_future = self.executor.submit(self.metrics.timed, ANSWER_GENERATION, self.generate_speculative_answer, speculation, self.answer_messages(prompt, filtered_history), overrides)
+
+        try:
+            search_query = self.completion_content(query_future.result(timeout=deadline.remaining(self.CHATGPT_TIMEOUT)))
+        except concurrent.futures.TimeoutError:
+            search_query = None
+        if search_query == None:
+            self.discard_speculation(answer_future, speculation)
+            return {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
+
+        logger.debug("Generated search query", extra={"search_query": search_query})
+
+        cached, query_vector = self.get_similar_answer(search_query, filtered_history, overrides)
+        if cached:
+            self.discard_speculation(answer_future, speculation)
+            return cached
+
+        query_documents, query_source_list, query_prompt = self.prepare_sources(search_query, filtered_history, overrides)
+        overlap = self.source_overlap(source_list, query_source_list)
+        decided = time.time()
+
+        if overlap >= self.SPECULATION_OVERLAP_THRESHOLD:
+            try:
+                answer = answer_future.result(timeout=deadline.remaining(self.CHATGPT_TIMEOUT))
+            except concurrent.futures.TimeoutError:
+                speculation.stopped.set()
+                answer = None
+            saved = min(decided, speculation.finished or decided) - speculation.started
+            self.speculation_stats.record(True, saved)
+            logger.info("Used speculative answer", extra={"source_overlap": round(overlap, 2), "saved_ms": round(saved * 1000)})
+        else:
+            self.discard_speculation(answer_future, speculation)
+            logger.info("Discarded speculative answer", extra={"source_overlap": round(overlap, 2)})
+            documents, source_list, prompt = query_documents, query_source_list, query_prompt
+            answer = self.generate_question_answer(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT)
+
+        return self.finish_speculative(history, overrides, answer, documents, source_list, search_query, prompt, filtered_history, query_vector)
+
+    async def run_speculative_async(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        use_semantic_captions, top, filter = self.search_options(overrides)
+        filtered_history = self.clear_history(history)
+
+        query_task = asyncio.create_task(self.metrics.timed_async(QUERY_GENERATION, self.get_completion_async, self.keyword_query_messages(filtered_history), overrides, priority=QUERY))
+
+        question = filtered_history[-1][self.USER]
+        documents = await self.retrieve_documents_async(question, top, filter, use_semantic_captions, overrides)
+        source_list = self.documents_to_sources(documents, use_semantic_captions, self.source_token_budget(filtered_history, overrides))
+        prompt = self.format_assistant_prompt("\n".join(source_list), overrides)
+
+        speculation = SpeculativeAnswer()
+        answer_task = asyncio.create_task(self.metrics.timed_async(ANSWER_GENERATION, self.generate_speculative_answer_async, speculation, self.answer_messages(prompt, filtered_history), overrides))
+
+        try:
+            search_query = self.completion_content(await asyncio.wait_for(query_task, deadline.remaining(self.CHATGPT_TIMEOUT)))
+        except asyncio.TimeoutError:
+            search_query = None
+        if search_query == None:
+            self.discard_speculation(answer_task, speculation)
+            return {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
+
+        cached, query_vector = await self.get_similar_answer_async(search_query, filtered_history, overrides)
+        if cached:
+            self.discard_speculation(answer_task, speculation)
+            return cached
+
+        query_documents, query_source_list, query_prompt = await self.prepare_sources_async(search_query, filtered_history, overrides)
+        overlap = self.source_overlap(source_list, query_source_list)
+        decided = time.time()
+
+        if overlap >= self.SPECULATION_OVERLAP_THRESHOLD:
+            try:
+                answer = await asyncio.wait_for(answer_task, deadline.remaining(self.CHATGPT_TIMEOUT))
+            except asyncio.TimeoutError:
+                answer = None
+            saved = min(decided, speculation.finished or decided) - speculation.started
+            self.speculation_stats.record(True, saved)
+        else:
+            self.discard_speculation(answer_task, speculation)
+            documents, source_list, prompt = query_documents, query_source_list, query_prompt
+            answer = await self.generate_question_answer_async(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT)
+
+        return await asyncio.to_thread(self.finish_speculative, history, overrides, answer, documents, source_list, search_query, prompt, filtered_history, query_vector)
+
+    # Returns the answer, or None when the call failed, its stream was cut off or the speculation was stopped
+    def generate_speculative_answer(self, speculation, messages, overrides):
+        if speculation.stopped.is_set():
+            return None
+        speculation.tokens = estimate_request_tokens([message["content"] for message in messages], None)
+        chunks = self.get_completion(messages, overrides, True)
+        if chunks is None:
+            return None
+        answer, finished = "", False
+        try:
+            for chunk in chunks:
+                speculation.tokens += 1
+                if speculation.stopped.is_set():
+                    return None
+                answer += self.completion_delta(chunk) or ""
+                finished = finished or self.stream_finished(chunk)
+        finally:
+            chunks.close()
+            speculation.finished = time.time()
+        return answer if finished and answer else None
+
+    async def generate_speculative_answer_async(self, speculation, messages, overrides):
+        speculation.tokens = estimate_request_tokens([message["content"] for message in messages], None)
+        chunks = await self.get_completion_async(messages, overrides, stream=True)
+        if chunks is None:
+            return None
+        answer, finished = "", False
+        try:
+            async for chunk in chunks:
+                speculation.tokens += 1
+                answer += self.completion_delta(chunk) or ""
+                finished = finished or self.stream_finished(chunk)
+        finally:
+            await chunks.aclose()
+            speculation.finished = time.time()
+        return answer if finished and answer else None
+
+    # A speculative answer that is still queued is cancelled, a running one stops at its next chunk, and an async one is
+    # cancelled right away. The tokens it used by then are counted as wasted
+    def discard_speculation(self, future, speculation):
+        speculation.stopped.set()
+        future.cancel()
+        self.speculation_stats.record(False, 0)
+        future.add_done_callback(lambda f: self.speculation_stats.record_waste(speculation.tokens))
+
+    def finish_speculative(self, history, overrides, answer, documents, source_list, search_query, prompt, filtered_history, query_vector=None):
+        timed_out = answer == None
+        if timed_out:
+            logger.warning("Timeout before generating question answer")
+            answer = "Sorry, I can't answer the question."
+
+        r = self.build_response(answer, documents, source_list, search_query, prompt, filtered_history, overrides)
+        if not timed_out:
+            self.cache_answer(history, overrides, search_query, r, query_vector)
+        return r
+
+    def source_overlap(self, sources, other_sources):
+        sources, other_sources = set(sources), set(other_sources)
+        if not sources and not other_sources:
+            return 1.0
+        return len(sources & other_sources) / len(sources | other_sources)
+
+    def response_events(self, r: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        yield {"data_points": r.get("data_points") or []}
+        if not r.get("answer"):
+            yield self.answer_failed_event()
+            return
+        yield {"delta": r.get("answer")}
+        yield {"answer": r.get("answer"), "thoughts": r.get("thoughts"), "followup_questions": self.followup_questions(r.get("answer") or "")}
+
+    def get_cached_answer(self, history, overrides):
+        if self.answer_cache is None:
+            return None
+        return self.answer_cache.get(self.clear_history(history), overrides)
+
+    # The key includes the index version, which is read from blob storage when it is due, and the disk tier reads files,
+    # so the lookup runs in a worker thread
+    async def get_cached_answer_async(self, history, overrides):
+        if self.answer_cache is None:
+            return None
+        return await asyncio.to_thread(self.get_cached_answer, history, overrides)
+
+    # Returns the cached answer or None, and the embedding of the search query, which cache_answer stores the answer under
+    # after a miss. The cache is an optimization, so when the embeddings deployment fails the question is answered as a
+    # miss and its answer isn't added to the semantic cache
+    def get_similar_answer(self, search_query, filtered_history, overrides):
+        # Only first questions are answered from the semantic cache, later answers also depend on the conversation so far
+        if self.semantic_cache is None or len(filtered_history) > 1:
+            return None, None
+        try:
+            query_vector = self.semantic_cache.embed(search_query)
+        except Exception as e:
+            logger.warning("Semantic cache lookup failed, answering without it", extra={"error": str(e)})
+            return None, None
+        cached = self.semantic_cache.get(search_query, self.semantic_cache_context(filtered_history, overrides), query_vector)
+        if cached is None:
+            return None, query_vector
+        similarity, r = cached
+        logger.info("Found similar cached answer", extra={"similarity": round(similarity, 3)})
+        return {**r, "thoughts": f"Answered from cache, searched for:<br>{search_query}<br>Similarity to cached search: {similarity:.3f}<br><br>" + r["thoughts"]}, query_vector
+
+    async def get_similar_answer_async(self, search_query, filtered_history, overrides):
+        if self.semantic_cache is None or len(filtered_history) > 1:
+            return None, None
+        return await asyncio.to_thread(self.get_similar_answer, search_query, filtered_history, overrides)
+
+    # query_vector is the embedding get_similar_answer returned, without it the answer isn't added to the semantic cache
+    def cache_answer(self, history, overrides, search_query, r, query_vector=None):
+        if not self.cacheable(r):
+            logger.debug("Answer not cached, it cites no sources")
+            return
+        if self.answer_cache is not None:
+            self.answer_cache.set(self.clear_history(history), overrides, r)
+        if self.semantic_cache is not None and query_vector is not None and len(self.clear_history(history)) == 1:
+            self.semantic_cache.set(search_query, self.semantic_cache_context(self.clear_history(history), overrides), r, query_vector)
+
+    # The keyword query is always English, while the answer is in the language of the question, so the language is
+    # part of the context cached answers must match
+    def semantic_cache_context(self, history, overrides):
+        return {**answer_overrides(overrides), "language": question_language(history[-1].get(self.USER, ""))}
+
+    # Answers are only cached when they cite a source. Refusals, "I don't know" answers, the fallbacks for invalid
+    # sources and clarifying questions cite none, and would otherwise be replayed to everyone asking until they expire
+    def cacheable(self, r):
+        return bool(re.search(self.SOURCE_REFERENCE, r.get("answer") or ""))
+
+    def prepare_query(self, history, overrides):
+        logger.debug("Beginning step 1: Generate keyword search query")
+
+        filtered_history = self.clear_history(history)
         
+        step_time = time.time()
+        search_query = self.generate_keyword_query(filtered_history, overrides, self.CHATGPT_TIMEOUT)
+        logger.debug("Finished step 1", extra={"duration_ms": logs.elapsed_ms(step_time)})
+
+        if search_query != None:
+            logger.debug("Generated search query", extra={"search_query": search_query})
+
+        return filtered_history, search_query
+
+    async def prepare_query_async(self, history, overrides):
+        filtered_history = self.clear_history(history)
+        search_query = await self.generate_keyword_query_async(filtered_history, overrides, self.CHATGPT_TIMEOUT)
+        if search_query != None:
+            logger.debug("Generated search query", extra={"search_query": search_query})
+
+        return filtered_history, search_query
+
+    def prepare_sources(self, search_query, filtered_history, overrides):
+        use_semantic_captions, top, filter = self.search_options(overrides)
+
+        logger.debug("Beginning step 2: Retrieve documents from search index")
 
-        print(filtered_history)
+        step_time = time.time()
+        documents = self.retrieve_documents(search_query, top, filter, use_semantic_captions, overrides)
+        source_list = self.documents_to_sources(documents, use_semantic_captions, self.source_token_budget(filtered_history, overrides))
+        sources = len(source_list) and "\n".join(source_list) or ""
+        prompt = self.format_assistant_prompt(sources, overrides)
+
+        logger.debug("Finished step 2", extra={"duration_ms": logs.elapsed_ms(step_time), "sources": len(source_list)})
+
+        return documents, source_list, prompt
+
+    async def prepare_sources_async(self, search_query, filtered_history, overrides):
+        use_semantic_captions, top, filter = self.search_options(overrides)
+        documents = await self.retrieve_documents_async(search_query, top, filter, use_semantic_captions, overrides)
+        source_list = self.documents_to_sources(documents, use_semantic_captions, self.source_token_budget(filtered_history, overrides))
+        sources = len(source_list) and "\n".join(source_list) or ""
+        prompt = self.format_assistant_prompt(sources, overrides)
+
+        return documents, source_list, prompt
 
-        print(f"Finished step 3 in {time.time() - step_time} seconds")
-        print(f"Answering process completed in {time.time() - start_time} seconds")
+    def build_response(self, answer, documents, source_list, search_query, prompt, history, overrides):
+        if not self.check_answer_sources(answer, documents, history):
+            logger.warning("Generated question answer used sources incorrectly")
+            answer = "Sorry, I do not have information related to your question."
+            # prompt = self.no_source.format(question=history[-1])
+            # answer = self.generate_question_answer(prompt,[], overrides, self.CHATGPT_TIMEOUT)
 
         thoughts = f"Searched for:<br>{search_query}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')
         if overrides.get("suggest_followup_questions"):
             answer = self.remove_wrong_questions_format(answer, "Next Questions: ")
 
-        
         return {"data_points": source_list, "answer": answer, "thoughts": thoughts}
 
-    def generate_keyword_query(self, history, overrides, timeout):
+    def search_options(self, overrides):
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        top = overrides.get("top") or 6
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+        return use_semantic_captions, top, filter
+
+    def keyword_query_messages(self, history):
         user_question = f"Generate search query for: {history[-1][self.USER]}"
-        prompt = self.query_prompt.format(history=self.history_as_text(history[:-1]))
-        messages = self.format_chat_messages(system_prompt=prompt, history=[], user_question=user_question, few_shot=self.query_prompt_few_shots)
-        future = self.executor.submit(self.get_completion, messages, overrides)
+
+        # Leave out the oldest turns of long conversations so the query prompt fits in the context window
+        earlier_history = history[:-1]
+        max_history_tokens = self.PROMPT_MAX_TOKENS - self.query_prompt_tokens - self.tokens.count(user_question)
+        while earlier_history and self.tokens.count(self.history_as_text(earlier_history)) > max_history_tokens:
+            earlier_history = earlier_history[1:]
+
+        prompt = self.query_prompt.format(history=self.history_as_text(earlier_history))
+        return self.format_chat_messages(system_prompt=prompt, history=[], user_question=user_question, few_shot=self.query_prompt_few_shots)
+
+    # A thread can't be stopped once the call has started, so the call gets the same time limit as the wait for it, and
+    # its HTTP request gives up when the wait does. Cancelling the future only drops the call while it is queued
+    def generate_keyword_query(self, history, overrides, timeout):
+        messages = self.keyword_query_messages(history)
+        with deadline.limited(timeout):
+            future = self.executor.submit(self.metrics.timed, QUERY_GENERATION, self.get_completion, messages, overrides, False, QUERY)
         try:
-            completion = future.result(timeout=timeout)
+            completion = future.result(timeout=deadline.remaining(timeout))
             return completion.choices[0].message.content
         except concurrent.futures.TimeoutError:
+            future.cancel()
+            return None
+
+    async def generate_keyword_query_async(self, history, overrides, timeout):
+        messages = self.keyword_query_messages(history)
+        try:
+            completion = await asyncio.wait_for(self.metrics.timed_async(QUERY_GENERATION, self.get_completion_async, messages, overrides, priority=QUERY), deadline.remaining(timeout))
+            return completion.choices[0].message.content
+        except asyncio.TimeoutError:
             return None
 
+    # top is not passed on to the search, the number of sources is limited by MAXIMUM_SOURCE_TOKENS instead
     def retrieve_documents(self, query, top, filter, use_semantic_captions, overrides):
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(query, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        
-        else:
-            r = self.search_client.search(query, filter=filter)
+        return self.filter_documents(self.search_documents(query, filter, None, overrides))
+
+    async def retrieve_documents_async(self, query, top, filter, use_semantic_captions, overrides):
+        return self.filter_documents(await self.search_documents_async(query, filter, None, overrides))
 
+    def filter_documents(self, r):
         documents = []
         for doc in r:
             score = doc["@search.score"]
-            if score < self.DOCUMENT_SCORE_CUTOFF:
-                print(f"Removed doc {doc[self.sourcepage_field]} with score {score}")
-            else:
-                print(f"Kept doc {doc[self.sourcepage_field]} with score {score}")
+            if score >= self.DOCUMENT_SCORE_CUTOFF:
                 documents.append(doc)
+        if logs.sampled():
+            logger.debug("Filtered documents by score", extra={"cutoff": self.DOCUMENT_SCORE_CUTOFF, "scores": {doc[self.sourcepage_field]: doc["@search.score"] for doc in r}, "kept": len(documents)})
 
         documents.sort(reverse=True, key=lambda doc: doc["@search.score"])
         return documents
 
-    def documents_to_sources(self, documents, use_semantic_captions):
+    def documents_to_sources(self, documents, use_semantic_captions, max_tokens):
+        with self.metrics.stage(SOURCE_PACKING):
+            return self.pack_sources(documents, use_semantic_captions, max_tokens)
+
+    def pack_sources(self, documents, use_semantic_captions, max_tokens):
         token_count = 0
         results = []
-        for doc in documents:
-            if use_semantic_captions:
-                source = f"###{doc['sourcefile']}### {nonewlines(' . '.join([c.text for c in doc['@search.captions']]))}"
-            else:
-                source = f"###{doc['sourcefile']}### {nonewlines(doc[self.content_field])}"
-
-            token_count += self.token_count(source)
-            if token_count > self.MAXIMUM_SOURCE_TOKENS:
-                print("Reached maximum token count for sources")
-                break
-
-            results.append(source)
+        for i in range(0, len(documents), self.SOURCE_BATCH_SIZE):
+            batch = documents[i:i + self.SOURCE_BATCH_SIZE]
+            sources = [self.document_to_source(doc, use_semantic_captions) for doc in batch]
+            for source, source_tokens in zip(sources, self.source_token_counts(batch, sources, use_semantic_captions)):
+                token_count += source_tokens + 1  # Sources are separated by newlines
+                if token_count > max_tokens:
+                    logger.debug("Reached maximum token count for sources", extra={"sources": len(results)})
+                    return results
+
+                results.append(source)
             
         return results
 
+    # Uses the token counts stored in the index, only captions and documents indexed without a count are encoded
+    def source_token_counts(self, documents, sources, use_semantic_captions):
+        counts = [None if use_semantic_captions else self.document_tokens(doc, f"###{doc['sourcefile']}### ") for doc in documents]
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            for i, count in zip(missing, self.tokens.count_batch([sources[i] for i in missing])):
+                counts[i] = count
+        return counts
+
+    def document_to_source(self, doc, use_semantic_captions):
+        if use_semantic_captions:
+            return f"###{doc['sourcefile']}### {nonewlines(' . '.join([c.text for c in doc['@search.captions']]))}"
+        return f"###{doc['sourcefile']}### {nonewlines(doc[self.content_field])}"
+
+    # Tokens left for the sources once the rest of the answer prompt and the history are counted, at most MAXIMUM_SOURCE_TOKENS
+    def source_token_budget(self, history, overrides):
+        prompt_override = overrides.get("prompt_template")
+        if prompt_override is None:
+            prompt_tokens = self.assistant_prompt_tokens
+        elif prompt_override.startswith(">>>"):
+            prompt_tokens = self.assistant_prompt_tokens + self.tokens.count(prompt_override[3:] + "\n")
+        else:
+            prompt_tokens = self.tokens.count(prompt_override.format(follow_up_questions_prompt="", sources=""))
+        if overrides.get("suggest_followup_questions"):
+            prompt_tokens += self.follow_up_questions_prompt_tokens
+
+        history_tokens = self.tokens.messages_count(self.answer_messages("", history))
+        return max(min(self.MAXIMUM_SOURCE_TOKENS, self.PROMPT_MAX_TOKENS - prompt_tokens - history_tokens), 0)
+
     def check_answer_sources(self, answer, documents, history):
-        source_regex = r"\[([^]]+)\]"
-        answer_sources = re.findall(source_regex, answer)
+        with self.metrics.stage(SOURCE_VALIDATION):
+            return self.answer_sources_valid(answer, documents, history)
+
+    def answer_sources_valid(self, answer, documents, history):
+        answer_sources = re.findall(self.SOURCE_REFERENCE, answer)
         search_documents = [doc["sourcefile"] for doc in documents]
-        history_documents = [src for msg in history if self.ASSISTANT in msg for src in re.findall(source_regex, msg[self.ASSISTANT])]
+        history_documents = [src for msg in history if self.ASSISTANT in msg for src in re.findall(self.SOURCE_REFERENCE, msg[self.ASSISTANT])]
 
-        print("Answer sources: ", answer_sources)
-        print("Documents from search: ", search_documents)
-        print("Documents from history: ", history_documents)
+        logger.debug("Checking answer sources", extra={"answer_sources": answer_sources, "search_documents": search_documents, "history_documents": history_documents})
 
         for source in answer_sources:
             if source not in search_documents and source not in history_documents:
-                print(f"Tried to use incorrect source {source} in answer")
+                logger.warning("Tried to use incorrect source in answer", extra={"source": source})
                 return False
 
         return True
@@ -249,45 +788,101 @@ History:
 
         return prompt
 
+    def answer_messages(self, prompt, history):
+        return self.format_chat_messages(system_prompt=prompt, history=history, user_question=history[-1][self.USER])
+
+    # Limited like generate_keyword_query
     def generate_question_answer(self, prompt, history, overrides, timeout):
-        messages = self.format_chat_messages(system_prompt=prompt, history=history, user_question=history[-1][self.USER])
-        future = self.executor.submit(self.get_completion, messages, overrides)
+        messages = self.answer_messages(prompt, history)
+        with deadline.limited(timeout):
+            future = self.executor.submit(self.metrics.timed, ANSWER_GENERATION, self.get_completion, messages, overrides)
         try:
-            completion = future.result(timeout=timeout)
+            completion = future.result(timeout=deadline.remaining(timeout))
             if completion:
                 return completion.choices[0].message.content
             return None
         except concurrent.futures.TimeoutError:
+            future.cancel()
             return None
-    
-    def get_completion(self, messages, overrides):
-        retries = 0
-        while retries <= self.CHATGPT_MAX_RETRIES:
-            if retries > 0:
-                print(f"Completion failed. Retry number {retries}")
 
-                # Wait a bit before retrying
-                time.sleep(self.CHATGPT_RETRY_WAIT)
-
-            try:
-                completion = openai.ChatCompletion.create(
-                engine=self.chatgpt_deployment,
-                messages=messages,
-                temperature=overrides.get("temperature") or 0,
-                max_tokens=self.CHATGPT_MAXIMUM_ANSWER_LENGTH,
-                n=1,
-                )
-
-                return completion
-            except openai.error.Timeout as e:
-                print(f"OpenAI API request timed out: {e}")
-            except openai.error.APIError as e:
-                print(f"OpenAI API returned an API Error: {e}")
+    async def generate_question_answer_async(self, prompt, history, overrides, timeout):
+        messages = self.answer_messages(prompt, history)
+        try:
+            completion = await asyncio.wait_for(self.metrics.timed_async(ANSWER_GENERATION, self.get_completion_async, messages, overrides), deadline.remaining(timeout))
+            if completion:
+                return completion.choices[0].message.content
+            return None
+        except asyncio.TimeoutError:
+            return None
+    
+    # Retries, hedging and the rate limiter are handled by the shared resilience layer, streamed completions are retried
+    # but never hedged. Returns None if the call still fails after the last retry. The time left before the request
+    # deadline is passed on as the HTTP timeout of every attempt, so an abandoned call doesn't keep a pool worker and
+    # quota busy
+    def get_completion(self, messages, overrides, stream=False, priority=ANSWER):
+        try:
+            return self.resilience.call(self.completion_operation(priority), self.create_completion, messages, overrides, stream, priority, hedge=not stream, quota=(self.estimate_tokens(messages), priority))
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            logger.warning("Completion failed after retries", extra={"error": str(e)})
+            return None
 
-            retries += 1
+    async def get_completion_async(self, messages, overrides, stream=False, priority=ANSWER):
+        try:
+            return await self.resilience.call_async(self.completion_operation(priority), self.create_completion_async, messages, overrides, stream, priority, hedge=not stream, quota=(self.estimate_tokens(messages), priority))
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            logger.warning("Completion failed after retries", extra={"error": str(e)})
+            return None
 
-        return None
+    def create_completion(self, messages, overrides, stream, priority):
+        usage.check_budget(self.estimate_tokens(messages))
+        completion = openai.ChatCompletion.create(
+            engine=self.chatgpt_deployment,
+            messages=messages,
+            temperature=overrides.get("temperature") or 0,
+            max_tokens=self.CHATGPT_MAXIMUM_ANSWER_LENGTH,
+            n=1,
+            stream=stream,
+            request_timeout=deadline.remaining(self.CHATGPT_TIMEOUT),
+        )
+        return self.completion_usage(self.chatgpt_deployment, completion, stream, [message["content"] for message in messages])
+
+    async def create_completion_async(self, messages, overrides, stream, priority):
+        usage.check_budget(self.estimate_tokens(messages))
+        # A stream keeps its worker until it is read to the end or closed
+        run = self.executor.run_stream_async if stream else self.executor.run_async
+        completion = await run(openai.ChatCompletion.acreate,
+            engine=self.chatgpt_deployment,
+            messages=messages,
+            temperature=overrides.get("temperature") or 0,
+            max_tokens=self.CHATGPT_MAXIMUM_ANSWER_LENGTH,
+            n=1,
+            stream=stream,
+            request_timeout=deadline.remaining(self.CHATGPT_TIMEOUT),
+        )
+        return self.completion_usage_async(self.chatgpt_deployment, completion, stream, [message["content"] for message in messages])
+
+    # Query rewrites and answers have different latencies, so they are tracked separately for hedging
+    def completion_operation(self, priority):
+        return "chat_answer" if priority == ANSWER else "chat_query"
+
+    def estimate_tokens(self, messages):
+        return estimate_request_tokens([message["content"] for message in messages], self.CHATGPT_MAXIMUM_ANSWER_LENGTH)
+
+    def completion_content(self, completion):
+        return completion.choices[0].message.content if completion else None
+
+    def completion_delta(self, completion):
+        # Azure OpenAI can send chunks without choices, e.g. with content filter results
+        if not completion.choices:
+            return None
+        return completion.choices[0].delta.get("content")
 
+    def followup_questions(self, answer):
+        return re.findall(r"<<([^>]+)>>", answer)
 
     def format_chat_messages(self, system_prompt: str, history: Sequence[dict[str, str]], user_question: str, few_shot: Sequence[dict[str, str]] = []):
         messages = [{"role": self.SYSTEM, "content": system_prompt}]
@@ -322,19 +917,14 @@ History:
         return filtered_history
     
     def remove_wrong_questions_format(self, answer, substring):
-        print("Checking for wrong format in suggested answers...")
         new_answer = answer.replace(substring, "")
         if  (new_answer != answer):
-            print(f"Removed {substring} from answer")
+            logger.debug("Removed wrong format from suggested answers", extra={"removed": substring})
         return new_answer
 
 
     def message_token_count(self, message):
-        num_tokens = 2  # For "role" and "content" keys
-        for _, value in message.items():
-            num_tokens += self.token_count(value)
-        return num_tokens
+        return self.tokens.message_count(message)
 
     def token_count(self, text):
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        return len(encoding.encode(text))
+        return self.tokens.count(text)
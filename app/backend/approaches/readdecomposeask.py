@@ -1,20 +1,31 @@
+import logging
 import openai
 import re
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
+from cache import SearchCache
+from pool import BoundedExecutor
+from ratelimit import RateLimiter
+from metrics import ANSWER_GENERATION, Metrics
+from resilience import ResilientCaller
 from langchain.prompts import PromptTemplate, BasePromptTemplate
 from langchain.callbacks.manager import CallbackManager
 from langchain.agents import Tool, AgentExecutor
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import DeadlineAzureOpenAI, HtmlCallbackHandler, LoggingCallbackHandler, RateLimitCallbackHandler
 from text import nonewlines
 from typing import Any, List, Optional
 
+logger = logging.getLogger(__name__)
+
 class ReadDecomposeAsk(Approach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str, search_cache: Optional[SearchCache] = None, executor: Optional[BoundedExecutor] = None, rate_limiter: Optional[RateLimiter] = None, resilience: Optional[ResilientCaller] = None, metrics: Optional[Metrics] = None):
         self.search_client = search_client
+        self.search_cache = search_cache
+        self.executor = executor or BoundedExecutor()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.resilience = resilience or ResilientCaller(rate_limiter=self.rate_limiter)
+        self.metrics = metrics or Metrics()
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
@@ -25,26 +36,8 @@ class ReadDecomposeAsk(Approach):
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None) 
-            for dc in r: 
-                if dc["@search.score"] >= 1:
-                    print("score",dc["@search.score"])
-
-
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-            print("here")
-            for dc in r: 
-                if dc["@search.score"] >= 1:
-                    print("score",dc["@search.score"])
+        r = self.search_documents(q, filter, top, overrides)
+        logger.debug("Searched documents", extra={"scores": [dc["@search.score"] for dc in r if dc["@search.score"] >= 1]})
 
          
         if use_semantic_captions:
@@ -56,17 +49,13 @@ class ReadDecomposeAsk(Approach):
             return "\n".join(self.results)
         return None
     
+    # Semantic search with an extractive answer, with the options and deadline of the other searches
     def lookup(self, q: str) -> Optional[str]:
         self.search_client.suggest()
         r = self.search_client.search(q,
-                                      top = 1,
                                       include_total_count=True,
-                                      query_type=QueryType.SEMANTIC, 
-                                      query_language="en-us", 
-                                      query_speller="lexicon", 
-                                      semantic_configuration_name="default",
                                       query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
+                                      **self.search_arguments(None, 1, {"semantic_ranker": True, "semantic_captions": True}))
         
         answers = r.get_answers()
         if answers and len(answers) > 0:
@@ -81,9 +70,11 @@ class ReadDecomposeAsk(Approach):
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        # Logs the prompts, actions and observations of the agent for sampled requests
+        log_handler = LoggingCallbackHandler()
+        cb_manager = CallbackManager(handlers=[cb_handler, log_handler])
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        llm = DeadlineAzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key, callbacks=[RateLimitCallbackHandler(self.rate_limiter, deployment=self.openai_deployment), log_handler])
         tools = [
             Tool(name="Search", func=lambda q: self.search(q, overrides), description="useful for when you need to ask with search", callbacks=cb_manager),
             Tool(name="Lookup", func=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
@@ -96,8 +87,9 @@ class ReadDecomposeAsk(Approach):
             EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
 
         agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        chain = AgentExecutor.from_agent_and_tools(agent, tools, callback_manager=cb_manager)
+        # The searches made by the agent are also recorded as their own stage
+        result = self.executor.submit(self.metrics.timed, ANSWER_GENERATION, chain.run, q).result()
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
         # generalizing too much and disrupt HTML snippets if present
@@ -1,14 +1,20 @@
+import logging
 import openai
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
+from cache import SearchCache
+from pool import BoundedExecutor
+from ratelimit import RateLimiter
+from metrics import ANSWER_GENERATION, Metrics
+from resilience import ResilientCaller
 from langchain.callbacks.manager import CallbackManager, Callbacks
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchainadapters import HtmlCallbackHandler
+from langchainadapters import DeadlineAzureOpenAI, HtmlCallbackHandler, LoggingCallbackHandler, RateLimitCallbackHandler
 from text import nonewlines
-from typing import Any
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
 
 class ReadRetrieveReadApproach(Approach):
     """
@@ -54,8 +60,13 @@ Final Answer: Based on my observations, I now know the final answer to the origi
 
     CognitiveSearchToolDescription = "Useful for searching for public information about DNB insurance car insurance, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str, search_cache: Optional[SearchCache] = None, executor: Optional[BoundedExecutor] = None, rate_limiter: Optional[RateLimiter] = None, resilience: Optional[ResilientCaller] = None, metrics: Optional[Metrics] = None):
         self.search_client = search_client
+        self.search_cache = search_cache
+        self.executor = executor or BoundedExecutor()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.resilience = resilience or ResilientCaller(rate_limiter=self.rate_limiter)
+        self.metrics = metrics or Metrics()
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
@@ -66,17 +77,7 @@ Final Answer: Based on my observations, I now know the final answer to the origi
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+        r = self.search_documents(q, filter, top, overrides)
         if use_semantic_captions:
             self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
@@ -84,7 +85,7 @@ Final Answer: Based on my observations, I now know the final answer to the origi
         content = "\n".join(self.results)
         return content
         
-    def run(self, q: str, overrides: dict[str, Any], ask_user: str) -> Any:
+    def run(self, q: str, overrides: dict[str, Any], ask_user: Optional[str] = None) -> Any:
         
         if bool(ask_user):
             return ask_user
@@ -93,7 +94,9 @@ Final Answer: Based on my observations, I now know the final answer to the origi
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        # Logs the prompts, actions and observations of the agent for sampled requests
+        log_handler = LoggingCallbackHandler()
+        cb_manager = CallbackManager(handlers=[cb_handler, log_handler])
         
         acs_tool = Tool(name="CognitiveSearch", 
                         func=lambda q: self.retrieve(q, overrides), 
@@ -107,15 +110,15 @@ Final Answer: Based on my observations, I now know the final answer to the origi
             prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
             suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
             input_variables = ["input", "agent_scratchpad"])
-        print(prompt)
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0, openai_api_key=openai.api_key)
+        logger.debug("Created agent prompt", extra={"prompt": prompt.template})
+        llm = DeadlineAzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0, openai_api_key=openai.api_key, callbacks=[RateLimitCallbackHandler(self.rate_limiter, deployment=self.openai_deployment), log_handler])
         chain = LLMChain(llm = llm, prompt = prompt)
         agent_exec = AgentExecutor.from_agent_and_tools(
             agent = ZeroShotAgent(llm_chain = chain, tools = tools),
             tools = tools, 
-            verbose = True, 
             callback_manager = cb_manager)
-        result = agent_exec.run(q)
+        # The searches made by the agent are also recorded as their own stage
+        result = self.executor.submit(self.metrics.timed, ANSWER_GENERATION, agent_exec.run, q).result()
                 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "")
@@ -1,10 +1,22 @@
+import asyncio
+import logging
 import openai
+import deadline
+import usage
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from cache import SearchCache
+from pool import BoundedExecutor
+from ratelimit import ANSWER, RateLimiter, estimate_request_tokens
+from metrics import ANSWER_GENERATION, SOURCE_PACKING, Metrics
+from resilience import ResilientCaller
 from text import nonewlines
-from typing import Any
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from tokens import TokenCounter
+from typing import Any, AsyncIterator, Iterator, Optional
+from concurrent.futures import TimeoutError
+
+logger = logging.getLogger(__name__)
 
 
 class RetrieveThenReadApproach(Approach):
@@ -48,69 +60,206 @@ Sources:
 Answer:
 """
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    #Setting max time limit for OpenAI search
+    OPENAI_TIMEOUT = 4
+    MAX_TOKENS = 1024
+
+    # Leaves room for the template and the answer in the context window of the completion model
+    MAXIMUM_SOURCE_TOKENS = 2000
+
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str, async_search_client: Optional[AsyncSearchClient] = None, search_cache: Optional[SearchCache] = None, tokens_field: Optional[str] = None, executor: Optional[BoundedExecutor] = None, rate_limiter: Optional[RateLimiter] = None, resilience: Optional[ResilientCaller] = None, metrics: Optional[Metrics] = None):
         self.search_client = search_client
+        self.async_search_client = async_search_client
+        self.search_cache = search_cache
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.tokens_field = tokens_field
+        self.executor = executor or BoundedExecutor()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.resilience = resilience or ResilientCaller(rate_limiter=self.rate_limiter)
+        self.metrics = metrics or Metrics()
+        # Counts the sources the way prepdocs.py counted the ones stored in the index
+        self.tokens = TokenCounter()
 
 
 
     def run(self, q: str, overrides: dict[str, Any]) -> Any:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+        results = self.format_results(self.search(q, overrides), use_semantic_captions)
         content = "\n".join(results)
 
         prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
 
         
-        #Setting max time limit for OpenAI search
-        max_time_limit = 4
+        #Setting max time limit for OpenAI search, at most the time left before the request deadline
+        max_time_limit = deadline.remaining(self.OPENAI_TIMEOUT)
 
 
-        #Start the threading, if the get_completion method takes to long(max_time_limit) the TimeoutError is triggered.
+        #Run the completion in the shared pool, if the get_completion method takes to long(max_time_limit) the TimeoutError is triggered.
+        #The call runs with the same limit, so its HTTP request is abandoned at the same time instead of running on in the pool
+        with deadline.limited(max_time_limit):
+            future = self.executor.submit(self.metrics.timed, ANSWER_GENERATION, self.get_completion, prompt, overrides)
         try:
-            with ThreadPoolExecutor() as executor:
-                future = executor.submit(self.get_completion, prompt, overrides)
-                completion = future.result(timeout=max_time_limit)
+            completion = future.result(timeout=max_time_limit)
         
         except TimeoutError:
+            future.cancel()
             #Custom response for when it takes to long
             return {"data_points": results, "answer": "Request took too long to generate, pleasre try again:=)", "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
         
         #Regular response for when timeouts doesnt happen.
         return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
 
+    async def run_async(self, q: str, overrides: dict[str, Any]) -> Any:
+        if self.async_search_client is None:
+            return await super().run_async(q, overrides)
+
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        results = self.format_results(await self.search_async(q, overrides), use_semantic_captions)
+        content = "\n".join(results)
+
+        prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
+
+        try:
+            completion = await asyncio.wait_for(self.executor.run_async(self.metrics.timed_async, ANSWER_GENERATION, self.get_completion_async, prompt, overrides), deadline.remaining(self.OPENAI_TIMEOUT))
+        except asyncio.TimeoutError:
+            return {"data_points": results, "answer": "Request took too long to generate, pleasre try again:=)", "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+
+    def run_stream(self, q: str, overrides: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        results = self.format_results(self.search(q, overrides), use_semantic_captions)
+        yield {"data_points": results}
+
+        prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved="\n".join(results))
+        answer = ""
+        finished = False
+        with self.metrics.stage(ANSWER_GENERATION):
+            for completion in self.executor.submit_stream(self.get_completion, prompt, overrides, True).result():
+                if completion.choices and completion.choices[0].text:
+                    answer += completion.choices[0].text
+                    yield {"delta": completion.choices[0].text}
+                finished = finished or self.stream_finished(completion)
+
+        if not finished or not answer:
+            logger.warning("Answer stream failed", extra={"finished": finished, "answer_length": len(answer)})
+            yield self.answer_failed_event()
+            return
+
+        yield {"answer": answer, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "followup_questions": []}
+
+    async def run_stream_async(self, q: str, overrides: dict[str, Any]) -> AsyncIterator[dict[str, Any]]:
+        if self.async_search_client is None:
+            async for event in super().run_stream_async(q, overrides):
+                yield event
+            return
+
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        results = self.format_results(await self.search_async(q, overrides), use_semantic_captions)
+        yield {"data_points": results}
 
-    #Query for the completion from OpenAI
-    def get_completion(self, prompt, overrides):
-        return openai.Completion.create(
+        prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved="\n".join(results))
+        answer = ""
+        finished = False
+        with self.metrics.stage(ANSWER_GENERATION):
+            async for completion in await self.executor.run_stream_async(self.get_completion_async, prompt, overrides, True):
+                if completion.choices and completion.choices[0].text:
+                    answer += completion.choices[0].text
+                    yield {"delta": completion.choices[0].text}
+                finished = finished or self.stream_finished(completion)
+
+        if not finished or not answer:
+            logger.warning("Answer stream failed", extra={"finished": finished, "answer_length": len(answer)})
+            yield self.answer_failed_event()
+            return
+
+        yield {"answer": answer, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "followup_questions": []}
+
+    def search(self, q, overrides):
+        top, filter = self.search_options(overrides)
+        return self.search_documents(q, filter, top, overrides)
+
+    async def search_async(self, q, overrides):
+        top, filter = self.search_options(overrides)
+        return await self.search_documents_async(q, filter, top, overrides)
+
+    def search_options(self, overrides):
+        top = overrides.get("top") or 3
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+        return top, filter
+
+    def format_results(self, r, use_semantic_captions):
+        with self.metrics.stage(SOURCE_PACKING):
+            if use_semantic_captions:
+                return [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            return [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in self.documents_within_budget(r)]
+
+    # Uses the token counts stored in the index, documents indexed before the counts were stored are encoded
+    def documents_within_budget(self, documents):
+        counts = [self.document_tokens(doc, doc[self.sourcepage_field] + ": ") for doc in documents]
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            sources = [documents[i][self.sourcepage_field] + ": " + nonewlines(documents[i][self.content_field]) for i in missing]
+            for i, count in zip(missing, self.tokens.count_batch(sources)):
+                counts[i] = count
+
+        token_count = 0
+        results = []
+        for doc, doc_tokens in zip(documents, counts):
+            token_count += doc_tokens + 1  # Sources are separated by newlines
+            if token_count > self.MAXIMUM_SOURCE_TOKENS:
+                logger.debug("Reached maximum token count for sources", extra={"sources": len(results)})
+                break
+            results.append(doc)
+        return results
+
+
+    #Query for the completion from OpenAI, streamed completions are retried but never hedged
+    def get_completion(self, prompt, overrides, stream=False):
+        return self.resilience.call("completion", self.create_completion, prompt, overrides, stream, hedge=not stream, quota=self.completion_quota(prompt))
+
+    async def get_completion_async(self, prompt, overrides, stream=False):
+        return await self.resilience.call_async("completion", self.create_completion_async, prompt, overrides, stream, hedge=not stream, quota=self.completion_quota(prompt))
+
+    # Taken from the rate limiter by the resilience layer before every attempt
+    def completion_quota(self, prompt):
+        return estimate_request_tokens([prompt], self.MAX_TOKENS), ANSWER
+
+    def create_completion(self, prompt, overrides, stream):
+        usage.check_budget(estimate_request_tokens([prompt], self.MAX_TOKENS))
+        completion = openai.Completion.create(
             engine = self.openai_deployment,
             prompt = prompt,
             temperature = overrides.get("temperature") or 0.3,
-            max_tokens = 1024,
+            max_tokens = self.MAX_TOKENS,
             n = 1,
-            stop = ["\n"]
+            stop = ["\n"],
+            stream = stream,
+            request_timeout = self.request_timeout(stream)
+
+        )
+        return self.completion_usage(self.openai_deployment, completion, stream, [prompt])
 
+    async def create_completion_async(self, prompt, overrides, stream):
+        usage.check_budget(estimate_request_tokens([prompt], self.MAX_TOKENS))
+        completion = await openai.Completion.acreate(
+            engine = self.openai_deployment,
+            prompt = prompt,
+            temperature = overrides.get("temperature") or 0.3,
+            max_tokens = self.MAX_TOKENS,
+            n = 1,
+            stop = ["\n"],
+            stream = stream,
+            request_timeout = self.request_timeout(stream)
         )
+        return self.completion_usage_async(self.openai_deployment, completion, stream, [prompt])
+
+    # Streams are only limited by the request deadline, a single completion also by OPENAI_TIMEOUT
+    def request_timeout(self, stream):
+        return deadline.remaining(None if stream else self.OPENAI_TIMEOUT)
        
     """
         #Setting the starttime for the counter
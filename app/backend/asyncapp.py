@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import logs
+from quart import Quart, Response, request, jsonify, abort
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from deadline import DeadlineExceeded, request_deadline, set_deadline
+from pool import PoolSaturated
+from app import AZURE_SEARCH_SERVICE, AZURE_SEARCH_INDEX, METRICS_MIMETYPE, REQUEST_TIMEOUT, SSE_HEADERS, search_client, content_proxy, llm_pool, metrics, traffic_recorder, usage_tracker, create_approaches, ensure_openai_token, format_sse, get_stats, request_session_id, set_session_cookie
+
+# Async (ASGI) serving mode for the backend. It exposes the same routes and responses as app.py, but the approaches await
+# Cognitive Search and Azure OpenAI instead of holding a worker thread for the whole request, so a single process can
+# serve many in-flight conversations. Run it with an ASGI server, e.g. 'python -m hypercorn asyncapp:app --bind 127.0.0.1:5000'
+
+app = Quart(__name__)
+
+@app.before_serving
+async def setup_clients():
+    # Async clients must be created inside the event loop that serves the requests
+    app.async_credential = AsyncDefaultAzureCredential()
+    app.async_search_client = AsyncSearchClient(
+        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+        index_name=AZURE_SEARCH_INDEX,
+        credential=app.async_credential)
+    app.ask_approaches, app.chat_approaches = create_approaches(search_client, app.async_search_client)
+
+@app.after_serving
+async def close_clients():
+    await app.async_search_client.close()
+    await app.async_credential.close()
+
+@app.before_request
+async def start_request():
+    logs.start_request(request.headers.get("X-Request-ID"))
+
+@app.after_request
+async def add_request_id(response):
+    response.headers["X-Request-ID"] = logs.request_id()
+    set_session_cookie(response, request.cookies, request.scheme == "https")
+    return response
+
+@app.route("/", defaults={"path": "index.html"})
+@app.route("/<path:path>")
+async def static_file(path):
+    return await app.send_static_file(path)
+
+@app.route("/content/<path>")
+async def content_file(path):
+    r = await asyncio.to_thread(content_proxy.get, path, request.headers.get("Range"), request.headers.get("If-None-Match"))
+    if r.status == 404:
+        abort(404)
+    return Response(iterate_in_thread(r.body) if r.body is not None else b"", status=r.status, headers=r.headers)
+
+# Reads the chunks of a blocking iterator in a worker thread, so streaming a file doesn't block the event loop
+async def iterate_in_thread(chunks):
+    chunks = iter(chunks)
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+@app.route("/ask", methods=["POST"])
+async def ask():
+    await asyncio.to_thread(ensure_openai_token)
+    request_json = await request.get_json()
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    approach = request_json["approach"]
+    try:
+        impl = app.ask_approaches.get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        with metrics.request("/ask", approach), request_deadline(REQUEST_TIMEOUT), traffic_recorder.record("/ask", request_json), usage_tracker.request("/ask", approach, request_session_id(request.cookies)):
+            r = await impl.run_async(request_json["question"], request_json.get("overrides") or {})
+        return jsonify(r)
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    except DeadlineExceeded as e:
+        return gateway_timeout(e)
+    except Exception as e:
+        logging.exception("Exception in /ask")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/chat", methods=["POST"])
+async def chat():
+    await asyncio.to_thread(ensure_openai_token)
+    request_json = await request.get_json()
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    approach = request_json["approach"]
+    try:
+        impl = app.chat_approaches.get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        with metrics.request("/chat", approach), request_deadline(REQUEST_TIMEOUT), traffic_recorder.record("/chat", request_json), usage_tracker.request("/chat", approach, request_session_id(request.cookies)):
+            r = await impl.run_async(request_json["history"], request_json.get("overrides") or {})
+        return jsonify(r)
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    except DeadlineExceeded as e:
+        return gateway_timeout(e)
+    except Exception as e:
+        logging.exception("Exception in /chat")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/stats", methods=["GET"])
+async def stats():
+    return jsonify(get_stats(app.chat_approaches))
+
+@app.route("/usage", methods=["GET"])
+async def usage_endpoint():
+    return jsonify(usage_tracker.summary())
+
+@app.route("/metrics", methods=["GET"])
+async def metrics_endpoint():
+    return Response(metrics.render(), mimetype=METRICS_MIMETYPE)
+
+@app.route("/ask_stream", methods=["POST"])
+async def ask_stream():
+    await asyncio.to_thread(ensure_openai_token)
+    request_json = await request.get_json()
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    impl = app.ask_approaches.get(request_json["approach"])
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    try:
+        llm_pool.check()
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    events = impl.run_stream_async(request_json["question"], request_json.get("overrides") or {})
+    return Response(sse_stream(events, "/ask_stream", request_json["approach"], request_session_id(request.cookies)), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+@app.route("/chat_stream", methods=["POST"])
+async def chat_stream():
+    await asyncio.to_thread(ensure_openai_token)
+    request_json = await request.get_json()
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    impl = app.chat_approaches.get(request_json["approach"])
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    try:
+        llm_pool.check()
+    except PoolSaturated as e:
+        return too_many_requests(e)
+    events = impl.run_stream_async(request_json["history"], request_json.get("overrides") or {})
+    return Response(sse_stream(events, "/chat_stream", request_json["approach"], request_session_id(request.cookies)), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+def too_many_requests(e):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+def gateway_timeout(e):
+    return jsonify({"error": str(e)}), 504
+
+async def sse_stream(events, route, approach, session_id=None):
+    try:
+        # Not reset when the stream ends, the generator may be closed from another context
+        set_deadline(REQUEST_TIMEOUT)
+        with metrics.request(route, approach), usage_tracker.request(route, approach, session_id):
+            async for event in events:
+                yield format_sse(event)
+    except Exception as e:
+        logging.exception(f"Exception in {route}")
+        yield format_sse({"error": str(e)})
+
+if __name__ == "__main__":
+    app.run()
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from deadline import request_deadline
+from metrics import QUERY_GENERATION, SEARCH, SOURCE_PACKING, ANSWER_GENERATION, SOURCE_VALIDATION
+from benchmarks.fakes import Latency, install
+
+# Offline benchmark of the approaches served by app.py, with local stand-ins for Cognitive Search and Azure OpenAI that
+# have configurable latencies and token output rates. Reports throughput, latency percentiles and a breakdown of the
+# time per stage from the metrics the approaches record, so changes to the backend can be measured without network.
+# The caches are disabled unless --caches is given, since the benchmark repeats a handful of questions.
+# Run from app/backend: python -m benchmarks.approaches
+
+QUESTIONS = [
+    "What does house insurance cover?",
+    "Is water damage covered by my contents insurance?",
+    "How much does car insurance cost?",
+    "What is the difference between kasko and partial kasko?",
+    "How do I report a damage claim?",
+    "Does travel insurance cover cancelled flights?",
+]
+
+STAGES = [QUERY_GENERATION, SEARCH, SOURCE_PACKING, ANSWER_GENERATION, SOURCE_VALIDATION]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+def request_body(endpoint, i):
+    question = QUESTIONS[i % len(QUESTIONS)]
+    # Numbering the questions keeps repeated questions apart for the search fake, which picks documents by query
+    if endpoint == "chat":
+        return [{"user": f"{question} ({i})"}]
+    return f"{question} ({i})"
+
+def run_approach(app, endpoint, name, requests, concurrency, overrides):
+    impl = (app.chat_approaches if endpoint == "chat" else app.ask_approaches)[name]
+
+    def timed_request(i):
+        started = time.perf_counter()
+        try:
+            with app.metrics.request(f"/{endpoint}", name), request_deadline(app.REQUEST_TIMEOUT):
+                impl.run(request_body(endpoint, i), overrides)
+            return time.perf_counter() - started, None
+        except Exception as e:
+            return time.perf_counter() - started, type(e).__name__
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, error in results if error is None]
+    errors = {}
+    for _, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+
+    stages = {}
+    for stage in STAGES:
+        labels = (f"/{endpoint}", name, stage)
+        if app.metrics.stage_seconds.quantile(labels, 0.5) is not None:
+            stages[stage] = {f"p{round(q * 100)}_ms": round(app.metrics.stage_seconds.quantile(labels, q) * 1000, 1) for q in (0.5, 0.99)}
+
+    return {
+        "approach": f"{endpoint}/{name}",
+        "requests": requests,
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "stages": stages
+    }
+
+def print_report(results):
+    print(f"{'approach':<10} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        print(f"{r['approach']:<10} {r['requests']:>8} {sum(r['errors'].values()):>6} {r['throughput']:>8.2f} {r['p50_ms']:>8.0f} {r['p99_ms']:>8.0f}")
+        for stage, latency in r["stages"].items():
+            print(f"  {stage:<20} {latency['p50_ms']:>24.1f} {latency['p99_ms']:>8.1f}")
+        for error, count in r["errors"].items():
+            print(f"  {count} x {error}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the approaches offline against simulated Search and OpenAI backends")
+    parser.add_argument("--approaches", nargs="+", default=["ask/rtr", "ask/rrr", "ask/rda", "chat/rtr", "chat/rrr"])
+    parser.add_argument("--requests", type=int, default=100, help="Requests per approach")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--search-latency", type=float, default=0.08, help="Median latency of a search in seconds")
+    parser.add_argument("--openai-latency", type=float, default=0.4, help="Median time to the first token of a completion in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the log-normal latencies, 0 for fixed latencies")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Output rate of the completions")
+    parser.add_argument("--answer-tokens", type=int, default=120, help="Length of the generated answers")
+    parser.add_argument("--documents", type=int, default=200, help="Size of the simulated index")
+    parser.add_argument("--document-words", type=int, default=150, help="Words per indexed section")
+    parser.add_argument("--overrides", type=json.loads, default={}, help="Overrides sent with every request, as JSON")
+    parser.add_argument("--caches", action="store_true", help="Keep the answer and search caches enabled")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if not args.caches:
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+        os.environ["SEARCH_CACHE_SIZE"] = "0"
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    os.environ.setdefault("LOG_SAMPLE_RATE", "0")
+    os.environ.pop("AZURE_OPENAI_EMB_DEPLOYMENT", None)
+
+    install(Latency(args.search_latency, args.latency_sigma), Latency(args.openai_latency, args.latency_sigma),
+            args.tokens_per_second, args.answer_tokens, args.documents, args.document_words)
+    import app
+
+    results = []
+    for approach in args.approaches:
+        endpoint, name = approach.split("/")
+        results.append(run_approach(app, endpoint, name, args.requests, args.concurrency, args.overrides))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
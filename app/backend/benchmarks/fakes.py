@@ -0,0 +1,350 @@
+import re
+import math
+import time
+import random
+import asyncio
+import hashlib
+from typing import Any, Optional
+
+# Local stand-ins for Cognitive Search, Azure OpenAI, Blob Storage and the Azure credential, so app.py can be imported
+# and its approaches benchmarked without network. install() must be called before app is imported.
+
+WORDS = "house insurance covers damage to the building caused by fire water storm theft and vandalism up to the insured amount".split()
+
+# Source names that the fake completions cite, as prepdocs.py names the pages of a document
+SOURCE_NAME = re.compile(r"\bdoc\d+(?:-\d+)?\.pdf\b")
+
+class Latency:
+    """
+    Log-normal latency with the given median in seconds. sigma sets the length of the tail, 0 gives a fixed latency and
+    0.5 a p99 of about three times the median.
+    """
+
+    def __init__(self, median: float, sigma: float = 0.5):
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self) -> float:
+        return self.median * math.exp(random.gauss(0, self.sigma)) if self.sigma > 0 else self.median
+
+class FakeCredential:
+    def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        return AccessToken("benchmark", int(time.time()) + 24 * 3600)
+
+class FakeContainerProperties:
+    metadata = {"indexversion": "benchmark"}
+
+class FakeContentSettings:
+    content_type = "application/pdf"
+
+class FakeBlobProperties:
+    content_settings = FakeContentSettings()
+
+    def __init__(self, path: str, size: int):
+        self.etag = "\"%s\"" % hashlib.sha256(path.encode()).hexdigest()[:16]
+        self.size = size
+
+class FakeDownload:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def readall(self) -> bytes:
+        return self.data
+
+class FakeBlobClient:
+    """
+    Every blob exists and has the same size. Reading the properties and every downloaded chunk take a sampled latency.
+    """
+
+    def __init__(self, path: str, size: int, latency: Latency):
+        self.path = path
+        self.size = size
+        self.latency = latency
+
+    def get_blob_properties(self, **kwargs) -> FakeBlobProperties:
+        time.sleep(self.latency.sample())
+        return FakeBlobProperties(self.path, self.size)
+
+    def download_blob(self, offset: int = 0, length: Optional[int] = None, **kwargs) -> FakeDownload:
+        time.sleep(self.latency.sample())
+        length = self.size - offset if length is None else min(length, self.size - offset)
+        return FakeDownload(b"\0" * length)
+
+class FakeContainerClient:
+    def __init__(self, latency: Optional[Latency] = None, blob_size: int = 200 * 1024):
+        self.latency = latency or Latency(0.02)
+        self.blob_size = blob_size
+
+    def get_container_properties(self, **kwargs):
+        return FakeContainerProperties()
+
+    def get_blob_client(self, path: str) -> FakeBlobClient:
+        return FakeBlobClient(path, self.blob_size, self.latency)
+
+class FakeBlobServiceClient:
+    def __init__(self, container: Optional[FakeContainerClient] = None):
+        self.container = container or FakeContainerClient()
+
+    def get_container_client(self, container: str) -> FakeContainerClient:
+        return self.container
+
+class FakeCaption:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeSearchResults(list):
+    def get_count(self) -> int:
+        return len(self)
+
+    def get_answers(self) -> list:
+        return []
+
+class FakeAsyncSearchResults:
+    def __init__(self, documents: list[dict[str, Any]]):
+        self.documents = documents
+
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+class FakeSearchClient:
+    """
+    Returns documents from a generated corpus after a sampled latency. The documents for a query are picked from a hash
+    of the query, so repeated queries get the same documents, with scores above the cutoff of the chat approach.
+    """
+
+    DEFAULT_TOP = 50
+
+    def __init__(self, latency: Latency, documents: int = 200, words: int = 150):
+        self.latency = latency
+        self.corpus = [self.make_document(i, words) for i in range(documents)]
+
+    @staticmethod
+    def make_document(i: int, words: int) -> dict[str, Any]:
+        content = " ".join(WORDS[(i + j) % len(WORDS)] for j in range(words))
+        return {
+            "id": f"doc{i}",
+            "sourcefile": f"doc{i}.pdf",
+            "sourcepage": f"doc{i}-{i % 5}.pdf",
+            "category": None,
+            "content": content,
+            "tokens": len(content) // 4,
+            "@search.captions": [FakeCaption(" ".join(content.split()[:30]))]
+        }
+
+    def results(self, q: str, top: Optional[int]) -> list[dict[str, Any]]:
+        start = int(hashlib.sha256(q.encode()).hexdigest(), 16) % len(self.corpus)
+        count = min(top or self.DEFAULT_TOP, len(self.corpus))
+        return [{**self.corpus[(start + i) % len(self.corpus)], "@search.score": 10.0 - i * 0.1} for i in range(count)]
+
+    def search(self, search_text: str, top: Optional[int] = None, **kwargs) -> FakeSearchResults:
+        documents, latency = self.lookup(search_text, top)
+        time.sleep(self.wait(latency, kwargs))
+        return FakeSearchResults(documents)
+
+    def suggest(self, *args, **kwargs) -> list:
+        return []
+
+    # Documents for the query, with the time the search takes
+    def lookup(self, q: str, top: Optional[int]) -> tuple[list[dict[str, Any]], float]:
+        return self.results(q, top), self.latency.sample()
+
+    # Sleeps no longer than the timeout the approach passed on, and fails like the SDK when the search takes longer
+    def wait(self, latency: float, kwargs: dict[str, Any]) -> float:
+        timeout = kwargs.get("read_timeout")
+        if timeout is not None and latency > timeout:
+            from azure.core.exceptions import ServiceResponseError
+            time.sleep(timeout)
+            raise ServiceResponseError("Read timed out")
+        return latency
+
+class FakeAsyncSearchClient(FakeSearchClient):
+    async def search(self, search_text: str, top: Optional[int] = None, **kwargs) -> FakeAsyncSearchResults:
+        documents, latency = self.lookup(search_text, top)
+        await asyncio.sleep(self.wait(latency, kwargs))
+        return FakeAsyncSearchResults(documents)
+
+    async def close(self):
+        pass
+
+class FakeOpenAI:
+    """
+    Answers chat and completion calls after a sampled time to the first token, then produces tokens at a fixed rate.
+    The replies follow the formats the approaches parse: keyword queries, answers that cite the sources in the prompt,
+    and the ReAct, MRKL and conversational agent formats of the langchain approaches, which search once and then answer.
+    """
+
+    def __init__(self, first_token: Latency, tokens_per_second: float = 50, answer_tokens: int = 120):
+        self.first_token = first_token
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+
+    def reply(self, prompt: str) -> str:
+        sources = list(dict.fromkeys(SOURCE_NAME.findall(prompt)))[:2]
+        if "Action: Finish[" in prompt:
+            question, searched = self.agent_state(prompt, "Question:", "Observation")
+            if not searched:
+                return f"Thought: I need to search {question}.\nAction: Search[{question}]"
+            return f"Thought: I can answer the question.\nAction: Finish[{self.answer(self.answer_tokens, sources, '<{}>')}]"
+        # The prompt of the conversational agent also describes the MRKL format, but its parser expects json
+        if '"action_input"' in prompt or "json blob" in prompt:
+            if "TOOL RESPONSE" not in prompt:
+                return '```json\n{"action": "CognitiveSearch", "action_input": "insurance coverage"}\n```'
+            return '```json\n{"action": "Final Answer", "action_input": "%s"}\n```' % self.answer(self.answer_tokens, sources, "[{}]")
+        if "Action Input:" in prompt:
+            question, searched = self.agent_state(prompt, "Question:", "Observation")
+            if not searched:
+                return f" I need to search for the answer.\nAction: CognitiveSearch\nAction Input: {question}"
+            return f" I now know the final answer.\nFinal Answer: {self.answer(self.answer_tokens, sources, '[{}]')}"
+        if "Generate a search query" in prompt:
+            return self.answer(12, [], "")
+        return self.answer(self.answer_tokens, sources, "[{}]")
+
+    @staticmethod
+    def agent_state(prompt: str, question_prefix: str, observation_prefix: str) -> tuple[str, bool]:
+        scratchpad = prompt[prompt.rindex(question_prefix) + len(question_prefix):]
+        return scratchpad.split("\n")[0].strip(), observation_prefix in scratchpad
+
+    @staticmethod
+    def answer(tokens: int, sources: list[str], citation: str) -> str:
+        words = [WORDS[i % len(WORDS)] for i in range(tokens)]
+        return " ".join(words) + "".join(" " + citation.format(source) for source in sources)
+
+    def prompt_text(self, kwargs: dict[str, Any]) -> str:
+        if "messages" in kwargs:
+            return "\n".join(message["content"] for message in kwargs["messages"])
+        prompt = kwargs.get("prompt")
+        return "\n".join(prompt) if isinstance(prompt, list) else prompt or ""
+
+    def response(self, kwargs: dict[str, Any], text: str, chat: bool):
+        from openai.openai_object import OpenAIObject
+        choice = {"index": 0, "finish_reason": "stop"}
+        choice.update({"message": {"role": "assistant", "content": text}} if chat else {"text": text, "logprobs": None})
+        prompt_tokens = len(self.prompt_text(kwargs)) // 4
+        completion_tokens = len(text.split())
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        return OpenAIObject.construct_from({"object": "chat.completion" if chat else "text_completion", "choices": [choice], "usage": usage})
+
+    # The last chunk of a stream carries the finish reason, like the service sends it
+    def chunk(self, token: str, chat: bool, last: bool = False):
+        from openai.openai_object import OpenAIObject
+        choice = {"index": 0, "finish_reason": "stop" if last else None}
+        choice.update({"delta": {"content": token}} if chat else {"text": token})
+        return OpenAIObject.construct_from({"choices": [choice]})
+
+    # Text of the reply, with the times to its first token and to its end
+    def completion(self, kwargs: dict[str, Any]) -> tuple[str, float, float]:
+        text = self.reply(self.prompt_text(kwargs))
+        first_token = self.first_token.sample()
+        return text, first_token, first_token + len(text.split(" ")) / self.tokens_per_second
+
+    # Calls that would take longer than the request timeout the approach passed on fail like the SDK after the timeout
+    def timed_out(self, kwargs: dict[str, Any], total: float) -> bool:
+        timeout = kwargs.get("request_timeout")
+        return timeout is not None and total > timeout and not kwargs.get("stream")
+
+    def create(self, chat: bool, **kwargs):
+        text, first_token, total = self.completion(kwargs)
+        tokens = text.split(" ")
+        if self.timed_out(kwargs, total):
+            import openai.error
+            time.sleep(kwargs["request_timeout"])
+            raise openai.error.Timeout("Request timed out")
+        if kwargs.get("stream"):
+            return self.stream(tokens, first_token, total, chat)
+        time.sleep(total)
+        return self.response(kwargs, text, chat)
+
+    def stream(self, tokens: list[str], first_token: float, total: float, chat: bool):
+        time.sleep(first_token)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep((total - first_token) / len(tokens))
+            yield self.chunk(token if i == 0 else " " + token, chat, i == len(tokens) - 1)
+
+    async def acreate(self, chat: bool, **kwargs):
+        text, first_token, total = self.completion(kwargs)
+        tokens = text.split(" ")
+        if self.timed_out(kwargs, total):
+            import openai.error
+            await asyncio.sleep(kwargs["request_timeout"])
+            raise openai.error.Timeout("Request timed out")
+        if kwargs.get("stream"):
+            return self.astream(tokens, first_token, total, chat)
+        await asyncio.sleep(total)
+        return self.response(kwargs, text, chat)
+
+    async def astream(self, tokens: list[str], first_token: float, total: float, chat: bool):
+        await asyncio.sleep(first_token)
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep((total - first_token) / len(tokens))
+            yield self.chunk(token if i == 0 else " " + token, chat, i == len(tokens) - 1)
+
+class FakeEncoding:
+    """
+    Splits text into words and punctuation, about as many tokens as cl100k_base gives for English text. Used when the
+    real encoding can't be loaded, since tiktoken downloads it on first use.
+    """
+
+    TOKEN = re.compile(r"\w+|[^\w\s]")
+
+    def encode(self, text: str, **kwargs) -> list[str]:
+        return self.TOKEN.findall(text)
+
+    def encode_batch(self, texts: list[str], **kwargs) -> list[list[str]]:
+        return [self.encode(text) for text in texts]
+
+def install(search_latency: Latency, openai_first_token: Latency, tokens_per_second: float = 50, answer_tokens: int = 120, documents: int = 200, words: int = 150, blob_latency: Optional[Latency] = None, blob_size: int = 200 * 1024) -> tuple[FakeSearchClient, FakeOpenAI]:
+    """
+    Replaces the Azure SDK clients and the OpenAI calls with the fakes. The client classes are replaced by factories, so
+    the clients app.py creates share the corpus and latencies of the fakes.
+    """
+    search = FakeSearchClient(search_latency, documents, words)
+    llm = FakeOpenAI(openai_first_token, tokens_per_second, answer_tokens)
+    install_clients(search, FakeAsyncSearchClient(search_latency, documents, words), llm, FakeContainerClient(blob_latency, blob_size))
+    return search, llm
+
+def install_clients(search: FakeSearchClient, async_search: FakeAsyncSearchClient, llm: FakeOpenAI, blob_container: FakeContainerClient):
+    import os
+    import openai
+    import azure.identity
+    import azure.storage.blob
+    import azure.search.documents
+    import azure.search.documents.aio
+
+    # Read by the langchain Azure OpenAI models, which check for them when an approach creates them
+    os.environ.setdefault("OPENAI_API_TYPE", "azure_ad")
+    os.environ.setdefault("OPENAI_API_BASE", "https://benchmark.openai.azure.com")
+    os.environ.setdefault("OPENAI_API_VERSION", "2023-06-01-preview")
+
+    azure.identity.DefaultAzureCredential = FakeCredential
+    azure.storage.blob.BlobServiceClient = lambda *args, **kwargs: FakeBlobServiceClient(blob_container)
+    azure.search.documents.SearchClient = lambda *args, **kwargs: search
+    azure.search.documents.aio.SearchClient = lambda *args, **kwargs: async_search
+
+    def create(chat):
+        return lambda *args, **kwargs: llm.create(chat, **kwargs)
+
+    def acreate(chat):
+        async def call(*args, **kwargs):
+            return await llm.acreate(chat, **kwargs)
+        return call
+
+    openai.ChatCompletion.create = create(True)
+    openai.Completion.create = create(False)
+    openai.ChatCompletion.acreate = acreate(True)
+    openai.Completion.acreate = acreate(False)
+
+    install_encoding()
+
+def install_encoding():
+    # The approaches count tokens when app.py creates them, so without the encoding in the tiktoken cache the import
+    # would fail offline. The token counts of the fake are close enough for the benchmarks
+    import tokens
+    try:
+        tokens.get_encoding("gpt-3.5-turbo")
+    except Exception as e:
+        print(f"Token encoding not available ({type(e).__name__}), counting tokens with FakeEncoding")
+        tokens.get_encoding = lambda model: FakeEncoding()
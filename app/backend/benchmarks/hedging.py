@@ -0,0 +1,56 @@
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from resilience import ResilientCaller
+
+# Offline evaluation of hedged requests against a simulated backend with a long latency tail, e.g. an OpenAI deployment
+# where a few percent of the calls are slow. Reports the latency percentiles and the extra calls made by hedging.
+# Run from app/backend: python -m benchmarks.hedging
+
+class SimulatedBackend:
+    def __init__(self, latency, tail_latency, tail_share):
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_share = tail_share
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+        slow = random.random() < self.tail_share
+        time.sleep(random.uniform(0.8, 1.2) * (self.tail_latency if slow else self.latency))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def measure(hedge, requests, concurrency, backend):
+    caller = ResilientCaller(hedge=hedge)
+    # Warm up the latency tracker, so hedging starts from a known p95
+    for _ in range(caller.hedge_min_samples):
+        caller.call("backend", backend.call)
+    backend.calls = 0
+
+    def timed_request(_):
+        started = time.perf_counter()
+        caller.call("backend", backend.call)
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(timed_request, range(requests)))
+    return latencies, backend.calls / requests - 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare tail latency with and without hedged requests")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="Typical latency of a call in seconds")
+    parser.add_argument("--tail-latency", type=float, default=0.5, help="Latency of the slow calls in seconds")
+    parser.add_argument("--tail-share", type=float, default=0.03, help="Share of the calls that are slow")
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'extra calls':>12}")
+    for hedge in [False, True]:
+        backend = SimulatedBackend(args.latency, args.tail_latency, args.tail_share)
+        latencies, extra_calls = measure(hedge, args.requests, args.concurrency, backend)
+        print(f"{'hedged' if hedge else 'plain':>10} {percentile(latencies, 0.5) * 1000:>8.0f} {percentile(latencies, 0.95) * 1000:>8.0f} {percentile(latencies, 0.99) * 1000:>8.0f} {extra_calls:>12.1%}")
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+from benchmarks.approaches import percentile, request_body
+from benchmarks.fakes import Latency, install
+
+# HTTP load test of the whole backend, including JSON parsing, token refresh, routing and /content. The server runs with
+# the Azure services replaced by the fakes in benchmarks/fakes.py, in a subprocess for every server configuration, or
+# in this process with --in-process. Each endpoint is loaded by an increasing number of clients that send requests back
+# to back, which gives a saturation curve of throughput, latency and error rate against concurrency.
+# A configuration is a name, optionally followed by environment variables for the server, e.g. "pool4:LLM_POOL_WORKERS=4"
+# Run from app/backend: python -m benchmarks.loadtest --config default --config "async@default" --endpoints ask content
+
+ENDPOINTS = ["ask", "chat", "content"]
+
+# Caches would answer most of the repeated questions, so they are off unless a configuration turns them on
+SERVER_DEFAULTS = {"ANSWER_CACHE_SIZE": "0", "SEARCH_CACHE_SIZE": "0", "LOG_LEVEL": "ERROR", "LOG_SAMPLE_RATE": "0"}
+
+# Options of the fakes, passed on to the server subprocess
+FAKE_OPTIONS = ["search_latency", "openai_latency", "latency_sigma", "tokens_per_second", "answer_tokens", "documents", "document_words", "blob_latency", "blob_size"]
+
+def parse_config(config):
+    # "[server@]name[:VAR=value,...]", the server is flask (app.py) or async (asyncapp.py served by hypercorn)
+    server, _, config = config.rpartition("@")
+    name, _, variables = config.partition(":")
+    env = dict(variable.split("=", 1) for variable in variables.split(",") if variable)
+    return name, server or "flask", env
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def install_fakes(args):
+    install(Latency(args.search_latency, args.latency_sigma), Latency(args.openai_latency, args.latency_sigma),
+            args.tokens_per_second, args.answer_tokens, args.documents, args.document_words,
+            Latency(args.blob_latency, args.latency_sigma), args.blob_size)
+
+def serve(server, port):
+    if server == "async":
+        import asyncio
+        import asyncapp
+        from hypercorn.config import Config
+        from hypercorn.asyncio import serve as hypercorn_serve
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        asyncio.run(hypercorn_serve(asyncapp.app, config))
+    else:
+        import app
+        from werkzeug.serving import make_server
+        make_server("127.0.0.1", port, app.app, threaded=True).serve_forever()
+
+def start_server(args, server, env):
+    port = free_port()
+    if args.in_process:
+        os.environ.update({**SERVER_DEFAULTS, **env})
+        install_fakes(args)
+        threading.Thread(target=serve, args=(server, port), daemon=True).start()
+        process = None
+    else:
+        # The fakes are configured with the same options in the server
+        fake_options = [arg for option in FAKE_OPTIONS for arg in (f"--{option.replace('_', '-')}", str(getattr(args, option)))]
+        process = subprocess.Popen([sys.executable, "-m", "benchmarks.loadtest", "--serve", str(port), "--server", server, *fake_options],
+                                   env={**os.environ, **SERVER_DEFAULTS, **env})
+    wait_until_ready(port, process)
+    return port, process
+
+def wait_until_ready(port, process, timeout=60):
+    started = time.time()
+    while time.time() - started < timeout:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/metrics")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server didn't start in {timeout} seconds")
+
+def send(port, endpoint, approach, i, timeout):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        if endpoint == "content":
+            conn.request("GET", f"/content/doc{i % 200}-{i % 5}.pdf")
+        else:
+            key = "history" if endpoint == "chat" else "question"
+            body = json.dumps({"approach": approach, key: request_body(endpoint, i), "overrides": {}})
+            conn.request("POST", f"/{endpoint}", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+def run_level(port, endpoint, approach, concurrency, duration, timeout):
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(sys.maxsize))
+    started = time.perf_counter()
+
+    def client():
+        while time.perf_counter() - started < duration:
+            request_started = time.perf_counter()
+            try:
+                status = send(port, endpoint, approach, next(counter), timeout)
+            except (OSError, http.client.HTTPException) as e:
+                status = type(e).__name__
+            with lock:
+                results.append((time.perf_counter() - request_started, status))
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, status in results if status in (200, 206, 304)]
+    errors = {}
+    for _, status in results:
+        if status not in (200, 206, 304):
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "error_rate": round(sum(errors.values()) / len(results), 4) if results else 0.0,
+        "errors": errors
+    }
+
+def print_curve(config, endpoint, levels):
+    print(f"\n{config} {endpoint}")
+    print(f"{'clients':>8} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    best = max(level["throughput"] for level in levels)
+    for level in levels:
+        # Marks the level with the highest throughput, beyond it more clients only add latency
+        mark = " *" if level["throughput"] == best else ""
+        errors = ", ".join(f"{count} x {status}" for status, count in level["errors"].items())
+        print(f"{level['concurrency']:>8} {level['requests']:>8} {level['throughput']:>8.2f} {level['p50_ms']:>8.0f} {level['p99_ms']:>8.0f} {level['error_rate']:>7.1%}{mark} {errors}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the backend over HTTP against simulated Search, OpenAI and Blob Storage backends")
+    parser.add_argument("--config", action="append", help="Server configuration to test, can be repeated")
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument("--approach", default="rtr", help="Approach used for /ask and /chat")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64], help="Numbers of clients to ramp through")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run every concurrency level")
+    parser.add_argument("--timeout", type=float, default=120, help="Client timeout of a request in seconds")
+    parser.add_argument("--in-process", action="store_true", help="Run the server in this process, only one configuration can be tested")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--search-latency", type=float, default=0.08, help="Median latency of a search in seconds")
+    parser.add_argument("--openai-latency", type=float, default=0.4, help="Median time to the first token of a completion in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the log-normal latencies, 0 for fixed latencies")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Output rate of the completions")
+    parser.add_argument("--answer-tokens", type=int, default=120, help="Length of the generated answers")
+    parser.add_argument("--documents", type=int, default=200, help="Size of the simulated index")
+    parser.add_argument("--document-words", type=int, default=150, help="Words per indexed section")
+    parser.add_argument("--blob-latency", type=float, default=0.02, help="Median latency of a blob storage call in seconds")
+    parser.add_argument("--blob-size", type=int, default=200 * 1024, help="Size of the content files in bytes")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--server", default="flask", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        install_fakes(args)
+        serve(args.server, args.serve)
+        sys.exit()
+
+    configs = [parse_config(config) for config in args.config or ["default"]]
+    if args.in_process and len(configs) > 1:
+        parser.error("--in-process can only test one configuration")
+
+    results = []
+    for name, server, env in configs:
+        port, process = start_server(args, server, env)
+        try:
+            for endpoint in args.endpoints:
+                levels = [run_level(port, endpoint, args.approach, concurrency, args.duration, args.timeout) for concurrency in args.concurrency]
+                results.append({"config": name, "server": server, "env": env, "endpoint": endpoint, "levels": levels})
+                if not args.json:
+                    print_curve(f"{server}@{name}", endpoint, levels)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
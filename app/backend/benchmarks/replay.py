@@ -0,0 +1,206 @@
+import os
+import glob
+import json
+import time
+import argparse
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from deadline import request_deadline
+from recording import call_key, request_text
+from tokens import TokenCounter
+from benchmarks.approaches import percentile
+from benchmarks.fakes import FakeAsyncSearchClient, FakeCaption, FakeContainerClient, FakeOpenAI, FakeSearchClient, Latency, install_clients
+
+# Replays traffic recorded with RECORD_DIR through the approaches, against stand-ins for Cognitive Search and OpenAI that
+# return what every recorded request saw, after the time it took. Requests start at their recorded times, sped up by
+# --speedup, or back to back with --speedup 0. Reports the latency and token usage per approach, and the change from a
+# baseline saved with --output, so two versions of the backend can be compared on production-shaped load.
+# Tokens are counted on the prompts this version sends and the recorded completions.
+# Run from app/backend: python -m benchmarks.replay recordings/*.jsonl --output before.json
+
+# Recorded calls of the request that is being replayed, copied to the pool threads with the context
+current_replay: contextvars.ContextVar[Optional["ReplayState"]] = contextvars.ContextVar("replay", default=None)
+
+class ReplayState:
+    """
+    Recorded searches and completions of one request, by the kind of call and the key of its query or prompt. A call
+    gets the response recorded for the same query or prompt, calls with the same key get theirs in the order they were
+    made. Calls this version makes that weren't recorded, e.g. because it changed a prompt, are answered by the
+    synthetic fakes and counted as unmatched. Recordings made before the keys were stored are handed out in order.
+    """
+
+    def __init__(self, recording: dict[str, Any]):
+        self.calls = {}
+        for search in recording["searches"]:
+            self.calls.setdefault(("search", search.get("key")), deque()).append(search)
+        for completion in recording["completions"]:
+            self.calls.setdefault((completion["kind"], completion.get("key")), deque()).append(completion)
+        self.lock = threading.Lock()
+        self.unmatched = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def next(self, kind: str, key: str) -> Optional[dict[str, Any]]:
+        with self.lock:
+            for calls_key in ((kind, key), (kind, None)):
+                calls = self.calls.get(calls_key)
+                if calls:
+                    return calls.popleft()
+            self.unmatched += 1
+            return None
+
+    def count_tokens(self, prompt_tokens: int, completion_tokens: int):
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+class ReplaySearchClient(FakeSearchClient):
+    def __init__(self):
+        super().__init__(Latency(0, 0), documents=0)
+
+    def lookup(self, q: str, top: Optional[int]) -> tuple[list[dict[str, Any]], float]:
+        state = current_replay.get()
+        search = state.next("search", call_key(q)) if state is not None else None
+        if search is None:
+            return [], 0.0
+        documents = [{**doc, "@search.captions": [FakeCaption(c["text"]) for c in doc.get("@search.captions") or []]} for doc in search["documents"]]
+        return documents, search["ms"] / 1000
+
+class ReplayAsyncSearchClient(ReplaySearchClient, FakeAsyncSearchClient):
+    pass
+
+class ReplayOpenAI(FakeOpenAI):
+    def __init__(self):
+        super().__init__(Latency(0, 0))
+        self.counter = TokenCounter()
+
+    def completion(self, kwargs: dict[str, Any]) -> tuple[str, float, float]:
+        state = current_replay.get()
+        kind = "chat" if "messages" in kwargs else "completion"
+        completion = state.next(kind, call_key(request_text(kwargs))) if state is not None else None
+        prompt = self.prompt_text(kwargs)
+        if completion is None:
+            text, first_token, total = self.reply(prompt), 0.0, 0.0
+        else:
+            text, total = completion["text"], completion["ms"] / 1000
+            first_token = completion["first_token_ms"] / 1000 if completion.get("first_token_ms") is not None else total
+        if state is not None:
+            state.count_tokens(self.counter.count(prompt), self.counter.count(text))
+        return text, first_token, total
+
+def load_recordings(patterns: list[str], limit: Optional[int]) -> list[dict[str, Any]]:
+    recordings = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, encoding="utf-8") as f:
+                recordings.extend(json.loads(line) for line in f if line.strip())
+    recordings.sort(key=lambda r: r["started"])
+    return recordings[:limit] if limit else recordings
+
+def replay_request(app, recording):
+    endpoint, body = recording["endpoint"], recording["body"]
+    approach = body.get("approach")
+    approaches = app.chat_approaches if endpoint == "/chat" else app.ask_approaches
+    state = ReplayState(recording)
+    current_replay.set(state)
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        impl = approaches[approach]
+        with app.metrics.request(endpoint, approach), request_deadline(app.REQUEST_TIMEOUT):
+            impl.run(body["history"] if endpoint == "/chat" else body["question"], body.get("overrides") or {})
+    except Exception as e:
+        outcome = type(e).__name__
+    return {
+        "request_id": recording["request_id"],
+        "group": f"{endpoint}/{approach}",
+        "outcome": outcome,
+        "recorded_ms": recording["ms"],
+        "ms": round((time.perf_counter() - started) * 1000),
+        "prompt_tokens": state.prompt_tokens,
+        "completion_tokens": state.completion_tokens,
+        "unmatched_calls": state.unmatched
+    }
+
+def replay(app, recordings, speedup, concurrency):
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = []
+        started = time.perf_counter()
+        for recording in recordings:
+            if speedup > 0:
+                delay = (recording["started"] - recordings[0]["started"]) / speedup - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            # Every request runs in a fresh context, so the replay state of one request isn't visible to the next
+            futures.append(executor.submit(contextvars.Context().run, replay_request, app, recording))
+        return [future.result() for future in futures]
+
+def summarize(results):
+    groups = {}
+    for r in results:
+        groups.setdefault(r["group"], []).append(r)
+    summary = {}
+    for group, rs in sorted(groups.items()):
+        ok = [r for r in rs if r["outcome"] == "ok"]
+        summary[group] = {
+            "requests": len(rs),
+            "errors": len(rs) - len(ok),
+            "recorded_p50_ms": percentile([r["recorded_ms"] for r in rs], 0.5),
+            "p50_ms": percentile([r["ms"] for r in ok], 0.5),
+            "p99_ms": percentile([r["ms"] for r in ok], 0.99),
+            "prompt_tokens": round(sum(r["prompt_tokens"] for r in rs) / len(rs)),
+            "completion_tokens": round(sum(r["completion_tokens"] for r in rs) / len(rs)),
+            "unmatched_calls": sum(r["unmatched_calls"] for r in rs)
+        }
+    return summary
+
+def print_summary(summary, baseline):
+    print(f"{'approach':<12} {'requests':>8} {'errors':>6} {'rec p50':>8} {'p50 ms':>8} {'p99 ms':>8} {'prompt':>8} {'output':>8} {'unmatched':>9}")
+    for group, s in summary.items():
+        print(f"{group:<12} {s['requests']:>8} {s['errors']:>6} {s['recorded_p50_ms']:>8} {s['p50_ms']:>8} {s['p99_ms']:>8} {s['prompt_tokens']:>8} {s['completion_tokens']:>8} {s['unmatched_calls']:>9}")
+        before = baseline.get(group)
+        if before:
+            # Change from the baseline, latencies in ms and tokens per request
+            print(f"{'  vs baseline':<12} {'':>8} {s['errors'] - before['errors']:>+6} {'':>8} {s['p50_ms'] - before['p50_ms']:>+8} {s['p99_ms'] - before['p99_ms']:>+8} "
+                  f"{s['prompt_tokens'] - before['prompt_tokens']:>+8} {s['completion_tokens'] - before['completion_tokens']:>+8}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through the approaches against recorded backend responses")
+    parser.add_argument("recordings", nargs="+", help="Recording files written with RECORD_DIR, or glob patterns")
+    parser.add_argument("--speedup", type=float, default=1, help="Factor to speed up the recorded arrival times by, 0 to send the requests back to back")
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight at most")
+    parser.add_argument("--limit", type=int, help="Replay only the first recorded requests")
+    parser.add_argument("--output", help="Save the results as JSON, to use as a baseline")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--caches", action="store_true", help="Keep the answer and search caches enabled")
+    args = parser.parse_args()
+
+    # A hedged call would take the response recorded for the next call with the same prompt, or count as unmatched
+    os.environ["HEDGE_REQUESTS"] = "false"
+    os.environ.pop("RECORD_DIR", None)
+    os.environ.pop("AZURE_OPENAI_EMB_DEPLOYMENT", None)
+    if not args.caches:
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+        os.environ["SEARCH_CACHE_SIZE"] = "0"
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    os.environ.setdefault("LOG_SAMPLE_RATE", "0")
+
+    install_clients(ReplaySearchClient(), ReplayAsyncSearchClient(), ReplayOpenAI(), FakeContainerClient())
+    import app
+
+    recordings = load_recordings(args.recordings, args.limit)
+    results = replay(app, recordings, args.speedup, args.concurrency)
+    summary = summarize(results)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["summary"]
+    print_summary(summary, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2)
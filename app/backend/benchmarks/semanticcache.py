@@ -0,0 +1,68 @@
+import time
+import argparse
+from semanticcache import SemanticCache, HashingEmbedder
+from cache import IndexVersion
+
+# Offline evaluation of the semantic answer cache, using the local hashing embedder instead of the embeddings deployment.
+# The hashing embedder only captures shared words, so thresholds for the embeddings deployment must be tuned separately.
+# Run from app/backend: python -m benchmarks.semanticcache
+
+# Pairs of search queries, as generated by ChatRetrieveThenReadApproach.generate_keyword_query, that should share an answer
+PARAPHRASES = [
+    ("house insurance water damage coverage", "water damage covered by home insurance"),
+    ("what does house insurance cover", "house insurance coverage"),
+    ("car insurance price", "price of car insurance"),
+    ("kasko car insurance", "what is kasko car insurance"),
+    ("contents insurance coverage", "what does contents insurance cover"),
+    ("difference between contents insurance and house insurance", "contents insurance vs house insurance difference"),
+    ("how to report a damage claim", "report damage claim"),
+    ("car insurance bonus", "bonus on car insurance"),
+]
+
+# Pairs of search queries that must not share an answer
+DISTINCT = [
+    ("house insurance water damage coverage", "car insurance water damage coverage"),
+    ("car insurance price", "house insurance price"),
+    ("contents insurance coverage", "travel insurance coverage"),
+    ("kasko car insurance", "partial kasko car insurance"),
+    ("how to report a damage claim", "how to cancel insurance"),
+    ("car insurance bonus", "house insurance deductible"),
+]
+
+def evaluate(threshold):
+    embedder = HashingEmbedder()
+    hits = 0
+    for cached_query, query in PARAPHRASES:
+        cache = SemanticCache(embedder, IndexVersion(None), threshold, 10)
+        cache.set(cached_query, {}, cached_query)
+        hits += cache.get(query, {}) is not None
+
+    false_hits = 0
+    for cached_query, query in DISTINCT:
+        cache = SemanticCache(embedder, IndexVersion(None), threshold, 10)
+        cache.set(cached_query, {}, cached_query)
+        false_hits += cache.get(query, {}) is not None
+
+    return hits / len(PARAPHRASES), false_hits / len(DISTINCT)
+
+def lookup_latency(size, lookups):
+    cache = SemanticCache(HashingEmbedder(), IndexVersion(None), 0.99, size)
+    for i in range(size):
+        cache.set(f"insurance question number {i}", {}, i)
+    start = time.perf_counter()
+    for i in range(lookups):
+        cache.get(f"insurance question {i} number", {})
+    return (time.perf_counter() - start) / lookups
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the semantic answer cache offline")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.6, 0.7, 0.8, 0.9, 0.95])
+    parser.add_argument("--size", type=int, default=1000, help="Number of cached entries when measuring lookup latency")
+    args = parser.parse_args()
+
+    print(f"{'threshold':>10} {'hit rate':>10} {'false hits':>11}")
+    for threshold in args.thresholds:
+        hit_rate, false_hit_rate = evaluate(threshold)
+        print(f"{threshold:>10.2f} {hit_rate:>10.0%} {false_hit_rate:>11.0%}")
+
+    print(f"Lookup latency with {args.size} entries: {lookup_latency(args.size, 200) * 1000:.3f} ms")
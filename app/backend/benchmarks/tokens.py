@@ -0,0 +1,50 @@
+import time
+import argparse
+import tiktoken
+from approaches.chatretrievethenread import ChatRetrieveThenReadApproach
+from text import nonewlines
+
+# Micro-benchmark of the token counting done for every chat request, before and after reusing the encoder.
+# Run from app/backend: python -m benchmarks.tokens
+
+WORDS = "house insurance covers damage to the building caused by fire water storm theft and vandalism up to the insured amount".split()
+
+def make_documents(count, words):
+    return [{"sourcefile": f"doc{i}.pdf", "content": " ".join(WORDS[(i + j) % len(WORDS)] for j in range(words)), "@search.score": 1.0} for i in range(count)]
+
+# Token counting as it was done before, with the encoder looked up for every source
+def old_documents_to_sources(documents, max_tokens):
+    token_count = 0
+    results = []
+    for doc in documents:
+        source = f"###{doc['sourcefile']}### {nonewlines(doc['content'])}"
+        token_count += len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(source))
+        if token_count > max_tokens:
+            break
+        results.append(source)
+    return results
+
+def cpu_time_per_request(f, requests):
+    start = time.process_time()
+    for _ in range(requests):
+        f()
+    return (time.process_time() - start) / requests
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the CPU time spent counting tokens per chat request")
+    parser.add_argument("--documents", type=int, default=50, help="Number of documents returned by the search")
+    parser.add_argument("--words", type=int, default=150, help="Number of words per document")
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    approach = ChatRetrieveThenReadApproach(None, "chat", "sourcepage", "content")
+    documents = make_documents(args.documents, args.words)
+    history = [{"user": "What does house insurance cover?"}]
+    overrides = {"suggest_followup_questions": True}
+
+    old = cpu_time_per_request(lambda: old_documents_to_sources(documents, approach.MAXIMUM_SOURCE_TOKENS), args.requests)
+    new = cpu_time_per_request(lambda: approach.documents_to_sources(documents, False, approach.source_token_budget(history, overrides)), args.requests)
+
+    print(f"Encoder per call:  {old * 1000:.3f} ms per request")
+    print(f"Shared encoder:    {new * 1000:.3f} ms per request (includes measuring the prompt and history)")
+    print(f"CPU time saved:    {(old - new) * 1000:.3f} ms per request")
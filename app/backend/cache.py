@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Metadata key on the content blob container that prepdocs.py bumps after every (re)indexing run
+INDEX_VERSION_METADATA_KEY = "indexversion"
+
+# Overrides that change the generated answer, all others are ignored when computing cache keys
+ANSWER_OVERRIDES = ["semantic_ranker", "semantic_captions", "top", "exclude_category", "temperature", "prompt_template", "suggest_followup_questions"]
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with least-recently-used eviction and an optional time-to-live for the entries.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl is not None and entry[0] + self.ttl < time.time()):
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Doesn't count as a hit or miss, nor make the entry more recently used
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # Keys and values of the entries that haven't expired, from the least to the most recently used. Doesn't count as
+    # hits or misses, nor make the entries more recently used
+    def items(self) -> list[tuple[str, Any]]:
+        with self.lock:
+            now = time.time()
+            return [(key, value) for key, (timestamp, value) in self.entries.items() if self.ttl is None or timestamp + self.ttl >= now]
+
+    def stats(self) -> dict[str, Any]:
+        return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+class DiskCache:
+    """
+    Cache of JSON serializable values stored as one file per key, so entries survive restarts and can be shared by the
+    worker processes of an instance. The number of files is bounded, the oldest files are removed first.
+    """
+
+    def __init__(self, directory: str, max_entries: int, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.write_errors = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self.path(key)
+        try:
+            if self.ttl is not None and os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    # Write errors, e.g. a full disk or a removed directory, are logged and the entry isn't stored, like read errors are
+    # misses, so they never fail the request whose result is being cached
+    def set(self, key: str, value: Any):
+        # Write to a temporary file first so concurrent readers never see a partially written entry
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+
+            self.writes += 1
+            if self.writes % 100 == 0:
+                self.prune()
+        except OSError as e:
+            self.write_errors += 1
+            logger.warning("Could not write cache entry", extra={"directory": self.directory, "error": str(e)})
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def prune(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda f: os.path.getmtime(f))
+        for f in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                os.remove(os.path.join(self.directory, name))
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def stats(self) -> dict[str, Any]:
+        return {"directory": self.directory, "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses, "write_errors": self.write_errors}
+
+class IndexVersion:
+    """
+    Version stamp of the search index content. prepdocs.py bumps it in the metadata of the blob container after
+    indexing, the stamp is re-read at most every refresh_interval seconds. Caches include the version in their keys,
+    so entries created before a reindex are never served after it.
+    """
+
+    def __init__(self, blob_container, refresh_interval: float = 60):
+        self.blob_container = blob_container
+        self.refresh_interval = refresh_interval
+        self.version = ""
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def get(self) -> str:
+        if self.blob_container is None or self.refreshed_at + self.refresh_interval > time.time():
+            return self.version
+
+        with self.lock:
+            if self.refreshed_at + self.refresh_interval > time.time():
+                return self.version
+            try:
+                metadata = self.blob_container.get_container_properties().metadata or {}
+                version = metadata.get(INDEX_VERSION_METADATA_KEY, "")
+            except Exception as e:
+                logger.warning("Could not read index version", extra={"error": str(e)})
+                version = self.version
+            self.refreshed_at = time.time()
+
+            if version != self.version:
+                logger.info("Index version changed", extra={"previous_version": self.version, "version": version})
+                self.version = version
+                for listener in self.listeners:
+                    listener(version)
+
+        return self.version
+
+    def on_change(self, listener):
+        self.listeners.append(listener)
+
+class AnswerCache:
+    """
+    Cache of complete chat answers. Entries are keyed on the normalized last user question, the earlier turns of the
+    conversation, the overrides that affect the answer and the index version. Lookups go to an in-process LRU tier
+    first, and then to an optional on-disk tier that is shared by the worker processes.
+    """
+
+    def __init__(self, index_version: IndexVersion, maxsize: int = 512, ttl: Optional[float] = 3600, directory: Optional[str] = None, max_disk_entries: int = 10000):
+        self.index_version = index_version
+        self.memory = LRUCache(maxsize, ttl)
+        self.disk = DiskCache(directory, max_disk_entries, ttl) if directory else None
+        # Old entries can never be hit after a reindex, so release the memory right away
+        index_version.on_change(lambda version: self.memory.clear())
+
+    def key(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> str:
+        question = normalize_question(history[-1].get("user", ""))
+        key_data = json.dumps([self.index_version.get(), question, list(history[:-1]), answer_overrides(overrides)], sort_keys=True)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Optional[dict[str, Any]]:
+        key = self.key(history, overrides)
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, history: Sequence[dict[str, str]], overrides: dict[str, Any], value: dict[str, Any]):
+        key = self.key(history, overrides)
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def stats(self) -> dict[str, Any]:
+        return {"index_version": self.index_version.version, "memory": self.memory.stats(), "disk": self.disk.stats() if self.disk else None}
+
+class SearchCache:
+    """
+    Cache of Cognitive Search results, shared by all approaches. Entries are keyed on the query and the search options,
+    and expire after the TTL or when the index version changes.
+    """
+
+    def __init__(self, index_version: IndexVersion, maxsize: int = 1024, ttl: Optional[float] = 300):
+        self.index_version = index_version
+        self.memory = LRUCache(maxsize, ttl)
+        index_version.on_change(lambda version: self.memory.clear())
+
+    def key(self, query: str, filter: Optional[str], top: Optional[int], semantic_ranker: bool, semantic_captions: bool) -> str:
+        return json.dumps([self.index_version.get(), query, filter, top, semantic_ranker, semantic_captions])
+
+    def get(self, key: str) -> Optional[list[dict[str, Any]]]:
+        return self.memory.get(key)
+
+    def set(self, key: str, documents: list[dict[str, Any]]):
+        self.memory.set(key, documents)
+
+    def stats(self) -> dict[str, Any]:
+        return {"index_version": self.index_version.version, "memory": self.memory.stats()}
+
+def answer_overrides(overrides: dict[str, Any]) -> dict[str, Any]:
+    return {k: overrides.get(k) for k in ANSWER_OVERRIDES if overrides.get(k) is not None}
+
+def normalize_question(question: str) -> str:
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!. ")
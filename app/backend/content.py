@@ -0,0 +1,273 @@
+import os
+import re
+import hashlib
+import mimetypes
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterator, Optional
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from cache import LRUCache
+
+class ContentResponse:
+    """
+    HTTP response for a content file, independent of the web framework. The body is an iterator of chunks, so it can be
+    streamed by both app.py and asyncapp.py.
+    """
+
+    def __init__(self, status: int, headers: dict[str, str], body: Optional[Iterator[bytes]] = None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+class ContentProxy:
+    """
+    Serves the content files (pages of the indexed documents) from blob storage. Blobs are streamed in fixed size chunks,
+    so memory use per request doesn't depend on the size of the file, and Range and If-None-Match requests are answered
+    from the blob ETag. Recently viewed files are kept in an optional on-disk cache that is bounded in bytes, with the
+    least recently used files removed first. With sas_redirect, clients are redirected to a short-lived read-only SAS URL
+    signed with a user delegation key, and the app is not in the data path at all.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    PROPERTIES_TTL = 60
+    CACHE_CONTROL = "private, max-age=300"
+
+    def __init__(self, blob_container, cache_dir: Optional[str] = None, cache_max_bytes: int = 500 * 1024 * 1024, sas_redirect: bool = False, blob_service_client = None, sas_ttl: int = 300):
+        self.blob_container = blob_container
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.sas_redirect = sas_redirect
+        self.blob_service_client = blob_service_client
+        self.sas_ttl = sas_ttl
+        self.properties = LRUCache(1024, self.PROPERTIES_TTL)
+        self.delegation_key = None
+        self.delegation_key_expiry = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, path: str, range_header: Optional[str] = None, if_none_match: Optional[str] = None) -> ContentResponse:
+        if self.sas_redirect:
+            return ContentResponse(302, {"Location": self.sas_url(path), "Cache-Control": "no-store"})
+
+        # The properties are cached, so the blob can have been replaced since they were read. The first chunk is read
+        # before the response is returned, and if the blob changed, the response is built again from fresh properties
+        for attempt in range(2):
+            try:
+                properties = self.blob_properties(path)
+            except ResourceNotFoundError:
+                return ContentResponse(404, {})
+            try:
+                return self.respond(path, properties, range_header, if_none_match)
+            except ResourceModifiedError:
+                self.properties.delete(path)
+                if attempt > 0:
+                    raise
+
+    def respond(self, path: str, properties: dict[str, Any], range_header: Optional[str], if_none_match: Optional[str]) -> ContentResponse:
+        headers = {
+            "Content-Type": properties["content_type"],
+            "Content-Disposition": f"inline; filename=\"{path}\"",
+            "ETag": properties["etag"],
+            "Accept-Ranges": "bytes",
+            "Cache-Control": self.CACHE_CONTROL,
+        }
+        if if_none_match and etag_matches(if_none_match, properties["etag"]):
+            return ContentResponse(304, headers)
+
+        size = properties["size"]
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return ContentResponse(416, {"Content-Range": f"bytes */{size}"})
+
+        status = 200
+        start, end = 0, size - 1
+        if byte_range is not None:
+            status = 206
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        cache_path = self.cache_path(path, properties["etag"])
+        cached_file = self.open_cached(cache_path) if cache_path else None
+        if cached_file is not None:
+            self.hits += 1
+            return ContentResponse(status, headers, self.read_file(cached_file, start, end))
+
+        self.misses += 1
+        if cache_path and byte_range is None and size <= self.cache_max_bytes:
+            return ContentResponse(status, headers, prefetch(self.download_to_cache(path, properties["etag"], size, cache_path)))
+        return ContentResponse(status, headers, prefetch(self.download(path, properties["etag"], start, end)))
+
+    def blob_properties(self, path: str) -> dict[str, Any]:
+        properties = self.properties.get(path)
+        if properties is None:
+            blob = self.blob_container.get_blob_client(path).get_blob_properties()
+            content_type = blob.content_settings.content_type
+            if not content_type or content_type == "application/octet-stream":
+                content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            etag = blob.etag if blob.etag.startswith("\"") else f"\"{blob.etag}\""
+            properties = {"etag": etag, "size": blob.size, "content_type": content_type}
+            self.properties.set(path, properties)
+        return properties
+
+    # Reads the blob one chunk at a time, every chunk is only read if the blob hasn't changed since the properties were read.
+    # A blob that changed in the middle of a response can't be served any more, but the next request reads its properties again
+    def download(self, path: str, etag: str, start: int, end: int) -> Iterator[bytes]:
+        blob_client = self.blob_container.get_blob_client(path)
+        offset = start
+        while offset <= end:
+            length = min(self.CHUNK_SIZE, end - offset + 1)
+            try:
+                chunk = blob_client.download_blob(offset=offset, length=length, etag=etag, match_condition=MatchConditions.IfNotModified).readall()
+            except ResourceModifiedError:
+                self.properties.delete(path)
+                raise
+            yield chunk
+            offset += length
+
+    # Streams the blob to the client and writes it to the cache at the same time. The file is only added to the cache
+    # once it is complete, so an aborted download never leaves a partial file behind.
+    def download_to_cache(self, path: str, etag: str, size: int, cache_path: str) -> Iterator[bytes]:
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        completed = False
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in self.download(path, etag, 0, size - 1):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, cache_path)
+            completed = True
+            self.prune()
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # The file is opened right away, so it can still be read if it is pruned before the response is sent
+    def open_cached(self, cache_path: str):
+        try:
+            f = open(cache_path, "rb")
+        except OSError:
+            return None
+        # The modification time orders the files for eviction, so touch the file on every hit
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return f
+
+    def read_file(self, f, start: int, end: int) -> Iterator[bytes]:
+        with f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def cache_path(self, path: str, etag: str) -> Optional[str]:
+        # The ETag is part of the file name, so a changed blob is never served from a stale file
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha256(f"{path}|{etag}".encode("utf-8")).hexdigest() + ".bin")
+
+    def prune(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".bin"):
+                    try:
+                        stat = os.stat(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.cache_max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+                total -= size
+
+    def sas_url(self, path: str) -> str:
+        blob_client = self.blob_container.get_blob_client(path)
+        expiry = datetime.now(timezone.utc) + timedelta(seconds=self.sas_ttl)
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        sas = generate_blob_sas(
+            account_name=blob_client.account_name,
+            container_name=blob_client.container_name,
+            blob_name=blob_client.blob_name,
+            user_delegation_key=self.user_delegation_key(),
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry,
+            content_type=content_type,
+            content_disposition=f"inline; filename=\"{path}\"")
+        return f"{blob_client.url}?{sas}"
+
+    # A user delegation key is valid for up to 7 days, it is renewed when less than an hour is left
+    def user_delegation_key(self):
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            if self.delegation_key is None or self.delegation_key_expiry - now < timedelta(hours=1):
+                self.delegation_key_expiry = now + timedelta(days=1)
+                self.delegation_key = self.blob_service_client.get_user_delegation_key(now - timedelta(minutes=5), self.delegation_key_expiry)
+            return self.delegation_key
+
+    def stats(self) -> dict[str, Any]:
+        return {"cache_dir": self.cache_dir, "cache_max_bytes": self.cache_max_bytes, "sas_redirect": self.sas_redirect, "hits": self.hits, "misses": self.misses}
+
+# Reads the first chunk right away, so errors of the first read are raised before the response status is sent
+def prefetch(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    first = next(chunks, None)
+    def body():
+        try:
+            if first is not None:
+                yield first
+            yield from chunks
+        finally:
+            chunks.close()
+    return body()
+
+# Parses a single "bytes=" range into the first and last byte positions. Returns None if the whole file should be sent,
+# which is also allowed for multiple ranges and headers that can't be parsed, including ranges that end before they start
+def parse_range(range_header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    if not range_header:
+        return None
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", range_header)
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+
+    first, last = match.group(1), match.group(2)
+    if not first:
+        # Suffix range with the number of bytes at the end of the file
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as required for If-None-Match
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
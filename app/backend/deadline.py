@@ -0,0 +1,55 @@
+import time
+import contextvars
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Monotonic time by which the current request must be answered. It is set by the route and read by every stage of the
+# approaches, the pool and the resilience layer copy the context, so it follows the work to other threads
+current_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when there is no time left to start or continue work for a request. The routes answer with 504.
+    """
+
+    def __init__(self, message: str = "Request deadline exceeded"):
+        super().__init__(message)
+
+@contextmanager
+def request_deadline(seconds: Optional[float]) -> Iterator[None]:
+    token = current_deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+# Brings the deadline forward to at most seconds from now for the work started inside, e.g. a call the caller stops
+# waiting for after seconds. The call copies the context, so its queue wait, HTTP timeout and retries end at the same
+# time instead of running on after the caller has given up
+@contextmanager
+def limited(seconds: Optional[float]) -> Iterator[None]:
+    deadline = current_deadline.get()
+    if seconds:
+        deadline = min(deadline, time.monotonic() + seconds) if deadline is not None else time.monotonic() + seconds
+    token = current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+def set_deadline(seconds: Optional[float]):
+    # For streamed responses, where the work continues after the route has returned
+    current_deadline.set(time.monotonic() + seconds if seconds else None)
+
+def remaining(limit: Optional[float] = None) -> Optional[float]:
+    # Seconds left for the request, at most limit. None if there is neither a deadline nor a limit
+    deadline = current_deadline.get()
+    if deadline is None:
+        return limit
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if limit is None else min(left, limit)
+
+def check():
+    remaining()
@@ -1,6 +1,16 @@
+import logging
+import openai.error
+import deadline
+import usage
 from typing import Any, Dict, List, Optional, Union
 from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import AzureChatOpenAI
+from langchain.llms.openai import AzureOpenAI
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+from ratelimit import ANSWER, RateLimiter, estimate_request_tokens
+from usage import AGENT_STEP
+
+logger = logging.getLogger(__name__)
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
@@ -86,3 +96,63 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+class LoggingCallbackHandler(BaseCallbackHandler):
+    """Logs the steps of a langchain agent at debug level through the logging of the app, so they end up in the logs
+    of sampled requests, instead of agents printing them to stdout with verbose."""
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        logger.debug("Agent LLM call", extra={"prompts": prompts})
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        logger.debug("Agent action", extra={"tool": action.tool, "tool_input": action.tool_input, "log": action.log})
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        logger.debug("Agent observation", extra={"observation": output})
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        logger.debug("Agent finished", extra={"log": finish.log})
+
+class DeadlineAzureOpenAI(AzureOpenAI):
+    """AzureOpenAI that passes the time left before the request deadline as the timeout of every call, instead of the
+    time that was left when the agent was built."""
+
+    @property
+    def _invocation_params(self) -> Dict[str, Any]:
+        return {**super()._invocation_params, "request_timeout": deadline.remaining()}
+
+class DeadlineAzureChatOpenAI(AzureChatOpenAI):
+    """AzureChatOpenAI that passes the time left before the request deadline as the timeout of every call."""
+
+    @property
+    def _client_params(self) -> Dict[str, Any]:
+        return {**super()._client_params, "request_timeout": deadline.remaining()}
+
+class RateLimitCallbackHandler(BaseCallbackHandler):
+    """Takes quota from the shared rate limiter before every LLM call made by a langchain agent, and stops the agent
+    with DeadlineExceeded when the deadline of the request has passed, or with TokenBudgetExceeded when the request or
+    its session has used up its tokens. The token usage of every call is recorded as an agent step."""
+
+    raise_error: bool = True
+
+    def __init__(self, rate_limiter: RateLimiter, max_tokens: Optional[int] = 256, priority: int = ANSWER, deployment: Optional[str] = None):
+        self.rate_limiter = rate_limiter
+        self.max_tokens = max_tokens
+        self.priority = priority
+        self.deployment = deployment
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        deadline.check()
+        tokens = estimate_request_tokens(prompts, self.max_tokens)
+        usage.check_budget(tokens)
+        self.rate_limiter.acquire(tokens, self.priority)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        usage.record(self.deployment, token_usage.get("prompt_tokens", 0), token_usage.get("completion_tokens", 0), stage=AGENT_STEP)
+
+    def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
+        if isinstance(error, openai.error.RateLimitError):
+            self.rate_limiter.throttled(error)
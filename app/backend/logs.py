@@ -0,0 +1,118 @@
+import sys
+import json
+import time
+import uuid
+import atexit
+import queue
+import random
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
+
+# Id of the current request and whether its verbose payloads (prompts, history, documents) are logged. Set when the
+# request starts and copied to the pool threads with the context
+current_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+current_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("log_sampled", default=False)
+
+# Attributes every LogRecord has, anything else was passed with extra and is logged as a field
+RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime", "request_id", "taskName"}
+
+def start_request(request_id: Optional[str] = None, sample_rate: Optional[float] = None) -> str:
+    request_id = request_id or uuid.uuid4().hex
+    current_request_id.set(request_id)
+    current_sampled.set(random.random() < (SAMPLE_RATE if sample_rate is None else sample_rate))
+    return request_id
+
+def request_id() -> str:
+    return current_request_id.get()
+
+# Verbose payloads are only logged for a sample of the requests. Callers check this before building a large payload
+def sampled() -> bool:
+    return current_sampled.get()
+
+def elapsed_ms(started: float) -> int:
+    return round((time.time() - started) * 1000)
+
+class RequestFilter(logging.Filter):
+    """
+    Stamps records with the id of the current request, and drops records below the configured level unless the request
+    is sampled. Runs in the thread that logs, before the record is queued, so the context of the request is available.
+    """
+
+    def __init__(self, level: int):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level and not current_sampled.get():
+            return False
+        record.request_id = current_request_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the fields passed with extra next to the message, so the logs can be queried.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class RequestQueueHandler(QueueHandler):
+    # The listener formats the record, so the request thread only puts it on the queue. The default prepare formats
+    # the message and drops the fields, which would move the work back to the request thread
+    def prepare(self, record: logging.LogRecord) -> Any:
+        return record
+
+SAMPLE_RATE = 0.0
+listener: Optional[QueueListener] = None
+
+def configure_logging(level: str = "INFO", sample_rate: float = 0.0, json_format: bool = True):
+    """
+    Sends all logging through a queue to a background thread that formats and writes it, so requests never wait for
+    stdout. Sampled requests are also logged at debug level, with their prompts, history and documents. The level is
+    a level name in any case, an unknown one raises ValueError.
+    """
+    global SAMPLE_RATE, listener
+    level_number = logging.getLevelName(level.strip().upper())
+    if not isinstance(level_number, int):
+        raise ValueError(f"Unknown log level {level!r}")
+    SAMPLE_RATE = sample_rate
+    stop_logging()
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = RequestQueueHandler(log_queue)
+    queue_handler.addFilter(RequestFilter(level_number))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.DEBUG if sample_rate > 0 else level_number)
+    # The SDKs log every HTTP request and response, which is the kind of volume this is meant to avoid
+    for name in ("azure", "urllib3", "openai", "asyncio"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+# Writes out what is still queued when the process exits
+@atexit.register
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
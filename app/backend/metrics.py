@@ -0,0 +1,181 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterator, Optional, Sequence
+
+# Stages of answering a question, used as the stage label
+QUERY_GENERATION = "query_generation"
+SEARCH = "search"
+SOURCE_PACKING = "source_packing"
+ANSWER_GENERATION = "answer_generation"
+SOURCE_VALIDATION = "source_validation"
+
+# Latencies from a cache hit up to a slow completion, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+# Endpoint and approach of the current request, set by the route and copied to the pool threads with the context
+current_labels: contextvars.ContextVar[tuple[str, str]] = contextvars.ContextVar("metric_labels", default=("", ""))
+
+# Innermost stage that is running, the token usage of OpenAI calls is accounted to it
+current_stage: contextvars.ContextVar[str] = contextvars.ContextVar("stage", default="")
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    labels = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Counter:
+    """
+    Counter with labels, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels: Sequence[str], amount: float = 1):
+        with self.lock:
+            self.values[tuple(labels)] = self.values.get(tuple(labels), 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}")
+        return lines
+
+class Histogram:
+    """
+    Histogram with labels and fixed buckets, rendered in the Prometheus text format. Quantiles are estimated from the
+    buckets the same way histogram_quantile does, so /stats and the dashboards agree.
+    """
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels: Sequence[str], value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(tuple(labels))
+            if series is None:
+                # Counts per bucket, the last one for values above the largest bucket, then the sum
+                series = self.series[tuple(labels)] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def quantile(self, labels: Sequence[str], q: float) -> Optional[float]:
+        with self.lock:
+            series = self.series.get(tuple(labels))
+            if series is None:
+                return None
+            counts = list(series[0])
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return None
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.items())
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names, labels, 'le="%s"' % format_value(bound))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative += counts[-1]
+            bucket_labels = format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+class Metrics:
+    """
+    Latency histograms and error counters for the requests and for every stage of every approach, labelled with the
+    endpoint and approach of the request. Served in the Prometheus text format on /metrics, with p50/p95/p99 per stage
+    in /stats.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.request_seconds = Histogram("rag_request_duration_seconds", "Time to answer a request.", ("endpoint", "approach", "outcome"), buckets)
+        self.stage_seconds = Histogram("rag_stage_duration_seconds", "Time spent in a stage of answering a request.", ("endpoint", "approach", "stage"), buckets)
+        self.stage_errors = Counter("rag_stage_errors_total", "Stages that ended with an exception.", ("endpoint", "approach", "stage"))
+
+    @contextmanager
+    def request(self, endpoint: str, approach: str) -> Iterator[None]:
+        # The previous labels are restored with set rather than reset, which would fail if a streamed response is
+        # closed from another context
+        previous = current_labels.get()
+        current_labels.set((endpoint, approach or ""))
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            self.request_seconds.observe((endpoint, approach or "", outcome), time.perf_counter() - started)
+            current_labels.set(previous)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        labels = (*current_labels.get(), name)
+        previous = current_stage.get()
+        current_stage.set(name)
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.stage_errors.inc(labels)
+            raise
+        finally:
+            self.stage_seconds.observe(labels, time.perf_counter() - started)
+            current_stage.set(previous)
+
+    # For stages that are submitted to the pool rather than run in place
+    def timed(self, stage: str, fn: Callable, *args, **kwargs) -> Any:
+        with self.stage(stage):
+            return fn(*args, **kwargs)
+
+    async def timed_async(self, stage: str, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        with self.stage(stage):
+            return await fn(*args, **kwargs)
+
+    def render(self) -> str:
+        lines = self.request_seconds.render() + self.stage_seconds.render() + self.stage_errors.render()
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict[str, Any]:
+        stages = {}
+        with self.stage_seconds.lock:
+            series = {labels: sum(counts) for labels, (counts, _) in self.stage_seconds.series.items()}
+        for labels, count in sorted(series.items()):
+            quantiles = {f"p{round(q * 100)}_ms": round(self.stage_seconds.quantile(labels, q) * 1000) for q in (0.5, 0.95, 0.99)}
+            stages["/".join(labels)] = {"count": count, **quantiles}
+        return stages
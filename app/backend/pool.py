@@ -0,0 +1,293 @@
+import math
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+import deadline
+from profiling import run_profiled
+
+class PoolSaturated(Exception):
+    """
+    Raised when a task is submitted while all workers are busy and the queue is full. The routes answer with 429 and a
+    Retry-After header, so clients back off instead of piling up requests the instance can't serve.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many requests, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+class WorkerLimit:
+    """
+    Workers shared by the threads of the pool and the coroutines of the async approaches, so both together never run
+    more than size tasks. Waiting threads block and waiting coroutines await, both are served in the order they came,
+    and a released worker is handed to the next one directly.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.used = 0
+        self.waiters = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.used < self.size and not self.waiters:
+                self.used += 1
+                return
+            waiter = threading.Event()
+            self.waiters.append(waiter)
+        waiter.wait()
+
+    async def acquire_async(self):
+        with self.lock:
+            if self.used < self.size and not self.waiters:
+                self.used += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                    raise
+            # The worker was handed over before the cancellation got through, a cancelled waiter gives it back itself
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            if not self.waiters:
+                self.used -= 1
+                return
+            waiter = self.waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            waiter.get_loop().call_soon_threadsafe(self.hand_over, waiter)
+
+    def hand_over(self, waiter: asyncio.Future):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+class HeldStream:
+    """
+    Completion stream that keeps the worker of the call that opened it until it is exhausted, fails or is closed, so
+    answers count against the limits of the pool for as long as they are generated. Works for sync and async streams,
+    and a stream that is dropped without being closed gives the worker back when it is collected.
+    """
+
+    def __init__(self, chunks: Any, on_close: Callable[[], None]):
+        self.chunks = chunks
+        self.on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.chunks.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    def close(self):
+        try:
+            if self.on_close is not None and hasattr(self.chunks, "close"):
+                self.chunks.close()
+        finally:
+            self.release()
+
+    async def aclose(self):
+        try:
+            if self.on_close is not None and hasattr(self.chunks, "aclose"):
+                await self.chunks.aclose()
+        finally:
+            self.release()
+
+    def release(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+    def __del__(self):
+        self.release()
+
+class BoundedExecutor:
+    """
+    Process-wide pool for the OpenAI calls of all approaches. At most max_workers tasks run at the same time and at most
+    max_queue tasks wait for a worker, submitting more raises PoolSaturated right away. Tasks run in a copy of the
+    context of the submitting thread, so context variables set for the request are visible in the task. Tasks that are
+    still queued when the deadline of their request has passed are dropped with DeadlineExceeded instead of being run.
+    Coroutines from the async approaches are admitted against the same limits with run_async, and share the workers
+    with the threads. Streamed completions are opened with submit_stream and run_stream_async, and keep their worker and
+    their place in the queue until the stream is exhausted or closed.
+    """
+
+    MAX_RETRY_AFTER = 60
+
+    def __init__(self, max_workers: int = 16, max_queue: int = 64):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="llm")
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.workers = WorkerLimit(max_workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.wait_times = deque(maxlen=1000)
+        self.run_times = deque(maxlen=1000)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        return self.submit_task(False, fn, args, kwargs)
+
+    # The future resolves to a HeldStream, or None when fn returned None
+    def submit_stream(self, fn: Callable, *args, **kwargs) -> Future:
+        return self.submit_task(True, fn, args, kwargs)
+
+    def submit_task(self, stream: bool, fn: Callable, args: tuple, kwargs: dict[str, Any]) -> Future:
+        self.admit()
+        context = contextvars.copy_context()
+        submitted = time.monotonic()
+
+        def run():
+            self.workers.acquire()
+            started = self.start_task(submitted)
+            held = False
+            try:
+                context.run(self.check_deadline)
+                result = context.run(run_profiled, fn, *args, **kwargs)
+                if stream and result is not None:
+                    held = True
+                    return HeldStream(result, lambda: self.finish_task(started))
+                return result
+            finally:
+                if not held:
+                    self.finish_task(started)
+
+        try:
+            future = self.executor.submit(run)
+        except BaseException:
+            self.release()
+            raise
+        # A task cancelled while it is queued never runs, so its place in the queue is given back here
+        future.add_done_callback(lambda f: self.release() if f.cancelled() else None)
+        return future
+
+    async def run_async(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        return await self.run_task_async(False, fn, args, kwargs)
+
+    # Returns a HeldStream, or None when fn returned None
+    async def run_stream_async(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        return await self.run_task_async(True, fn, args, kwargs)
+
+    async def run_task_async(self, stream: bool, fn: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict[str, Any]) -> Any:
+        self.admit()
+        submitted = time.monotonic()
+        try:
+            await self.workers.acquire_async()
+        except BaseException:
+            self.release()
+            raise
+        started = self.start_task(submitted)
+        held = False
+        try:
+            self.check_deadline()
+            result = await fn(*args, **kwargs)
+            if stream and result is not None:
+                held = True
+                return HeldStream(result, lambda: self.finish_task(started))
+            return result
+        finally:
+            if not held:
+                self.finish_task(started)
+
+    def admit(self):
+        # Fails fast instead of blocking, so a full queue is reported to the client right away
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PoolSaturated(self.retry_after())
+        with self.lock:
+            self.pending += 1
+
+    def check(self):
+        # For routes that can't report an error once they start streaming the response
+        with self.lock:
+            full = self.pending >= self.max_workers + self.max_queue
+            if full:
+                self.rejected += 1
+        if full:
+            raise PoolSaturated(self.retry_after())
+
+    def check_deadline(self):
+        try:
+            deadline.check()
+        except deadline.DeadlineExceeded:
+            with self.lock:
+                self.expired += 1
+            raise
+
+    def start_task(self, submitted: float) -> float:
+        started = time.monotonic()
+        with self.lock:
+            self.running += 1
+            self.wait_times.append(started - submitted)
+        return started
+
+    def finish_task(self, started: float):
+        with self.lock:
+            self.running -= 1
+            self.completed += 1
+            self.run_times.append(time.monotonic() - started)
+        self.workers.release()
+        self.release()
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def retry_after(self) -> int:
+        # Time for the workers to get through the queue, from the recent task run times
+        with self.lock:
+            run_time = sum(self.run_times) / len(self.run_times) if self.run_times else 1.0
+            queued = max(self.pending - self.running, 0)
+        return min(max(1, math.ceil(run_time * (queued + 1) / self.max_workers)), self.MAX_RETRY_AFTER)
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            wait_times = sorted(self.wait_times)
+            run_times = list(self.run_times)
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self.running,
+                "queued": max(self.pending - self.running, 0),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "wait_ms_avg": round(sum(wait_times) * 1000 / len(wait_times)) if wait_times else 0,
+                "wait_ms_p95": round(wait_times[int(len(wait_times) * 0.95)] * 1000) if wait_times else 0,
+                "run_ms_avg": round(sum(run_times) * 1000 / len(run_times)) if run_times else 0
+            }
@@ -0,0 +1,158 @@
+import io
+import os
+import sys
+import random
+import marshal
+import secrets
+import pstats
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+from cache import LRUCache
+
+# Sampled call stacks, or cProfile statistics of every call
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+
+# Profile of the current request, None when it isn't profiled. Copied to the pool threads with the context, so the
+# work a request does there is added to its profile
+current_profile: contextvars.ContextVar[Optional["Profile"]] = contextvars.ContextVar("profile", default=None)
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Profile:
+    """
+    Profile of one request across the request thread and the pool threads that work for it. In sample mode a background
+    thread records the stacks of those threads every interval, which costs the request almost nothing and includes the
+    time spent waiting for the network. In cprofile mode every thread runs its own cProfile, and the statistics are
+    merged when the request ends, which is exact but slows the profiled request down.
+    """
+
+    def __init__(self, mode: str, interval: float):
+        self.mode = mode
+        self.interval = interval
+        self.threads = {}
+        self.stacks = {}
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        if self.mode == SAMPLE:
+            self.sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    # Adds the work of the current thread to the profile, the stacks of the thread are sampled under the given name
+    @contextmanager
+    def thread(self, name: str) -> Iterator[None]:
+        ident = threading.get_ident()
+        profiler = cProfile.Profile() if self.mode == CPROFILE else None
+        with self.lock:
+            self.threads[ident] = name
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            with self.lock:
+                self.threads.pop(ident, None)
+                if profiler is not None:
+                    self.profiles.append(profiler)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                threads = dict(self.threads)
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    key = ";".join([name] + stack[::-1])
+                    with self.lock:
+                        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    # Collapsed stacks for flamegraph.pl or speedscope, or pstats data that can be loaded with pstats.Stats or snakeviz
+    def dump(self) -> bytes:
+        if self.mode == SAMPLE:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())).encode("utf-8")
+        stats = pstats.Stats(*self.profiles, stream=io.StringIO())
+        return marshal.dumps(stats.stats)
+
+def run_profiled(fn: Callable, *args, **kwargs) -> Any:
+    # For work the request hands to other threads. Unprofiled requests only pay for a context variable lookup
+    profile = current_profile.get()
+    if profile is None:
+        return fn(*args, **kwargs)
+    # Threads of a pool are named after it, so the stacks of all its threads are merged under one root
+    with profile.thread(threading.current_thread().name.rsplit("_", 1)[0]):
+        return fn(*args, **kwargs)
+
+class RequestProfiler:
+    """
+    Profiles single /ask and /chat requests, the ones that ask for it with the "profile" override, and a sample of all
+    others. Profiles are kept in memory, the most recent max_profiles of them, under a random id the server generates,
+    so profiles can't be looked up by an id the client chose or guessed. The app only honors the override and hands
+    out the id of a profile to admin clients.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, mode: str = SAMPLE, max_profiles: int = 100, interval: float = 0.005):
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+        self.profiles = LRUCache(max_profiles)
+        self.profiled = 0
+
+    # The override is true for the default mode, or the name of a mode
+    def requested_mode(self, overrides: dict[str, Any]) -> Optional[str]:
+        requested = overrides.get("profile")
+        if requested in (SAMPLE, CPROFILE):
+            return requested
+        if requested or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return self.mode
+        return None
+
+    # Yields the id the profile is stored under, or None when the request isn't profiled. The override is ignored
+    # unless allow_override is set
+    @contextmanager
+    def profile(self, overrides: dict[str, Any], allow_override: bool = True) -> Iterator[Optional[str]]:
+        mode = self.requested_mode(overrides if allow_override else {})
+        if mode is None:
+            yield None
+            return
+
+        profile_id = secrets.token_hex(16)
+        profile = Profile(mode, self.interval)
+        previous = current_profile.get()
+        current_profile.set(profile)
+        profile.start()
+        try:
+            with profile.thread("request"):
+                yield profile_id
+        finally:
+            profile.stop()
+            current_profile.set(previous)
+            self.profiles.set(profile_id, (mode, profile.dump()))
+            self.profiled += 1
+
+    # Mode and data of a profile, None if there is none or it was evicted
+    def get(self, profile_id: str) -> Optional[tuple[str, bytes]]:
+        return self.profiles.get(profile_id)
+
+    def stats(self) -> dict[str, Any]:
+        return {"sample_rate": self.sample_rate, "mode": self.mode, "profiled": self.profiled, "stored": len(self.profiles)}
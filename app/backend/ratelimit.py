@@ -0,0 +1,194 @@
+import math
+import time
+import asyncio
+import threading
+from typing import Any, Optional, Sequence
+import deadline
+from pool import PoolSaturated
+
+# Priorities of OpenAI calls, answer generation can use the whole quota while query rewrites leave a reserve for answers
+ANSWER = 0
+QUERY = 1
+
+class QuotaExhausted(PoolSaturated):
+    """
+    Raised when a call would have to wait longer than the rate limiter allows for quota. Handled like a saturated pool,
+    so the client gets a 429 with Retry-After.
+    """
+
+class TokenBucket:
+    """
+    Bucket that holds up to a minute of quota and refills continuously. A quota of 0 means unlimited.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, reserve: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        # Calls larger than the whole quota can't wait for more than a full bucket
+        required = min(amount + reserve * self.capacity, self.capacity)
+        return max(required - self.level, 0.0) / self.rate
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= amount
+
+class RateLimiter:
+    """
+    Client-side limiter for the requests-per-minute and tokens-per-minute quotas of the Azure OpenAI deployments, shared
+    by all approaches. Every call takes one request and its estimated tokens, the prompt plus max_tokens as Azure OpenAI
+    counts them, from two token buckets and waits until both have enough. Query rewrites leave ANSWER_RESERVE of the
+    quota for answer generation. When the service throttles anyway, the buckets are emptied and all calls wait for the
+    Retry-After time, so throttling doesn't turn into a storm of retries.
+    """
+
+    ANSWER_RESERVE = 0.2
+    DEFAULT_RETRY_AFTER = 10
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0, max_wait: float = 30):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_wait = max_wait
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.rejected = 0
+        self.throttles = 0
+        self.waiting = 0
+
+    def reserve(self, tokens: int, priority: int) -> float:
+        # Takes the quota and returns 0, or returns how long to wait before trying again
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            reserve = 0.0 if priority == ANSWER else self.ANSWER_RESERVE
+            wait = max(self.requests.wait_time(1, reserve), self.tokens.wait_time(tokens, reserve))
+            if wait > 0:
+                return wait
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.acquired += 1
+            return 0.0
+
+    def acquire(self, tokens: int, priority: int = ANSWER):
+        started = time.monotonic()
+        wait = self.reserve(tokens, priority)
+        if wait == 0:
+            return self.record_wait(started)
+        self.set_waiting(1)
+        try:
+            while wait > 0:
+                self.check_wait(started, wait)
+                time.sleep(wait)
+                wait = self.reserve(tokens, priority)
+        finally:
+            self.set_waiting(-1)
+        self.record_wait(started)
+
+    async def acquire_async(self, tokens: int, priority: int = ANSWER):
+        started = time.monotonic()
+        wait = self.reserve(tokens, priority)
+        if wait == 0:
+            return self.record_wait(started)
+        self.set_waiting(1)
+        try:
+            while wait > 0:
+                self.check_wait(started, wait)
+                await asyncio.sleep(wait)
+                wait = self.reserve(tokens, priority)
+        finally:
+            self.set_waiting(-1)
+        self.record_wait(started)
+
+    def set_waiting(self, change: int):
+        with self.lock:
+            self.waiting += change
+
+    # Whether calls are waiting for quota, or the service told us to back off
+    def queuing(self) -> bool:
+        with self.lock:
+            return self.waiting > 0 or time.monotonic() < self.blocked_until
+
+    # Waiting for quota counts against the deadline of the request, there is no point in waiting past it
+    def check_wait(self, started: float, wait: float):
+        left = deadline.remaining()
+        if left is not None and wait >= left:
+            with self.lock:
+                self.rejected += 1
+            raise deadline.DeadlineExceeded()
+        if time.monotonic() + wait - started > self.max_wait:
+            with self.lock:
+                self.rejected += 1
+            raise QuotaExhausted(math.ceil(wait))
+
+    def record_wait(self, started: float):
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self.lock:
+                self.waited += 1
+                self.wait_seconds += waited
+
+    def throttled(self, error: Exception):
+        # Called when the service answers 429 despite the limiter, e.g. when other clients share the deployment
+        retry_after = retry_after_seconds(error) or self.DEFAULT_RETRY_AFTER
+        with self.lock:
+            self.throttles += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.requests.level = min(self.requests.level, 0)
+            self.tokens.level = min(self.tokens.level, 0)
+
+    def headroom(self) -> dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "requests_per_minute": self.requests.capacity or None,
+                "tokens_per_minute": self.tokens.capacity or None,
+                "requests_available": math.floor(self.requests.level) if self.requests.capacity else None,
+                "tokens_available": math.floor(self.tokens.level) if self.tokens.capacity else None,
+                "requests_headroom": round(self.requests.level / self.requests.capacity, 3) if self.requests.capacity else 1.0,
+                "tokens_headroom": round(self.tokens.level / self.tokens.capacity, 3) if self.tokens.capacity else 1.0,
+                "blocked_for_ms": round(max(self.blocked_until - now, 0) * 1000)
+            }
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            **self.headroom(),
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "wait_ms_avg": round(self.wait_seconds * 1000 / self.waited) if self.waited else 0,
+            "rejected": self.rejected,
+            "throttled": self.throttles,
+            "waiting": self.waiting
+        }
+
+# Azure OpenAI counts roughly four characters per token when it estimates the tokens of a request for the quota
+def estimate_request_tokens(texts: Sequence[str], max_tokens: Optional[int]) -> int:
+    return sum(len(text) for text in texts) // 4 + (max_tokens or 0)
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+    except (TypeError, ValueError):
+        pass
+    return None
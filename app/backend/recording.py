@@ -0,0 +1,276 @@
+import os
+import re
+import json
+import time
+import hashlib
+import queue
+import random
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+import openai
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Recording of the current request, None when it isn't recorded. Copied to the pool threads with the context, so the
+# calls the approaches make there are added to it
+current_recording: contextvars.ContextVar[Optional["Recording"]] = contextvars.ContextVar("recording", default=None)
+
+# Personal data that customers type into questions. Numbers keep their length and separators, so the recorded questions
+# tokenize to about the same length. These patterns only catch e-mail addresses and numbers of six or more characters,
+# like phone, account and national id numbers, so they are all that is masked when recordings keep the raw text
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+NUMBER = re.compile(r"\+?\d[\d .-]{4,}\d")
+
+def anonymize(text: str) -> str:
+    text = EMAIL.sub("user@example.com", text)
+    return NUMBER.sub(lambda m: re.sub(r"\d", "0", m.group()), text)
+
+# Names, addresses and other personal data typed as words can't be told apart from the rest of the text by patterns, so
+# by default every word is replaced by a placeholder of the same length. Kept are the punctuation, the cited source
+# names, which come from the index, and the words of the formats the approaches parse in completions, so redacted
+# recordings replay the same steps. The placeholder of a word only depends on its length, so redacting is repeatable
+WORD = re.compile(r"[^\W\d_]+")
+CITATION = re.compile(r"\[[^\[\]]+\.\w{2,5}\]|<[^<>]+\.\w{2,5}>|\[https?://[^\[\]]+\]")
+KEPT_WORDS = {"Thought", "Action", "Input", "Observation", "Final", "Answer", "Question", "Search", "Lookup", "Finish", "CognitiveSearch", "action", "input", "json"}
+
+def redact(text: str) -> str:
+    text = anonymize(text)
+    parts, last = [], 0
+    for match in CITATION.finditer(text):
+        parts.append(redact_words(text[last:match.start()]))
+        parts.append(match.group())
+        last = match.end()
+    parts.append(redact_words(text[last:]))
+    return "".join(parts)
+
+def redact_words(text: str) -> str:
+    return WORD.sub(lambda m: m.group() if m.group() in KEPT_WORDS else ("lorem" * (len(m.group()) // 5 + 1))[:len(m.group())], text)
+
+def protect_value(value: Any, protect: Callable[[str], str]) -> Any:
+    if isinstance(value, str):
+        return protect(value)
+    if isinstance(value, list):
+        return [protect_value(v, protect) for v in value]
+    if isinstance(value, dict):
+        return {k: protect_value(v, protect) for k, v in value.items()}
+    return value
+
+# The question and history are redacted or anonymized, the approach and overrides are kept as they are
+def protect_body(body: dict[str, Any], protect: Callable[[str], str]) -> dict[str, Any]:
+    return {k: protect_value(v, protect) if k in ("question", "history") else v for k, v in body.items()}
+
+# Identifies a call by what was asked, so benchmarks/replay.py can answer a call with the response recorded for the same
+# query or prompt instead of the next one in order. The key is made from the redacted text, which is the same for the
+# original text and for its redacted or anonymized recording, so replayed calls match in both modes
+def call_key(text: str) -> str:
+    return hashlib.sha256(redact(text).encode("utf-8")).hexdigest()[:16]
+
+# The prompt of a chat or completion call, as the text the key is made from
+def request_text(kwargs: dict[str, Any]) -> str:
+    if "messages" in kwargs:
+        return "\n".join(message["content"] for message in kwargs["messages"])
+    prompt = kwargs.get("prompt")
+    return "\n".join(prompt) if isinstance(prompt, list) else prompt or ""
+
+# Search results hold caption objects, which are stored as their text
+def serializable_document(doc: dict[str, Any]) -> dict[str, Any]:
+    doc = dict(doc)
+    if doc.get("@search.captions"):
+        doc["@search.captions"] = [{"text": c.text} for c in doc["@search.captions"]]
+    return doc
+
+def completion_text(response) -> str:
+    choice = response["choices"][0] if response.get("choices") else {}
+    if "message" in choice:
+        return choice["message"].get("content") or ""
+    if "delta" in choice:
+        return choice["delta"].get("content") or ""
+    return choice.get("text") or ""
+
+class Recording:
+    """
+    What one request saw: its redacted body, the search results and OpenAI responses in the order they arrived, and the
+    time every call took. Every call is stored with the key of its query or prompt. With raw_text, the text of the body,
+    queries and responses is only anonymized instead. benchmarks/replay.py plays the recordings back against stand-ins
+    that return the same results after the same times.
+    """
+
+    def __init__(self, endpoint: str, body: dict[str, Any], raw_text: bool = False):
+        self.request_id = logs.request_id()
+        self.endpoint = endpoint
+        self.raw_text = raw_text
+        self.protect = anonymize if raw_text else redact
+        self.body = protect_body(body, self.protect)
+        self.started = time.time()
+        self.searches = []
+        self.completions = []
+        self.lock = threading.Lock()
+
+    def add_search(self, q: str, filter: Optional[str], top: Optional[int], documents: list[dict[str, Any]], seconds: float, cached: bool):
+        search = {"q": self.protect(q), "key": call_key(q), "filter": filter, "top": top, "documents": [serializable_document(doc) for doc in documents], "ms": round(seconds * 1000), "cached": cached}
+        with self.lock:
+            self.searches.append(search)
+
+    def add_completion(self, kind: str, key: str, text: str, usage: Optional[dict[str, int]], seconds: float, first_token_seconds: Optional[float] = None):
+        completion = {"kind": kind, "key": key, "text": self.protect(text), "usage": dict(usage) if usage else None, "ms": round(seconds * 1000),
+                      "first_token_ms": round(first_token_seconds * 1000) if first_token_seconds is not None else None}
+        with self.lock:
+            self.completions.append(completion)
+
+    # Streamed completions are recorded when the stream ends, with the time to the first chunk
+    def record_stream(self, kind: str, key: str, chunks: Iterator[Any], started: float) -> Iterator[Any]:
+        text, first_token = "", None
+        for chunk in chunks:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            text += completion_text(chunk)
+            yield chunk
+        self.add_completion(kind, key, text, None, time.perf_counter() - started, first_token)
+
+    async def record_stream_async(self, kind: str, key: str, chunks: AsyncIterator[Any], started: float) -> AsyncIterator[Any]:
+        text, first_token = "", None
+        async for chunk in chunks:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            text += completion_text(chunk)
+            yield chunk
+        self.add_completion(kind, key, text, None, time.perf_counter() - started, first_token)
+
+    def to_json(self, outcome: str, seconds: float) -> str:
+        with self.lock:
+            return json.dumps({
+                "request_id": self.request_id,
+                "endpoint": self.endpoint,
+                "started": self.started,
+                "ms": round(seconds * 1000),
+                "outcome": outcome,
+                "text": "raw" if self.raw_text else "redacted",
+                "body": self.body,
+                "searches": self.searches,
+                "completions": self.completions
+            }, default=str, ensure_ascii=False)
+
+def record_search(q: str, filter: Optional[str], top: Optional[int], documents: list[dict[str, Any]], seconds: float, cached: bool):
+    recording = current_recording.get()
+    if recording is not None:
+        recording.add_search(q, filter, top, documents, seconds, cached)
+
+def recorded(create: Callable, kind: str) -> Callable:
+    def call(*args, **kwargs):
+        recording = current_recording.get()
+        if recording is None:
+            return create(*args, **kwargs)
+        key = call_key(request_text(kwargs))
+        started = time.perf_counter()
+        response = create(*args, **kwargs)
+        if kwargs.get("stream"):
+            return recording.record_stream(kind, key, response, started)
+        recording.add_completion(kind, key, completion_text(response), response.get("usage"), time.perf_counter() - started)
+        return response
+    return call
+
+def recorded_async(acreate: Callable, kind: str) -> Callable:
+    async def call(*args, **kwargs):
+        recording = current_recording.get()
+        if recording is None:
+            return await acreate(*args, **kwargs)
+        key = call_key(request_text(kwargs))
+        started = time.perf_counter()
+        response = await acreate(*args, **kwargs)
+        if kwargs.get("stream"):
+            return recording.record_stream_async(kind, key, response, started)
+        recording.add_completion(kind, key, completion_text(response), response.get("usage"), time.perf_counter() - started)
+        return response
+    return call
+
+hooks_installed = False
+
+# The approaches call OpenAI directly and through langchain, which uses the same SDK classes, so the SDK calls are
+# wrapped once. Unrecorded requests only pay for a context variable lookup
+def install_openai_hooks():
+    global hooks_installed
+    if hooks_installed:
+        return
+    hooks_installed = True
+    openai.ChatCompletion.create = recorded(openai.ChatCompletion.create, "chat")
+    openai.Completion.create = recorded(openai.Completion.create, "completion")
+    openai.ChatCompletion.acreate = recorded_async(openai.ChatCompletion.acreate, "chat")
+    openai.Completion.acreate = recorded_async(openai.Completion.acreate, "completion")
+
+class TrafficRecorder:
+    """
+    Records a sample of the /ask and /chat requests to JSON lines files, one per day, for replaying production-shaped
+    load with benchmarks/replay.py. Questions, history, search queries and OpenAI responses are redacted before they are
+    stored, search results are stored as they are. Recordings are written by a background thread, so requests never wait
+    for the disk. Disabled without a directory. raw_text keeps the text with only e-mail addresses and long numbers
+    masked, and is only to be enabled where storing what customers type is allowed.
+    """
+
+    def __init__(self, directory: Optional[str] = None, sample_rate: float = 0.1, raw_text: bool = False):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.raw_text = raw_text
+        self.queue = queue.SimpleQueue()
+        self.writer = None
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.failed = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            install_openai_hooks()
+
+    @contextmanager
+    def record(self, endpoint: str, body: dict[str, Any]) -> Iterator[None]:
+        if not self.directory or random.random() >= self.sample_rate:
+            yield
+            return
+
+        recording = Recording(endpoint, body, self.raw_text)
+        previous = current_recording.get()
+        current_recording.set(recording)
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            current_recording.set(previous)
+            self.write(recording.to_json(outcome, time.perf_counter() - started))
+
+    def write(self, line: str):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_lines, name="recorder", daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+        self.queue.put(line)
+
+    def write_lines(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                return
+            try:
+                path = os.path.join(self.directory, f"traffic-{datetime.now(timezone.utc):%Y%m%d}.jsonl")
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                self.recorded += 1
+            except OSError:
+                self.failed += 1
+                logger.exception("Failed to write recording")
+
+    # Writes out what is still queued when the process exits
+    def flush(self):
+        self.queue.put(None)
+        self.writer.join(timeout=5)
+
+    def stats(self) -> dict[str, Any]:
+        return {"directory": self.directory, "sample_rate": self.sample_rate, "raw_text": self.raw_text, "recorded": self.recorded, "failed": self.failed}
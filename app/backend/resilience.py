@@ -0,0 +1,231 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Optional
+import openai.error
+import deadline
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from profiling import run_profiled
+from ratelimit import RateLimiter, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_OPENAI_ERRORS = (openai.error.Timeout, openai.error.APIError, openai.error.APIConnectionError, openai.error.TryAgain,
+                           openai.error.RateLimitError, openai.error.ServiceUnavailableError)
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, RETRYABLE_OPENAI_ERRORS):
+        return True
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    if isinstance(error, HttpResponseError):
+        return error.status_code in (408, 429, 500, 502, 503, 504)
+    return False
+
+class LatencyTracker:
+    """
+    Recent latencies of one kind of call, used to decide when a call is slow enough to hedge.
+    """
+
+    def __init__(self, size: int = 200):
+        self.latencies = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    # Calls from different threads count at the same time, so the counters are only changed under the lock
+    def count(self, counter: str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+    def stats(self) -> dict[str, Any]:
+        p50, p95 = self.quantile(0.5, 1), self.quantile(0.95, 1)
+        with self.lock:
+            counters = {"calls": self.calls, "retries": self.retries, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+        return {
+            **counters,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None
+        }
+
+class ResilientCaller:
+    """
+    Calls OpenAI and Cognitive Search with retries and optional hedging, used by all approaches. Failed calls that can
+    succeed on a second try (timeouts, throttling, 5xx) are retried with exponential backoff and full jitter, and the
+    Retry-After hint of the service is followed when there is one. With hedging, a second identical request is sent
+    when the first one has taken longer than the p95 latency of that kind of call, and whichever returns first is used.
+    Only the slowest few percent of calls are hedged, so the extra quota used is small. A call is not retried when the
+    wait would take it past the deadline of the request.
+    Calls given a quota take it from the rate limiter before every attempt, and the hedge delay and the latencies only
+    start once the limiter let the call through, so waiting for quota never looks like a slow call. No hedge is sent
+    while other calls are waiting for quota, or when the limiter can't let it through right away. A losing async call
+    is cancelled, while a losing sync call can't be interrupted in its thread and runs to completion.
+    """
+
+    def __init__(self, max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 20, hedge: bool = False, hedge_quantile: float = 0.95, hedge_min_samples: int = 20, hedge_workers: int = 64, rate_limiter: Optional[RateLimiter] = None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.rate_limiter = rate_limiter
+        self.trackers = {}
+        self.lock = threading.Lock()
+        # The threads only wait for responses, and a hedged call must never queue behind other calls
+        self.executor = ThreadPoolExecutor(hedge_workers, thread_name_prefix="hedge") if hedge else None
+
+    # quota is the estimated tokens and the priority of the call, for calls that have to be admitted by the rate limiter
+    def call(self, operation: str, fn: Callable, *args, hedge: bool = True, quota: Optional[tuple[int, int]] = None, **kwargs) -> Any:
+        tracker = self.tracker(operation)
+        tracker.count("calls")
+        attempt = 0
+        while True:
+            try:
+                if quota is not None and self.rate_limiter is not None:
+                    self.rate_limiter.acquire(*quota)
+                if self.hedge and hedge:
+                    return self.hedged_call(tracker, quota, fn, *args, **kwargs)
+                return self.timed_call(tracker, fn, *args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                logger.warning("Call failed, retrying", extra={"operation": operation, "delay_ms": round(delay * 1000), "error": str(e)})
+                tracker.count("retries")
+                attempt += 1
+                time.sleep(delay)
+
+    async def call_async(self, operation: str, fn: Callable[..., Awaitable[Any]], *args, hedge: bool = True, quota: Optional[tuple[int, int]] = None, **kwargs) -> Any:
+        tracker = self.tracker(operation)
+        tracker.count("calls")
+        attempt = 0
+        while True:
+            try:
+                if quota is not None and self.rate_limiter is not None:
+                    await self.rate_limiter.acquire_async(*quota)
+                if self.hedge and hedge:
+                    return await self.hedged_call_async(tracker, quota, fn, *args, **kwargs)
+                return await self.timed_call_async(tracker, fn, *args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                logger.warning("Call failed, retrying", extra={"operation": operation, "delay_ms": round(delay * 1000), "error": str(e)})
+                tracker.count("retries")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        if isinstance(error, openai.error.RateLimitError) and self.rate_limiter is not None:
+            self.rate_limiter.throttled(error)
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = min(retry_after, self.max_delay)
+        else:
+            # Full jitter, so clients that failed at the same time don't retry at the same time
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        left = deadline.remaining()
+        if left is not None and delay >= left:
+            return None
+        return delay
+
+    def timed_call(self, tracker: LatencyTracker, fn: Callable, *args, **kwargs) -> Any:
+        started = time.monotonic()
+        result = fn(*args, **kwargs)
+        tracker.record(time.monotonic() - started)
+        return result
+
+    async def timed_call_async(self, tracker: LatencyTracker, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        started = time.monotonic()
+        result = await fn(*args, **kwargs)
+        tracker.record(time.monotonic() - started)
+        return result
+
+    def hedged_call(self, tracker: LatencyTracker, quota: Optional[tuple[int, int]], fn: Callable, *args, **kwargs) -> Any:
+        hedge_after = tracker.quantile(self.hedge_quantile, self.hedge_min_samples)
+        if hedge_after is None:
+            return self.timed_call(tracker, fn, *args, **kwargs)
+
+        # The calls run in a copy of the caller's context, and a call that loses the race runs to completion in the background
+        primary = self.executor.submit(contextvars.copy_context().run, run_profiled, self.timed_call, tracker, fn, *args, **kwargs)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done or not self.can_hedge(quota):
+            return primary.result()
+
+        tracker.count("hedges")
+        secondary = self.executor.submit(contextvars.copy_context().run, run_profiled, self.timed_call, tracker, fn, *args, **kwargs)
+        pending = {primary, secondary}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = self.winner(done, pending, secondary, tracker)
+            if winner is not None:
+                return winner.result()
+
+    async def hedged_call_async(self, tracker: LatencyTracker, quota: Optional[tuple[int, int]], fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        hedge_after = tracker.quantile(self.hedge_quantile, self.hedge_min_samples)
+        if hedge_after is None:
+            return await self.timed_call_async(tracker, fn, *args, **kwargs)
+
+        primary = asyncio.ensure_future(self.timed_call_async(tracker, fn, *args, **kwargs))
+        done, _ = await asyncio.wait([primary], timeout=hedge_after)
+        if done or not self.can_hedge(quota):
+            return await primary
+
+        tracker.count("hedges")
+        secondary = asyncio.ensure_future(self.timed_call_async(tracker, fn, *args, **kwargs))
+        pending = {primary, secondary}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = self.winner(done, pending, secondary, tracker)
+                if winner is not None:
+                    return winner.result()
+        finally:
+            # Unlike threads, the losing request can really be cancelled
+            for task in pending:
+                task.cancel()
+
+    # A hedge takes its own quota, but never waits for it and never overtakes calls that are already waiting
+    def can_hedge(self, quota: Optional[tuple[int, int]]) -> bool:
+        if quota is None or self.rate_limiter is None:
+            return True
+        return not self.rate_limiter.queuing() and self.rate_limiter.reserve(*quota) == 0
+
+    # The first call that succeeded, or the failed one when no other call is left to wait for
+    def winner(self, done, pending, secondary, tracker: LatencyTracker):
+        succeeded = [f for f in done if f.exception() is None]
+        if succeeded:
+            if succeeded[0] is secondary:
+                tracker.count("hedge_wins")
+            return succeeded[0]
+        return None if pending else next(iter(done))
+
+    def tracker(self, operation: str) -> LatencyTracker:
+        with self.lock:
+            if operation not in self.trackers:
+                self.trackers[operation] = LatencyTracker()
+            return self.trackers[operation]
+
+    def stats(self) -> dict[str, Any]:
+        return {"hedge": self.hedge, "operations": {operation: tracker.stats() for operation, tracker in self.trackers.items()}}
@@ -0,0 +1,165 @@
+import re
+import json
+import zlib
+import threading
+import unicodedata
+import numpy as np
+import openai
+import deadline
+import usage
+from typing import Any, Optional
+from cache import IndexVersion
+from ratelimit import QUERY, RateLimiter, estimate_request_tokens
+from resilience import ResilientCaller
+
+# Frequent words of the languages customers ask in, to tell the language of a question without a language model.
+# Norwegian and Danish share most of them, the words that differ decide
+LANGUAGE_WORDS = {
+    "en": set("what which who how is are does do can my i you the a an of to in for with and or not insurance cover covered".split()),
+    "nb": set("hva hvilke hvem hvordan er gjelder kan min mitt mine jeg du en et av til i for med og eller ikke forsikring dekker dekket".split()),
+    "da": set("hvad hvilke hvem hvordan er gælder kan min mit mine jeg du en et af til i for med og eller ikke forsikring dækker dækket".split()),
+    "sv": set("vad vilka vem hur är gäller kan min mitt mina jag du en ett av till i för med och eller inte försäkring täcker".split()),
+    "de": set("was welche wer wie ist sind gilt kann mein meine ich du der die das ein eine von zu in für mit und oder nicht versicherung deckt".split()),
+    "es": set("qué que cuál quién cómo es son cubre puedo mi mis yo tú el la los las un una de a en para con y o no seguro cuánto".split()),
+    "fr": set("que quoi quel quelle qui comment est sont couvre puis mon ma mes je tu le la les un une de à en pour avec et ou pas assurance".split()),
+}
+
+# Language of a question, used in the key of cached answers, since the answer is given in the language of the question.
+# Questions in a script other than Latin are tagged with the script, Latin ones with the language whose frequent words
+# they use most, and questions without any of those words with "und"
+def question_language(question: str) -> str:
+    letters = [c for c in question if c.isalpha()]
+    scripts = {}
+    for c in letters:
+        script = unicodedata.name(c, "UNKNOWN").split(" ")[0]
+        scripts[script] = scripts.get(script, 0) + 1
+    script = max(scripts, key=scripts.get) if scripts else "LATIN"
+    if script != "LATIN":
+        return script.lower()
+    words = re.findall(r"\w+", question.lower())
+    scores = {language: sum(word in language_words for word in words) for language, language_words in LANGUAGE_WORDS.items()}
+    language = max(scores, key=scores.get)
+    return language if scores[language] > 0 else "und"
+
+class OpenAIEmbedder:
+    """
+    Embeds text with an Azure OpenAI embeddings deployment, e.g. text-embedding-ada-002. Like the completions, calls take
+    their quota from the shared rate limiter, are retried by the resilience layer, time out with the request deadline
+    and count in the token usage of the request.
+    """
+
+    TIMEOUT = 5
+
+    def __init__(self, deployment: str, rate_limiter: Optional[RateLimiter] = None, resilience: Optional[ResilientCaller] = None):
+        self.deployment = deployment
+        self.resilience = resilience or ResilientCaller(rate_limiter=rate_limiter)
+
+    def embed(self, text: str) -> np.ndarray:
+        tokens = estimate_request_tokens([text], None)
+        response = self.resilience.call("embedding", self.create_embedding, text, tokens, quota=(tokens, QUERY))
+        return np.array(response["data"][0]["embedding"], dtype=np.float32)
+
+    def create_embedding(self, text: str, tokens: int):
+        usage.check_budget(tokens)
+        response = openai.Embedding.create(engine=self.deployment, input=text, request_timeout=deadline.remaining(self.TIMEOUT))
+        usage.record_completion(self.deployment, response)
+        return response
+
+class HashingEmbedder:
+    """
+    Local stand-in for the embeddings deployment, so the semantic cache can be evaluated offline. Words and character
+    trigrams are hashed into a fixed number of dimensions, which makes queries sharing most of their words similar.
+    """
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode("utf-8")) % self.dimensions] += 1.0
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                vector[zlib.crc32(padded[i:i + 3].encode("utf-8")) % self.dimensions] += 0.5
+        return vector
+
+class SemanticCache:
+    """
+    Cache of answers keyed on the embedding of the generated search query, so paraphrased questions that lead to a
+    similar query get the cached answer. The embeddings are kept in a preallocated matrix with one row per entry, a
+    lookup is a single matrix-vector product. Entries only match if they were created with the same context (the
+    language of the question, the overrides that affect the answer and the index version), and the least recently used
+    entry is evicted when full.
+    """
+
+    def __init__(self, embedder, index_version: IndexVersion, threshold: float = 0.95, maxsize: int = 1000):
+        self.embedder = embedder
+        self.index_version = index_version
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.matrix = None
+        self.contexts = [None] * maxsize
+        self.values = [None] * maxsize
+        self.last_used = np.zeros(maxsize, dtype=np.int64)
+        self.size = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        index_version.on_change(lambda version: self.clear())
+
+    # Normalized embedding of a query, which callers can pass to get and then to set, so a miss embeds the query once
+    def embed(self, query: str) -> np.ndarray:
+        return self.normalize(self.embedder.embed(query))
+
+    def get(self, query: str, context: dict[str, Any], vector: Optional[np.ndarray] = None) -> Optional[tuple[float, Any]]:
+        vector = self.embed(query) if vector is None else vector
+        context_key = self.context_key(context)
+        with self.lock:
+            if self.size == 0:
+                self.misses += 1
+                return None
+            similarities = self.matrix[:self.size] @ vector
+            similarities[[c != context_key for c in self.contexts[:self.size]]] = -1
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.clock += 1
+            self.last_used[best] = self.clock
+            self.hits += 1
+            return float(similarities[best]), self.values[best]
+
+    def set(self, query: str, context: dict[str, Any], value: Any, vector: Optional[np.ndarray] = None):
+        vector = self.embed(query) if vector is None else vector
+        context_key = self.context_key(context)
+        with self.lock:
+            if self.matrix is None:
+                self.matrix = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+            if self.size < self.maxsize:
+                i = self.size
+                self.size += 1
+            else:
+                i = int(np.argmin(self.last_used))
+            self.clock += 1
+            self.matrix[i] = vector
+            self.contexts[i] = context_key
+            self.values[i] = value
+            self.last_used[i] = self.clock
+
+    def clear(self):
+        with self.lock:
+            self.size = 0
+            self.contexts = [None] * self.maxsize
+            self.values = [None] * self.maxsize
+            self.last_used[:] = 0
+
+    def context_key(self, context: dict[str, Any]) -> str:
+        return json.dumps([self.index_version.get(), context], sort_keys=True)
+
+    def normalize(self, vector: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def stats(self) -> dict[str, Any]:
+        return {"size": self.size, "maxsize": self.maxsize, "threshold": self.threshold, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,40 @@
+import functools
+from typing import Sequence
+import tiktoken
+
+# Tokens added by the chat format for every message, and for priming the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model)
+
+class TokenCounter:
+    """
+    Counts tokens with an encoder that is only built once per model, instead of once per call. The encoder is loaded on
+    first use, since tiktoken downloads it unless it is cached, so creating a counter never needs the network.
+    """
+
+    def __init__(self, model: str = "gpt-3.5-turbo"):
+        self.model = model
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        return get_encoding(self.model)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_batch(self, texts: Sequence[str]) -> list[int]:
+        return [len(tokens) for tokens in self.encoding.encode_batch(list(texts), disallowed_special=())]
+
+    def message_count(self, message: dict[str, str]) -> int:
+        return TOKENS_PER_MESSAGE + sum(self.count(value) for value in message.values())
+
+    def messages_count(self, messages: Sequence[dict[str, str]]) -> int:
+        return TOKENS_PER_REPLY + sum(self.message_count(message) for message in messages)
+
+# Generous estimate for short strings like source names, which aren't worth encoding
+def estimate_tokens(text: str) -> int:
+    return len(text) // 2 + 1
@@ -0,0 +1,245 @@
+import hmac
+import time
+import hashlib
+import secrets
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Iterator, Optional
+from cache import LRUCache
+from metrics import current_stage
+from pool import PoolSaturated
+
+# Stage of the OpenAI calls made by the langchain agents, one call per iteration of the agent
+AGENT_STEP = "agent_step"
+
+# Token usage of the current request, set by the route and copied to the pool threads with the context
+current_usage: contextvars.ContextVar[Optional["RequestUsage"]] = contextvars.ContextVar("usage", default=None)
+
+class TokenBudgetExceeded(PoolSaturated):
+    """
+    Raised before an OpenAI call when the request or its session has used up its token budget, which stops agents that
+    keep iterating. Handled like a saturated pool, the client gets a 429 with the time until the session budget resets.
+    """
+
+    def __init__(self, retry_after: int, message: str):
+        super().__init__(retry_after)
+        self.args = (message,)
+
+class RequestUsage:
+    """
+    Prompt and completion tokens of the OpenAI calls of one request, by stage. Streamed completions don't return a usage
+    block, their tokens are estimated and counted as such. Every call reserves its estimated tokens before it is made,
+    and the oldest reservation is released when the usage of a call is recorded, so calls made at the same time count
+    against the budgets before they return. Reservations of calls that never recorded usage end with the request.
+    """
+
+    def __init__(self, tracker: "UsageTracker", endpoint: str, approach: str, session_id: Optional[str]):
+        self.tracker = tracker
+        self.endpoint = endpoint
+        self.approach = approach
+        self.session_id = session_id
+        self.reservations = deque()
+        self.stages = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, deployment: Optional[str], prompt_tokens: int, completion_tokens: int, estimated: bool):
+        cost = self.tracker.cost(deployment, prompt_tokens, completion_tokens)
+        with self.lock:
+            usage = self.stages.setdefault(stage or "other", {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "estimated_calls": 0, "cost": 0.0})
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            usage["estimated_calls"] += int(estimated)
+            usage["cost"] += cost
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += cost
+            reserved = self.reservations.popleft() if self.reservations else 0
+            self.tracker.settle(self.session_id, prompt_tokens + completion_tokens, cost, reserved)
+
+    # Reserves the estimated tokens of a call, unless the request or its session already used or reserved its budget.
+    # Requests without a session only have the request budget
+    def check_budget(self, tokens: int = 0):
+        with self.lock:
+            if self.tracker.request_budget and self.prompt_tokens + self.completion_tokens + sum(self.reservations) >= self.tracker.request_budget:
+                raise TokenBudgetExceeded(1, f"Request used its budget of {self.tracker.request_budget} tokens")
+            self.tracker.reserve(self.session_id, tokens)
+            self.reservations.append(tokens)
+
+    def release(self):
+        with self.lock:
+            reserved = sum(self.reservations)
+            self.reservations.clear()
+        self.tracker.settle(self.session_id, 0, 0.0, reserved)
+
+def record(deployment: Optional[str], prompt_tokens: int, completion_tokens: int, estimated: bool = False, stage: Optional[str] = None):
+    usage = current_usage.get()
+    if usage is not None:
+        usage.add(stage or current_stage.get(), deployment, prompt_tokens, completion_tokens, estimated)
+
+def record_completion(deployment: Optional[str], completion):
+    usage = completion.get("usage") if completion is not None else None
+    if usage:
+        record(deployment, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+# Counts the chunks of a streamed completion, which carry about one token each, and records them when the stream ends
+def record_stream(deployment: Optional[str], chunks: Iterator[Any], estimated_prompt_tokens: int) -> Iterator[Any]:
+    stage = current_stage.get()
+    completion_tokens = 0
+    try:
+        for chunk in chunks:
+            completion_tokens += 1
+            yield chunk
+    finally:
+        record(deployment, estimated_prompt_tokens, completion_tokens, True, stage)
+
+async def record_stream_async(deployment: Optional[str], chunks: AsyncIterator[Any], estimated_prompt_tokens: int) -> AsyncIterator[Any]:
+    stage = current_stage.get()
+    completion_tokens = 0
+    try:
+        async for chunk in chunks:
+            completion_tokens += 1
+            yield chunk
+    finally:
+        record(deployment, estimated_prompt_tokens, completion_tokens, True, stage)
+
+def check_budget(tokens: int = 0):
+    usage = current_usage.get()
+    if usage is not None:
+        usage.check_budget(tokens)
+
+class SessionIds:
+    """
+    Session ids issued by the server, a random id and its HMAC signed with the secret, so clients can't choose the
+    session their tokens count against. Instances that share the secret accept each other's ids, without a secret
+    every process signs with its own random one.
+    """
+
+    def __init__(self, secret: Optional[str] = None):
+        self.secret = (secret or secrets.token_hex(32)).encode("utf-8")
+
+    def issue(self) -> str:
+        session_id = secrets.token_hex(8)
+        return f"{session_id}.{self.sign(session_id)}"
+
+    # The session id of a token issued by this server, None for missing, malformed or forged tokens
+    def verify(self, token: Optional[str]) -> Optional[str]:
+        session_id, _, signature = (token or "").partition(".")
+        if not session_id or not hmac.compare_digest(signature, self.sign(session_id)):
+            return None
+        return session_id
+
+    def sign(self, session_id: str) -> str:
+        return hmac.new(self.secret, session_id.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+class UsageTracker:
+    """
+    Token usage and cost of the OpenAI calls, summed per approach, per stage of every approach and per session, served
+    on /usage. Prices are per 1000 prompt and completion tokens of every deployment. Sessions can be given a token
+    budget, checked before every OpenAI call, and single requests too. Sessions count the tokens of every call as it
+    is recorded, and the tokens reserved by calls in flight. A session is forgotten, and its budget reset, session_ttl
+    seconds after its last call.
+    """
+
+    TOP_SESSIONS = 10
+
+    def __init__(self, prices: Optional[dict[str, tuple[float, float]]] = None, session_budget: int = 0, request_budget: int = 0, session_ttl: float = 3600, max_sessions: int = 10000):
+        self.prices = prices or {}
+        self.session_budget = session_budget
+        self.request_budget = request_budget
+        self.session_ttl = session_ttl
+        self.sessions = LRUCache(max_sessions, session_ttl)
+        self.approaches = {}
+        self.lock = threading.Lock()
+        self.budget_exceeded = 0
+
+    def cost(self, deployment: Optional[str], prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.prices.get(deployment, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    # Reserves tokens for a call of the session, unless its budget is used or reserved by the calls of its other requests
+    def reserve(self, session_id: Optional[str], tokens: int):
+        if not session_id:
+            return
+        with self.lock:
+            session = self.sessions.get(session_id) or {"started": time.time(), "requests": 0, "tokens": 0, "reserved": 0, "cost": 0.0}
+            if self.session_budget and session["tokens"] + session["reserved"] >= self.session_budget:
+                raise TokenBudgetExceeded(round(self.session_ttl), f"Session used its budget of {self.session_budget} tokens")
+            session["reserved"] += tokens
+            self.sessions.set(session_id, session)
+
+    # Adds the tokens used by a call to its session and releases the tokens it reserved
+    def settle(self, session_id: Optional[str], tokens: int, cost: float, reserved: int):
+        if not session_id:
+            return
+        with self.lock:
+            session = self.sessions.get(session_id) or {"started": time.time(), "requests": 0, "tokens": 0, "reserved": 0, "cost": 0.0}
+            session["tokens"] += tokens
+            session["reserved"] = max(0, session["reserved"] - reserved)
+            session["cost"] += cost
+            self.sessions.set(session_id, session)
+
+    @contextmanager
+    def request(self, endpoint: str, approach: str, session_id: Optional[str] = None) -> Iterator[RequestUsage]:
+        usage = RequestUsage(self, endpoint, approach or "", session_id)
+        previous = current_usage.get()
+        current_usage.set(usage)
+        started = time.perf_counter()
+        try:
+            yield usage
+        except TokenBudgetExceeded:
+            with self.lock:
+                self.budget_exceeded += 1
+            raise
+        finally:
+            current_usage.set(previous)
+            usage.release()
+            self.add(usage, time.perf_counter() - started)
+
+    def add(self, usage: RequestUsage, seconds: float):
+        with self.lock:
+            totals = self.approaches.setdefault((usage.endpoint, usage.approach), {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "seconds": 0.0, "stages": {}})
+            totals["requests"] += 1
+            totals["prompt_tokens"] += usage.prompt_tokens
+            totals["completion_tokens"] += usage.completion_tokens
+            totals["cost"] += usage.cost
+            totals["seconds"] += seconds
+            for stage, stage_usage in usage.stages.items():
+                stage_totals = totals["stages"].setdefault(stage, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "estimated_calls": 0, "cost": 0.0})
+                for key, value in stage_usage.items():
+                    stage_totals[key] += value
+
+            if usage.session_id:
+                session = self.sessions.get(usage.session_id) or {"started": time.time(), "requests": 0, "tokens": 0, "reserved": 0, "cost": 0.0}
+                session["requests"] += 1
+                self.sessions.set(usage.session_id, session)
+
+    def summary(self) -> dict[str, Any]:
+        with self.lock:
+            approaches = {}
+            for (endpoint, approach), totals in sorted(self.approaches.items()):
+                requests = totals["requests"]
+                approaches[f"{endpoint}/{approach}"] = {
+                    "requests": requests,
+                    "prompt_tokens": totals["prompt_tokens"],
+                    "completion_tokens": totals["completion_tokens"],
+                    "cost": round(totals["cost"], 4),
+                    "tokens_per_request": round((totals["prompt_tokens"] + totals["completion_tokens"]) / requests),
+                    "cost_per_request": round(totals["cost"] / requests, 5),
+                    "latency_ms_avg": round(totals["seconds"] * 1000 / requests),
+                    "stages": {stage: {**stage_totals, "cost": round(stage_totals["cost"], 4)} for stage, stage_totals in totals["stages"].items()}
+                }
+            sessions = sorted(self.sessions.items(), key=lambda s: s[1]["tokens"], reverse=True)
+            return {
+                "approaches": approaches,
+                "sessions": len(sessions),
+                "top_sessions": [{"session_id": session_id, **{**session, "cost": round(session["cost"], 4)}} for session_id, session in sessions[:self.TOP_SESSIONS]],
+                "session_budget": self.session_budget or None,
+                "request_budget": self.request_budget or None,
+                "budget_exceeded": self.budget_exceeded
+            }
@@ -0,0 +1,133 @@
+import html
+import time
+import random
+import argparse
+from azure.ai.formrecognizer import AnalyzeResult, BoundingRegion, DocumentPage, DocumentSpan, DocumentTable, DocumentTableCell
+from documenttext import get_document_text_from_analysis_result
+
+# Benchmark of building the page texts of a document analyzed by Form Recognizer, against a copy of the implementation
+# that marked the table spans one character at a time and filtered all tables for every page. Both must produce the same
+# pages, on synthetic documents with many and large tables, tables that continue on the next page and overlapping spans.
+# Run from scripts: python -m benchmarks.analysis --pages 500 --tables 8
+
+WORDS = "the insurance covers damage to the house caused by fire water storm theft and vandalism up to the insured amount".split()
+
+# Page texts as they were built before, copied from prepdocs.py
+def old_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+def old_get_document_text_from_analysis_result(result):
+    offset = 0
+    page_map = []
+    for page_num, page in enumerate(result.pages):
+        tables_on_page = [table for table in result.tables if table.bounding_regions[0].page_number == page_num + 1]
+
+        # mark all positions of the table spans in the page
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1]*page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                # replace all table spans with "table_id" in table_chars array
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >=0 and idx < page_length:
+                        table_chars[idx] = table_id
+
+        # build page text by replacing charcters in table spans with table html
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                page_text += result.content[page_offset + idx]
+            elif not table_id in added_tables:
+                page_text += old_table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+
+        page_text += " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+
+    return page_map
+
+def words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+def make_table(rng, page_number, offset, rows, columns):
+    cells = [DocumentTableCell(kind="columnHeader" if row == 0 else "content", row_index=row, column_index=column, row_span=1, column_span=2 if rng.random() < 0.05 else 1,
+                               content=f"{words(rng, 2)} <{row}&{column}>") for row in range(rows) for column in range(columns)]
+    rng.shuffle(cells)
+    text = " ".join(cell.content for cell in cells)
+    # Tables are mostly one span, sometimes split in two with text of the table in between
+    if rng.random() < 0.2:
+        middle = len(text) // 2
+        spans = [DocumentSpan(offset=offset, length=middle), DocumentSpan(offset=offset + middle + 1, length=len(text) - middle - 1)]
+    else:
+        spans = [DocumentSpan(offset=offset, length=len(text))]
+    return DocumentTable(row_count=rows, column_count=columns, cells=cells, spans=spans, bounding_regions=[BoundingRegion(page_number=page_number, polygon=[])]), text
+
+# A document of pages with text between tables of various sizes. Some tables run past the end of their page, and some
+# spans overlap the table before them, which the old implementation resolved by letting the later table win
+def synthetic_result(pages, tables_per_page, seed):
+    rng = random.Random(seed)
+    content = []
+    length = 0
+    result_pages, tables = [], []
+    for page_number in range(1, pages + 1):
+        page_start = length
+        for _ in range(rng.randint(0, 2 * tables_per_page)):
+            text = words(rng, rng.randint(20, 200)) + " "
+            content.append(text)
+            length += len(text)
+            table, text = make_table(rng, page_number, length, rng.choice([2, 5, 20, 60]), rng.randint(2, 6))
+            if rng.random() < 0.05 and tables and tables[-1].bounding_regions[0].page_number == page_number:
+                table.spans.append(DocumentSpan(offset=tables[-1].spans[0].offset + 3, length=10))
+            tables.append(table)
+            content.append(text + " ")
+            length += len(text) + 1
+        text = words(rng, rng.randint(50, 300))
+        content.append(text)
+        length += len(text)
+        page_length = length - page_start
+        if tables and rng.random() < 0.1:
+            # The last table continues beyond the page
+            page_length -= min(page_length // 2, 40)
+        result_pages.append(DocumentPage(page_number=page_number, spans=[DocumentSpan(offset=page_start, length=page_length)]))
+    rng.shuffle(tables)
+    return AnalyzeResult(content="".join(content), pages=result_pages, tables=tables)
+
+def timed(f, result):
+    start = time.perf_counter()
+    page_map = f(result)
+    return page_map, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare building the page texts of analyzed documents with the implementation it replaced")
+    parser.add_argument("--pages", type=int, default=500, help="Number of pages of the largest synthetic document")
+    parser.add_argument("--tables", type=int, default=8, help="Average number of tables per page")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'tables':>7} {'chars':>10} {'before ms':>10} {'after ms':>10} {'speedup':>9}")
+    for pages in sorted({10, 100, args.pages}):
+        if pages > args.pages:
+            continue
+        result = synthetic_result(pages, args.tables, args.seed)
+        old_page_map, old_seconds = timed(old_get_document_text_from_analysis_result, result)
+        new_page_map, new_seconds = timed(get_document_text_from_analysis_result, result)
+        if new_page_map != old_page_map:
+            mismatch = next(i for i, (a, b) in enumerate(zip(old_page_map, new_page_map)) if a != b)
+            raise AssertionError(f"Page {mismatch} of the {pages} page document differs")
+        print(f"{pages:>6} {len(result.tables):>7} {len(result.content):>10} {old_seconds * 1000:>10.1f} {new_seconds * 1000:>10.1f} {old_seconds / max(new_seconds, 1e-9):>8.1f}x")
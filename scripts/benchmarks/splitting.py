@@ -0,0 +1,176 @@
+import os
+import glob
+import time
+import random
+import argparse
+from pypdf import PdfReader
+from textsplitter import MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP, split_text
+
+# Benchmark of the chunking done by prepdocs, against a copy of the implementation that scanned the text one character
+# at a time and the page map once per section. Both must produce the same sections, on a synthetic document with tables
+# and empty pages, and on the bundled PDFs read with pypdf as with --localpdfparser.
+# With --tokens, also compares how sections split by characters and by tokens pack into the source budget of the chat
+# prompt: the search returns TOP sections, and the app keeps them until the budget is used up.
+# Run from scripts: python -m benchmarks.splitting --pages 2000 --tokens
+# The speedup grows with the length of the document and depends on the machine. On 2000 synthetic pages, three runs on
+# one vCPU of an Intel Xeon with Python 3.11.7 took 1209-1325 ms before and 94-108 ms after, 12.2x to 13.3x, and
+# another machine measured 1487 ms and 153 ms, 9.7x. Expect about 10x, not a fixed number
+
+WORDS = "the insurance covers damage to the house caused by fire water storm theft and vandalism up to the insured amount per claim".split()
+
+# Chunking as it was done before, copied from prepdocs.py
+def old_split_text(page_map, verbose=False):
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        l = len(page_map)
+        for i in range(l - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return l - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+            # If last table starts inside SECTION_OVERLAP, keep overlapping
+            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+        
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 25))]
+    if rng.random() < 0.2:
+        words.insert(rng.randint(0, len(words)), f"({rng.choice(WORDS)}, {rng.randint(1, 999)})")
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "!", "?", ":", ""])
+
+def table(rng):
+    rows = rng.choice([2, 5, 40])
+    cells = "".join("<tr>" + "".join(f"<td>{rng.choice(WORDS)} {rng.randint(1, 9999)}</td>" for _ in range(4)) + "</tr>" for _ in range(rows))
+    return f"<table>{cells}</table>"
+
+# Pages of prose with tables of various lengths, some longer than a section, and an empty page now and then
+def synthetic_page_map(pages, seed):
+    rng = random.Random(seed)
+    page_map = []
+    offset = 0
+    for page_num in range(pages):
+        parts = []
+        if rng.random() > 0.02:
+            for _ in range(rng.randint(10, 40)):
+                parts.append(table(rng) if rng.random() < 0.05 else sentence(rng))
+        page_text = " ".join(parts) + " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+def pdf_page_map(filename):
+    page_map = []
+    offset = 0
+    for page_num, p in enumerate(PdfReader(filename).pages):
+        page_text = p.extract_text()
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+def timed(f, page_map):
+    start = time.perf_counter()
+    sections = list(f(page_map))
+    return sections, time.perf_counter() - start
+
+def compare(name, page_map):
+    old_sections, old_seconds = timed(old_split_text, page_map)
+    new_sections, new_seconds = timed(split_text, page_map)
+    if new_sections != old_sections:
+        mismatch = next(i for i, (a, b) in enumerate(zip(old_sections + [None], new_sections + [None])) if a != b)
+        raise AssertionError(f"{name}: sections differ from section {mismatch}")
+    print(f"{name:<32} {len(page_map):>6} {len(old_sections):>8} {old_seconds * 1000:>10.1f} {new_seconds * 1000:>10.1f} {old_seconds / max(new_seconds, 1e-9):>8.1f}x")
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+# The chat approach with its default settings: sections of the best results are kept until MAXIMUM_SOURCE_TOKENS
+TOP = 10
+MAXIMUM_SOURCE_TOKENS = 5000
+
+def pack(section_tokens, rng, requests):
+    kept, prompt_tokens = [], []
+    for _ in range(requests):
+        total, count = 0, 0
+        for tokens in rng.sample(section_tokens, min(TOP, len(section_tokens))):
+            if total + tokens + 1 > MAXIMUM_SOURCE_TOKENS:
+                break
+            total += tokens + 1
+            count += 1
+        kept.append(count)
+        prompt_tokens.append(total)
+    return kept, prompt_tokens
+
+def compare_packing(page_map, encoding, seed):
+    print(f"\n{'mode':<12} {'sections':>8} {'p50 tok':>8} {'p95 tok':>8} {'max tok':>8} {'kept':>6} {'dropped':>8} {'prompt p5':>10} {'prompt p95':>11}")
+    for mode, sections in (("characters", split_text(page_map)), ("tokens", split_text(page_map, encoding=encoding))):
+        # Counted like content_token_count in prepdocs, with the description prefix
+        section_tokens = [len(encoding.encode(f"This sections is about insurance. {text}".replace("\n", " "), disallowed_special=())) for text, _ in sections]
+        kept, prompt_tokens = pack(section_tokens, random.Random(seed), 1000)
+        print(f"{mode:<12} {len(section_tokens):>8} {percentile(section_tokens, 0.5):>8} {percentile(section_tokens, 0.95):>8} {max(section_tokens):>8} "
+              f"{sum(kept) / len(kept):>6.1f} {TOP - sum(kept) / len(kept):>8.1f} {percentile(prompt_tokens, 0.05):>10} {percentile(prompt_tokens, 0.95):>11}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the chunking of prepdocs with the implementation it replaced")
+    parser.add_argument("--pages", type=int, default=2000, help="Number of pages of the synthetic document")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokens", action="store_true", help="Compare how sections split by characters and by tokens fill the prompt, requires the tiktoken encoding")
+    parser.add_argument("--pdfs", default=os.path.join(os.path.dirname(__file__), "..", "..", "data", "*.pdf"), help="PDFs to compare the sections of")
+    args = parser.parse_args()
+
+    print(f"{'document':<32} {'pages':>6} {'sections':>8} {'before ms':>10} {'after ms':>10} {'speedup':>9}")
+    for filename in sorted(glob.glob(args.pdfs)):
+        compare(os.path.basename(filename), pdf_page_map(filename))
+    for pages in sorted({100, 500, args.pages}):
+        if pages <= args.pages:
+            compare("synthetic", synthetic_page_map(pages, args.seed))
+
+    if args.tokens:
+        import tiktoken
+        compare_packing(synthetic_page_map(args.pages, args.seed), tiktoken.encoding_for_model("gpt-3.5-turbo"), args.seed)
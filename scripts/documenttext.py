@@ -0,0 +1,86 @@
+import html
+import heapq
+from collections import defaultdict
+from typing import Iterator
+from azure.ai.formrecognizer import AnalyzeResult, DocumentTable
+
+def table_to_html(table: DocumentTable) -> str:
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    table_html = ["<table>"]
+    for row_cells in rows:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
+
+# Splits a page into consecutive segments of text and of tables, as (start, end, table_id) with -1 for text. Where the
+# spans of tables overlap, the table that comes last on the page owns the characters
+def page_segments(spans: list[tuple[int, int, int]], page_length: int) -> Iterator[tuple[int, int, int]]:
+    starts, ends = defaultdict(list), defaultdict(list)
+    for start, end, table_id in spans:
+        starts[start].append(table_id)
+        ends[end].append(table_id)
+    points = sorted({0, page_length, *starts, *ends})
+    active = defaultdict(int)
+    covering = []
+    for start, end in zip(points, points[1:]):
+        for table_id in starts.get(start, ()):
+            active[table_id] += 1
+            heapq.heappush(covering, -table_id)
+        for table_id in ends.get(start, ()):
+            active[table_id] -= 1
+        while covering and active[-covering[0]] == 0:
+            heapq.heappop(covering)
+        yield start, end, -covering[0] if covering else -1
+
+def get_document_text_from_analysis_result(result: AnalyzeResult):
+    """
+    Text of every page of an analyzed document, with the tables on the page replaced by their HTML where their first
+    span starts, as (page index, offset, text) with the offset of the page in the text of the whole document. Tables are
+    grouped by page once, and every page is built from its slices of text and tables with one join.
+    """
+    tables_by_page = defaultdict(list)
+    for table in result.tables:
+        tables_by_page[table.bounding_regions[0].page_number].append(table)
+
+    offset = 0
+    page_map = []
+    for page_num, page in enumerate(result.pages):
+        tables_on_page = tables_by_page.get(page_num + 1, [])
+
+        # spans of the tables on the page, relative to the page and cut off at its edges
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        spans = []
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                start = max(span.offset - page_offset, 0)
+                end = min(span.offset - page_offset + span.length, page_length)
+                if start < end:
+                    spans.append((start, end, table_id))
+
+        # build page text by replacing the table spans with table html
+        parts = []
+        added_tables = set()
+        for start, end, table_id in page_segments(spans, page_length):
+            if table_id == -1:
+                parts.append(result.content[page_offset + start:page_offset + end])
+            elif not table_id in added_tables:
+                parts.append(table_to_html(tables_on_page[table_id]))
+                added_tables.add(table_id)
+
+        parts.append(" ")
+        page_text = "".join(parts)
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+
+    return page_map
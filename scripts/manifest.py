@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Iterable, Optional
+
+def content_hash(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def section_hash(section: dict[str, Any]) -> str:
+    return content_hash(json.dumps(section, sort_keys=True, ensure_ascii=False))
+
+class Manifest:
+    """
+    Content hashes of the sources prepdocs has indexed, and of every section they were split into, kept in a local JSON
+    file. Sources whose content hasn't changed are skipped without being analyzed, and of the others only the sections
+    that changed are uploaded, while sections that are no longer produced are deleted by id. A source is only marked as
+    indexed when all its sections were, so failed uploads are retried on the next run.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.sources = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.sources = json.load(f).get("sources") or {}
+
+    def source(self, source: str) -> dict[str, Any]:
+        with self.lock:
+            return dict(self.sources.get(source) or {})
+
+    def unchanged(self, source: str, hash: str) -> bool:
+        with self.lock:
+            return (self.sources.get(source) or {}).get("hash") == hash
+
+    # Sections of a changed source that have to be uploaded, all of them with force, and ids of its sections that no
+    # longer exist
+    def diff_sections(self, source: str, sections: Iterable[dict[str, Any]], force: bool = False) -> tuple[list[tuple[dict[str, Any], str]], list[str]]:
+        with self.lock:
+            indexed = dict((self.sources.get(source) or {}).get("sections") or {})
+        changed, ids = [], set()
+        for section in sections:
+            hash = section_hash(section)
+            ids.add(section["id"])
+            if force or indexed.get(section["id"]) != hash:
+                changed.append((section, hash))
+        return changed, [id for id in indexed if id not in ids]
+
+    def set_sections(self, source: str, hashes: dict[str, str]):
+        with self.lock:
+            self.sources.setdefault(source, {}).setdefault("sections", {}).update(hashes)
+
+    def remove_sections(self, source: str, ids: Iterable[str]):
+        with self.lock:
+            sections = self.sources.get(source, {}).get("sections") or {}
+            for id in ids:
+                sections.pop(id, None)
+
+    # Marks a source as indexed, with the validators of the response it was downloaded with
+    def set_source(self, source: str, hash: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        with self.lock:
+            entry = self.sources.setdefault(source, {})
+            entry.update({"hash": hash, "etag": etag, "last_modified": last_modified})
+
+    def remove_source(self, source: str):
+        with self.lock:
+            self.sources.pop(source, None)
+
+    def clear(self):
+        with self.lock:
+            self.sources = {}
+
+    # Sources that were indexed before but aren't part of this run, with the ids of their sections
+    def removed_sources(self, sources: Iterable[str]) -> dict[str, list[str]]:
+        sources = set(sources)
+        with self.lock:
+            return {source: list((entry.get("sections") or {}).keys()) for source, entry in self.sources.items() if source not in sources}
+
+    # Written to a temporary file first, so an interrupted run never leaves a broken manifest behind
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps({"sources": self.sources}, indent=1, sort_keys=True, ensure_ascii=False)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,138 @@
+import time
+import queue
+import threading
+import traceback
+from typing import Any, Callable, Iterable, Optional
+
+# Put in the queue of a stage once for every worker when all its producers are done
+DONE = object()
+
+class Stage:
+    """
+    Workers that take items from a bounded queue and process them. Every item can produce any number of items for the
+    next stage, which block when its queue is full, so a slow stage holds back the stages before it instead of letting
+    work pile up in memory. Failed items are reported and counted, they don't stop the pipeline.
+    """
+
+    def __init__(self, name: str, process: Callable[[Any], Optional[Iterable[Any]]], workers: int, queue_size: int, next_stage: Optional["Stage"] = None, describe: Callable[[Any], str] = str):
+        self.name = name
+        self.process = process
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(queue_size)
+        self.next_stage = next_stage
+        self.describe = describe
+        self.producers = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.work, name=f"{self.name}_{i}", daemon=True) for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item: Any):
+        self.queue.put(item)
+
+    # Called by every producer when it is done, the workers stop when the last one is
+    def close(self):
+        with self.lock:
+            self.producers -= 1
+            done = self.producers == 0
+        if done:
+            for _ in range(self.workers):
+                self.queue.put(DONE)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is DONE:
+                break
+            started = time.perf_counter()
+            try:
+                for output in self.process(item) or ():
+                    # Time spent waiting for room in the next stage isn't work of this stage
+                    waiting = time.perf_counter()
+                    self.next_stage.put(output)
+                    started += time.perf_counter() - waiting
+                with self.lock:
+                    self.processed += 1
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                print(f"Error in stage {self.name} processing {self.describe(item)}:\n{traceback.format_exc()}")
+            with self.lock:
+                self.busy += time.perf_counter() - started
+        if self.next_stage is not None:
+            self.next_stage.close()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+class Pipeline:
+    """
+    Stages that run concurrently, every one with its own workers, connected by bounded queues. Items are fed to the
+    stages that no other stage produces for. The total time is bound by the slowest stage rather than the sum of all of
+    them, and the report shows which stage that is: the one whose workers were busy for the largest share of the time.
+    """
+
+    def __init__(self, stages: list[Stage], progress_interval: float = 10, count: Optional[Callable[[], tuple[str, int]]] = None):
+        self.stages = stages
+        self.progress_interval = progress_interval
+        self.count = count
+        for stage in stages:
+            if stage.next_stage is not None:
+                stage.next_stage.producers += stage.workers
+        self.stopped = threading.Event()
+        self.started = None
+
+    # Feeds every item to the stages route returns for it, and waits until all stages are done. Returns the number of
+    # items that failed in any stage
+    def run(self, items: Iterable[Any], route: Callable[[Any], Iterable[Stage]]) -> int:
+        fed = [stage for stage in self.stages if stage.producers == 0]
+        for stage in fed:
+            stage.producers += 1
+        self.started = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        reporter = threading.Thread(target=self.report_progress, name="progress", daemon=True)
+        reporter.start()
+
+        for item in items:
+            for stage in route(item):
+                stage.put(item)
+        for stage in fed:
+            stage.close()
+        for stage in self.stages:
+            stage.join()
+
+        self.stopped.set()
+        reporter.join()
+        self.print_report()
+        return sum(stage.failed for stage in self.stages)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report_progress(self):
+        while not self.stopped.wait(self.progress_interval):
+            stages = ", ".join(f"{stage.name} {stage.processed} done {stage.queue.qsize()} queued" for stage in self.stages)
+            print(f"[{self.elapsed():.0f}s] {stages}{self.count_text()}")
+
+    def count_text(self) -> str:
+        if self.count is None:
+            return ""
+        name, count = self.count()
+        return f", {count} {name} ({count / max(self.elapsed(), 1e-9):.1f}/s)"
+
+    def print_report(self):
+        elapsed = self.elapsed()
+        print(f"Finished in {elapsed:.1f}s{self.count_text()}")
+        print(f"{'stage':<10} {'workers':>7} {'items':>6} {'failed':>6} {'items/s':>8} {'busy':>6}")
+        for stage in self.stages:
+            # Share of the time the workers of the stage were busy, the stage closest to 100% limits the pipeline
+            busy = stage.busy / (elapsed * stage.workers) if elapsed > 0 else 0
+            print(f"{stage.name:<10} {stage.workers:>7} {stage.processed:>6} {stage.failed:>6} {stage.processed / max(elapsed, 1e-9):>8.2f} {busy:>6.0%}")
@@ -1,10 +1,13 @@
 import os
+import sys
 import argparse
 import glob
-import html
 import io
+import json
 import re
 import time
+import threading
+import tiktoken
 from pypdf import PdfReader, PdfWriter
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
@@ -13,12 +16,21 @@ from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import *
 from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 from bs4 import BeautifulSoup
+from documenttext import get_document_text_from_analysis_result
+from manifest import Manifest, content_hash
+from pipeline import Pipeline, Stage
+from textsplitter import MAX_SECTION_TOKENS, SECTION_OVERLAP_TOKENS, SENTENCE_SEARCH_TOKENS, split_text
 
-MAX_SECTION_LENGTH = 1000
-SENTENCE_SEARCH_LIMIT = 100
-SECTION_OVERLAP = 100
+# Files are split into sections measured in characters, or in tokens so that they fill the prompts of the app predictably
+CHARACTERS = "characters"
+TOKENS = "tokens"
+
+# The token count of every section is stored in the index, so the app can fill its prompts without encoding the sources
+TOKENS_FIELD = "tokens"
+encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
 parser = argparse.ArgumentParser(
     description="Prepare documents by extracting content from PDFs, splitting content into sections, uploading to blob storage, and indexing in a search index.",
@@ -32,13 +44,23 @@ parser.add_argument("--container", help="Azure Blob Storage container name")
 parser.add_argument("--storagekey", required=False, help="Optional. Use this Azure Blob Storage account key instead of the current user identity to login (use az login to set current user for Azure)")
 parser.add_argument("--tenantid", required=False, help="Optional. Use this to define the Azure directory where to authenticate)")
 parser.add_argument("--searchservice", help="Name of the Azure Cognitive Search service where content should be indexed (must exist already)")
-parser.add_argument("--index", help="Name of the Azure Cognitive Search index where content should be indexed (will be created if it doesn't exist)")
+parser.add_argument("--index", help="Name of the Azure Cognitive Search index where content should be indexed (will be created if it doesn't exist, an existing index without the tokens field gets it added in place)")
 parser.add_argument("--searchkey", required=False, help="Optional. Use this Azure Cognitive Search account key instead of the current user identity to login (use az login to set current user for Azure)")
 parser.add_argument("--remove", action="store_true", help="Remove references to this document from blob storage and the search index")
 parser.add_argument("--removeall", action="store_true", help="Remove all blobs from blob storage and documents from the search index")
 parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
 parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
 parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--extractworkers", type=int, default=4, help="Number of sources that are downloaded and analyzed at the same time")
+parser.add_argument("--chunkworkers", type=int, default=2, help="Number of sources that are split into sections at the same time")
+parser.add_argument("--uploadworkers", type=int, default=4, help="Number of files that are uploaded to blob storage at the same time")
+parser.add_argument("--indexworkers", type=int, default=4, help="Number of section batches that are uploaded to the search index at the same time")
+parser.add_argument("--queuesize", type=int, default=16, help="Number of items that can wait between two stages of the ingestion pipeline")
+parser.add_argument("--progressinterval", type=float, default=10, help="Seconds between progress reports")
+parser.add_argument("--chunking", choices=[CHARACTERS, TOKENS], default=CHARACTERS, help="Measure the length and overlap of the sections files are split into in characters, or in the tokens the app counts its prompts in")
+parser.add_argument("--sectiontokens", type=int, default=MAX_SECTION_TOKENS, help="Length of the sections in tokens when chunking by tokens, sections can be longer by twice the sentence search limit")
+parser.add_argument("--manifest", required=False, help="Optional. Local file with the content hashes of the indexed sources and sections, used to only index what changed since the last run (defaults to .manifest-<searchservice>-<index>-<storageaccount>-<container>.json next to this script, so runs against other services or containers don't share it)")
+parser.add_argument("--full", action="store_true", help="Analyze and upload all sources, even the ones the manifest shows as unchanged")
 parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
 args = parser.parse_args()
 
@@ -49,6 +71,17 @@ args = parser.parse_args()
 url_sources = [("www.dnb.no/en/insurance/house-insurance", "house insurance"), ("www.dnb.no/en/insurance/home-contents-insurance", "content insurance"), ("www.dnb.no/en/insurance/car-insurance", "car insurance"), ("www.dnb.no/en/insurance", "general insurance information")]
 file_sources = [("data/Car insurance.pdf", "car insurance"), ("data/HouseInsuranceTest.pdf", "house insurance"),  ("data/contentinsurance.pdf",  "content insurance")]
 
+# Kinds of sources the ingestion pipeline processes, as (kind, url or filename, description)
+URL_SOURCE = "url"
+FILE_SOURCE = "file"
+
+# Sections uploaded to the search index in one request
+INDEX_BATCH_SIZE = 1000
+
+# Actions of the index stage
+UPLOAD = "upload"
+DELETE = "delete"
+
 # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
 azd_credential = AzureDeveloperCliCredential() if args.tenantid == None else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
 default_creds = azd_credential if args.searchkey == None or args.storagekey == None else None
@@ -106,60 +139,41 @@ def remove_blobs(filename):
             if args.verbose: print(f"\tRemoving blob {b}")
             blob_container.delete_blob(b)
 
-def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
-    for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
-            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
-            cell_spans = ""
-            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
-            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
-
-def get_document_text_from_analysis_result(result: AnalyzeResult):
-    offset = 0
-    page_map = []
-    for page_num, page in enumerate(result.pages):
-        tables_on_page = [table for table in result.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-        # mark all positions of the table spans in the page
-        page_offset = page.spans[0].offset
-        page_length = page.spans[0].length
-        table_chars = [-1]*page_length
-        for table_id, table in enumerate(tables_on_page):
-            for span in table.spans:
-                # replace all table spans with "table_id" in table_chars array
-                for i in range(span.length):
-                    idx = span.offset - page_offset + i
-                    if idx >=0 and idx < page_length:
-                        table_chars[idx] = table_id
-
-        # build page text by replacing charcters in table spans with table html
-        page_text = ""
-        added_tables = set()
-        for idx, table_id in enumerate(table_chars):
-            if table_id == -1:
-                page_text += result.content[page_offset + idx]
-            elif not table_id in added_tables:
-                page_text += table_to_html(tables_on_page[table_id])
-                added_tables.add(table_id)
-
-        page_text += " "
-        page_map.append((page_num, offset, page_text))
-        offset += len(page_text)
-
-    return page_map
-
-def get_html_page_text(url):
-    req = Request(f"https://{url}")
-    html_page = urlopen(req).read()
+def update_index_version():
+    # The backend caches answers and search results per index version, so bump it whenever the index content changes
+    if args.skipblobs:
+        print("Skipping index version update since blob storage is skipped, cached answers in the app will not be invalidated")
+        return
+    version = str(int(time.time()))
+    if args.verbose: print(f"Updating index version to {version}")
+    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
+    blob_container = blob_service.get_container_client(args.container)
+    if not blob_container.exists():
+        blob_container.create_container()
+    blob_container.set_container_metadata({"indexversion": version})
+
+# Downloads a url, unless it hasn't changed since the response the manifest has the validators of. Returns the content,
+# None if it hasn't changed, and the validators of the response
+def download_url(url, entry):
+    headers = {}
+    if entry.get("etag"): headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"): headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        response = urlopen(Request(f"https://{url}", headers=headers))
+    except HTTPError as e:
+        if e.code == 304:
+            return None, entry.get("etag"), entry.get("last_modified")
+        raise
+    with response:
+        return response.read(), response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+def get_html_page_text(url, html_page=None):
+    if html_page is None:
+        req = Request(f"https://{url}")
+        html_page = urlopen(req).read()
     soup = BeautifulSoup(html_page, "html.parser")
 
+    page_map = []
     page_num = 0
     offset = 0
 
@@ -208,10 +222,14 @@ def get_html_page_text(url):
 
     return page_map
 
-def get_document_text_from_url(url):
+# Form Recognizer downloads the document itself, unless it has been downloaded already
+def get_document_text_from_url(url, data=None):
     if args.verbose: print(f"Extracting text from '{url}' using Azure Form Recognizer")
     form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"})
-    poller = form_recognizer_client.begin_analyze_document_from_url("prebuilt-layout", f"https://{url}")
+    if data is None:
+        poller = form_recognizer_client.begin_analyze_document_from_url("prebuilt-layout", f"https://{url}")
+    else:
+        poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = data)
     form_recognizer_results = poller.result()
 
     return get_document_text_from_analysis_result(form_recognizer_results)
@@ -237,70 +255,23 @@ def get_document_text_from_file(filename):
 
         return get_document_text_from_analysis_result(form_recognizer_results)
 
-def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
-
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-        
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+# Counts the tokens of the content as the app puts it in the prompt, with newlines replaced by spaces
+def content_token_count(content):
+    return len(encoding.encode(content.replace('\n', ' ').replace('\r', ' '), disallowed_special=()))
 
 def create_sections_for_file(filename, page_map, description):
-    for i, (section, pagenum) in enumerate(split_text(page_map)):
+    if args.chunking == TOKENS:
+        # The overlap and search limits keep their share of the section length
+        scale = args.sectiontokens / MAX_SECTION_TOKENS
+        sections = split_text(page_map, args.verbose, args.sectiontokens, max(1, round(SENTENCE_SEARCH_TOKENS * scale)), max(1, round(SECTION_OVERLAP_TOKENS * scale)), encoding)
+    else:
+        sections = split_text(page_map, args.verbose)
+    for i, (section, pagenum) in enumerate(sections):
+        content = f"This sections is about {description}. {section}"
         yield {
             "id": re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{i}"),
-            "content": f"This sections is about {description}. {section}",
+            "content": content,
+            TOKENS_FIELD: content_token_count(content),
             "category": args.category,
             "sourcepage": blob_name_from_file_page(filename, pagenum),
             "sourcefile": filename,
@@ -311,14 +282,17 @@ def create_id_from_url(url):
 
 def create_sections_for_webpage(url, page_map, description):
     for (page_num, offset, page_text) in page_map:
+        content = f"This paragraph is about {description}. {page_text}"
         yield {
             "id": f"{create_id_from_url(url)}-{page_num}",
-            "content": f"This paragraph is about {description}. {page_text}",
+            "content": content,
+            TOKENS_FIELD: content_token_count(content),
             "category": args.category,
             "sourcepage": blob_name_from_file_page(url, page_num),
             "sourcefile": url,
         }
 
+# Returns whether the index was created
 def create_search_index():
     if args.verbose: print(f"Ensuring search index {args.index} exists")
     index_client = SearchIndexClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
@@ -333,6 +307,7 @@ def create_search_index():
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
+                SimpleField(name=TOKENS_FIELD, type="Edm.Int32"),
             ],
             semantic_settings=SemanticSettings(
                 configurations=[SemanticConfiguration(
@@ -342,30 +317,169 @@ def create_search_index():
         )
         if args.verbose: print(f"Creating {args.index} search index")
         index_client.create_index(index)
+        return True
     else:
         if args.verbose: print(f"Search index {args.index} already exists")
-
-def index_sections(filename, sections):
-    if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
+        # Indexes created before the token counts were stored get the field added in place, which the service allows
+        # without rebuilding the index. The documents already in it keep no value for the field until they are indexed
+        # again, the app counts the tokens of those when it builds its prompts. Printed even without --verbose, since it
+        # changes the schema of an index that may be serving
+        index = index_client.get_index(args.index)
+        if TOKENS_FIELD not in [field.name for field in index.fields]:
+            print(f"Adding {TOKENS_FIELD} field to existing search index {args.index}, documents indexed before have no value for it until they are indexed again")
+            index.fields.append(SimpleField(name=TOKENS_FIELD, type="Edm.Int32"))
+            index_client.create_or_update_index(index)
+        return False
+
+# Returns the ids of the sections that were indexed
+def index_sections(search_client, filename, batch):
+    if args.verbose: print(f"Indexing {len(batch)} sections from '{filename}' into search index '{args.index}'")
+    results = search_client.upload_documents(documents=batch)
+    succeeded = [r.key for r in results if r.succeeded]
+    if args.verbose: print(f"\tIndexed {len(results)} sections, {len(succeeded)} succeeded")
+    return succeeded
+
+# Returns the ids of the sections that were deleted
+def delete_sections(search_client, filename, ids):
+    if args.verbose: print(f"Deleting {len(ids)} sections from '{filename}' that no longer exist from search index '{args.index}'")
+    results = search_client.delete_documents(documents=[{ "id": id } for id in ids])
+    return [r.key for r in results if r.succeeded]
+
+# The description and category are part of every section, and files are split by the chunking settings, so sources are
+# indexed again when they change
+def source_hash(source, content):
+    kind, path, description = source
+    if kind == FILE_SOURCE and args.chunking == TOKENS:
+        return content_hash(content, description, args.category, TOKENS, args.sectiontokens)
+    return content_hash(content, description, args.category)
+
+# Ingestion runs as a pipeline of stages with their own workers: text extraction, which waits on the web pages and Form
+# Recognizer, chunking, and indexing, while files are uploaded to blob storage next to the extraction. The stages are
+# connected by bounded queues, so re-indexing takes about as long as the slowest service needs for its share of the work.
+# Sources the manifest shows as unchanged are skipped before they are analyzed, and of the others only the sections that
+# changed are uploaded. Returns whether the index has changed, and whether anything failed. Sources that failed in any
+# stage aren't marked as indexed, so the next run processes them again
+def ingest(sources, manifest):
     search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                     index_name=args.index,
                                     credential=search_creds)
-
-    i = 0
-    batch = []
-    for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-            batch = []
-
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    counts = {"skipped": 0, "unchanged": 0, "uploaded": 0, "deleted": 0}
+    # Sources are marked as indexed in the manifest at the end, if neither their upload nor any of their sections failed
+    indexed_sources = {}
+    failed_sources = set()
+    lock = threading.Lock()
+
+    def count(name, n=1):
+        with lock:
+            counts[name] += n
+
+    def skip(path):
+        if args.verbose: print(f"Skipping '{path}', it hasn't changed since it was indexed")
+        count("skipped")
+
+    # Sections of sources that were indexed before but are no longer part of the run are deleted
+    for path, ids in manifest.removed_sources(path for kind, path, description in sources).items():
+        for i in range(0, len(ids), INDEX_BATCH_SIZE):
+            deleted = delete_sections(search_client, os.path.basename(path), ids[i:i + INDEX_BATCH_SIZE])
+            manifest.remove_sections(path, deleted)
+            count("deleted", len(deleted))
+        if not manifest.source(path).get("sections"):
+            manifest.remove_source(path)
+
+    def extract(source):
+        kind, path, description = source
+        if args.verbose: print(f"Processing '{path}'")
+        entry = {} if args.full else manifest.source(path)
+        etag = last_modified = None
+        if kind == FILE_SOURCE:
+            with open(path, "rb") as f:
+                hash = source_hash(source, f.read())
+            page_map = get_document_text_from_file(path)
+        else:
+            data, etag, last_modified = download_url(path, entry)
+            if data is None:
+                return skip(path)
+            if ".pdf" in path:
+                # Documents are hashed before they are analyzed, so unchanged ones cost no Form Recognizer pages
+                hash = source_hash(source, data)
+                if entry.get("hash") == hash:
+                    return skip(path)
+                page_map = get_document_text_from_url(path, data)
+            else:
+                # Web pages are hashed on the extracted text, their markup changes on every request
+                page_map = get_html_page_text(path, data)
+                hash = source_hash(source, json.dumps(page_map, ensure_ascii=False))
+        if entry.get("hash") == hash:
+            return skip(path)
+        yield source, page_map, (hash, etag, last_modified)
+
+    def chunk(item):
+        (kind, path, description), page_map, version = item
+        if kind == FILE_SOURCE:
+            sections = list(create_sections_for_file(os.path.basename(path), page_map, description))
+        else:
+            sections = list(create_sections_for_webpage(path, page_map, description))
+        changed, deleted = manifest.diff_sections(path, sections, args.full)
+        with lock:
+            indexed_sources[path] = version
+        count("unchanged", len(sections) - len(changed))
+        for i in range(0, len(changed), INDEX_BATCH_SIZE):
+            yield path, UPLOAD, changed[i:i + INDEX_BATCH_SIZE]
+        for i in range(0, len(deleted), INDEX_BATCH_SIZE):
+            yield path, DELETE, deleted[i:i + INDEX_BATCH_SIZE]
+
+    def index(item):
+        path, action, batch = item
+        succeeded = set()
+        try:
+            if action == UPLOAD:
+                succeeded = set(index_sections(search_client, os.path.basename(path), [section for section, hash in batch]))
+                manifest.set_sections(path, {section["id"]: hash for section, hash in batch if section["id"] in succeeded})
+                count("uploaded", len(succeeded))
+            else:
+                succeeded = set(delete_sections(search_client, os.path.basename(path), batch))
+                manifest.remove_sections(path, succeeded)
+                count("deleted", len(succeeded))
+        finally:
+            if len(succeeded) < len(batch):
+                with lock:
+                    failed_sources.add(path)
+
+    def upload(source):
+        try:
+            upload_blobs(source[1])
+        except Exception:
+            with lock:
+                failed_sources.add(source[1])
+            raise
+
+    index_stage = Stage("index", index, args.indexworkers, args.queuesize, describe=lambda item: f"{len(item[2])} sections from '{item[0]}'")
+    chunk_stage = Stage("chunk", chunk, args.chunkworkers, args.queuesize, index_stage, describe=lambda item: f"'{item[0][1]}'")
+    extract_stage = Stage("extract", extract, args.extractworkers, args.queuesize, chunk_stage, describe=lambda source: f"'{source[1]}'")
+    upload_stage = Stage("upload", upload, args.uploadworkers, args.queuesize, describe=lambda source: f"'{source[1]}'")
+    pipeline = Pipeline([extract_stage, upload_stage, chunk_stage, index_stage], args.progressinterval, lambda: ("sections uploaded", counts["uploaded"]))
+
+    # Only files have content of their own to upload, the pages of urls are linked to where they are. Local files are
+    # cheap to hash, so unchanged ones are skipped before they are uploaded
+    def route(source):
+        kind, path, description = source
+        if kind != FILE_SOURCE:
+            return [extract_stage]
+        if not args.full:
+            with open(path, "rb") as f:
+                if manifest.unchanged(path, source_hash(source, f.read())):
+                    skip(path)
+                    return []
+        return [extract_stage] if args.skipblobs else [extract_stage, upload_stage]
+
+    failures = pipeline.run(sources, route)
+
+    for path, (hash, etag, last_modified) in indexed_sources.items():
+        if path not in failed_sources:
+            manifest.set_source(path, hash, etag, last_modified)
+    manifest.save()
+    print(f"{counts['skipped']} unchanged sources skipped, {counts['uploaded']} sections uploaded, {counts['unchanged']} unchanged, {counts['deleted']} deleted")
+    return counts["uploaded"] > 0 or counts["deleted"] > 0, failures > 0 or len(failed_sources) > 0
 
 def remove_from_index(filename):
     if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
@@ -382,12 +496,18 @@ def remove_from_index(filename):
         # It can take a few seconds for search results to reflect changes, so wait a bit
         time.sleep(2)
 
+manifest = Manifest(args.manifest or os.path.join(os.path.dirname(os.path.abspath(__file__)), f".manifest-{args.searchservice}-{args.index}-{args.storageaccount}-{args.container}.json"))
+
 if args.removeall:
     remove_blobs(None)
     remove_from_index(None)
+    manifest.clear()
+    manifest.save()
+    update_index_version()
 else:
-    if not args.remove:
-        create_search_index()
+    # A new index has none of the sections the manifest shows as indexed, e.g. after it was deleted, so all are uploaded
+    if not args.remove and create_search_index():
+        manifest.clear()
     
     # print(f"Processing files...")
     # for filename in glob.glob(args.files):
@@ -423,16 +543,14 @@ else:
     #         sections = create_sections_for_file(os.path.basename(filename), page_map, description)
     #         index_sections(os.path.basename(filename), sections)
 
+    # Add (FILE_SOURCE, filename, description) for every entry of file_sources to process the files as well
     print("Processing urls...")
-    for source in url_sources:
-        url = source[0]
-        description = source[1]
-        if args.verbose: print(f"Processing '{url}'")
-
-        if ".pdf" in url:
-            page_map = get_document_text_from_url(url)
-        else:
-            page_map = get_html_page_text(url)
-
-        sections = create_sections_for_webpage(url, page_map, description)
-        index_sections(os.path.basename(url), sections)
+    changed, failed = ingest([(URL_SOURCE, url, description) for url, description in url_sources], manifest)
+    if failed:
+        # The app keeps serving its cached answers until a run indexes every source
+        print("Ingestion failed for some sources, not updating the index version, run again to retry them")
+        sys.exit(1)
+    if changed:
+        update_index_version()
+    else:
+        print("Search index is up to date, not updating the index version")
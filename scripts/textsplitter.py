@@ -0,0 +1,165 @@
+import re
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Any, Optional
+
+MAX_SECTION_LENGTH = 1000
+SENTENCE_SEARCH_LIMIT = 100
+SECTION_OVERLAP = 100
+
+# Settings of the token-aware mode, in tokens of the encoding the app counts prompts with
+MAX_SECTION_TOKENS = 250
+SENTENCE_SEARCH_TOKENS = 25
+SECTION_OVERLAP_TOKENS = 25
+
+SENTENCE_ENDINGS = [".", "!", "?"]
+WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+SENTENCE_ENDING = re.compile("[" + re.escape("".join(SENTENCE_ENDINGS)) + "]")
+WORD_BREAK = re.compile("[" + re.escape("".join(WORDS_BREAKS)) + "]")
+
+class Boundaries:
+    """
+    Finds the sentence endings and word breaks closest to a position in a text. The searches never look further than
+    the sentence search limits, so every window is searched by the regex engine or str.rfind instead of by stepping
+    through the text one character at a time, and splitting stays linear in the length of the text.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def is_sentence_ending(self, position: int) -> bool:
+        return self.text[position] in SENTENCE_ENDINGS
+
+    # First sentence ending in [low, high), or None
+    def first_sentence_ending(self, low: int, high: int) -> Optional[int]:
+        match = SENTENCE_ENDING.search(self.text, low, high)
+        return match.start() if match else None
+
+    # Last sentence ending in [low, high), or None
+    def last_sentence_ending(self, low: int, high: int) -> Optional[int]:
+        position = max(self.text.rfind(c, low, high) for c in SENTENCE_ENDINGS)
+        return position if position >= 0 else None
+
+    def first_word_break(self, low: int, high: int) -> Optional[int]:
+        match = WORD_BREAK.search(self.text, low, high)
+        return match.start() if match else None
+
+    def last_word_break(self, low: int, high: int) -> Optional[int]:
+        position = max(self.text.rfind(c, low, high) for c in WORDS_BREAKS)
+        return position if position >= 0 else None
+
+class Characters:
+    """Lengths of sections in characters, positions are character offsets."""
+
+    def __init__(self, text: str):
+        self.length = len(text)
+
+    def position(self, offset: int) -> int:
+        return offset
+
+    def offset(self, position: int) -> int:
+        return position
+
+class Tokens:
+    """
+    Lengths of sections in tokens. The text is encoded once, positions are indexes of tokens, and map to the offset of
+    the character the token starts at. A token that starts inside a multi-byte character maps to that character.
+    """
+
+    def __init__(self, text: str, encoding: Any):
+        tokens = encoding.encode(text, disallowed_special=())
+        byte_offsets = list(accumulate((len(b) for b in encoding.decode_tokens_bytes(tokens)), initial=0))
+        if text.isascii():
+            self.offsets = byte_offsets
+        else:
+            char_byte_offsets = list(accumulate((len(c.encode("utf-8")) for c in text), initial=0))
+            self.offsets = [bisect_right(char_byte_offsets, b) - 1 for b in byte_offsets]
+        self.length = len(tokens)
+
+    # Token the character at the offset belongs to, the offset of the end of the text is the position after the last token
+    def position(self, offset: int) -> int:
+        return bisect_right(self.offsets, offset) - 1
+
+    def offset(self, position: int) -> int:
+        return self.offsets[max(0, min(position, self.length))]
+
+# Index of the page the offset is on, pages without text share their offset with the next page and are never returned
+def find_page(offsets: list[int], offset: int) -> int:
+    i = bisect_right(offsets, offset) - 1
+    return i if i >= 0 else len(offsets) - 1
+
+def split_text(page_map, verbose: bool = False, max_section_length: Optional[int] = None, sentence_search_limit: Optional[int] = None, section_overlap: Optional[int] = None, encoding: Any = None):
+    """
+    Splits the text of the pages into sections of about max_section_length characters that overlap by section_overlap,
+    ending at a sentence ending within sentence_search_limit characters, or at least at a word break. Sections that
+    end in an unclosed table are followed by a section that starts with the table. Yields the text of every section
+    and the index of the page it starts on. Runs in linear time, pages are found by binary search.
+    With an encoding, the lengths, overlap and search limits are counted in its tokens instead, so sections are at
+    most max_section_length + 2 * sentence_search_limit tokens long. Settings that aren't given default to the ones of
+    the mode.
+    """
+    if encoding is None:
+        max_section_length = max_section_length or MAX_SECTION_LENGTH
+        sentence_search_limit = sentence_search_limit or SENTENCE_SEARCH_LIMIT
+        section_overlap = section_overlap or SECTION_OVERLAP
+    else:
+        max_section_length = max_section_length or MAX_SECTION_TOKENS
+        sentence_search_limit = sentence_search_limit or SENTENCE_SEARCH_TOKENS
+        section_overlap = section_overlap or SECTION_OVERLAP_TOKENS
+    offsets = [p[1] for p in page_map]
+    all_text = "".join(p[2] for p in page_map)
+    boundaries = Boundaries(all_text)
+    units = Characters(all_text) if encoding is None else Tokens(all_text, encoding)
+    length = len(all_text)
+    start = 0
+    end = length
+    while units.position(start) + section_overlap < units.length:
+        end = units.position(start) + max_section_length
+
+        if end > units.length:
+            end = length
+        else:
+            end = units.offset(end)
+            # Try to find the end of the sentence
+            limit = units.offset(min(units.length, units.position(start) + max_section_length + sentence_search_limit))
+            sentence_end = boundaries.first_sentence_ending(end, limit)
+            if sentence_end is not None:
+                end = sentence_end
+            else:
+                last_word = boundaries.last_word_break(end, limit)
+                end = limit
+                if end < length and not boundaries.is_sentence_ending(end) and last_word is not None and last_word > 0:
+                    end = last_word # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        lowest = units.offset(max(0, units.position(end) - max_section_length - 2 * sentence_search_limit))
+        if start > lowest:
+            sentence_start = boundaries.last_sentence_ending(lowest + 1, start + 1)
+            if sentence_start is not None:
+                start = sentence_start
+            else:
+                first_word = boundaries.first_word_break(lowest + 1, start + 1)
+                start = lowest
+                if not boundaries.is_sentence_ending(start) and first_word is not None and first_word > 0:
+                    start = first_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(offsets, start))
+
+        last_table_start = section_text.rfind("<table")
+        if (units.position(start + last_table_start) - units.position(start) > 2 * sentence_search_limit and last_table_start > section_text.rfind("</table")):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside sentence_search_limit, we ignore it, as that will cause an infinite loop for tables longer than max_section_length
+            # If last table starts inside section_overlap, keep overlapping
+            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(offsets, start)} offset {start} table start {last_table_start}")
+            start = min(units.offset(units.position(end) - section_overlap), start + last_table_start)
+        else:
+            start = units.offset(units.position(end) - section_overlap)
+
+    if units.position(start) + section_overlap < units.position(end):
+        yield (all_text[start:end], find_page(offsets, start))